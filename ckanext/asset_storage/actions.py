@@ -0,0 +1,287 @@
+"""ckanext-asset-storage actions
+"""
+import json
+import logging
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Dict, List, Optional, Set
+
+import six
+from ckan.plugins import toolkit
+from six import BytesIO
+from six.moves.urllib.request import urlopen
+from six.moves.urllib_parse import urlparse
+from werkzeug.datastructures import FileStorage, Headers
+
+from ckanext.asset_storage import uploader
+from ckanext.asset_storage.storage.stats import monotonic
+
+CONF_BATCH_UPLOAD_WORKERS = 'ckanext.asset_storage.batch_upload_workers'
+CONF_BATCH_UPLOAD_MAX_ITEMS = 'ckanext.asset_storage.batch_upload_max_items'
+
+FETCH_TIMEOUT = 10
+
+_log = logging.getLogger(__name__)
+
+
+class _BatchItem(object):
+    """A single image to upload in a batch, and its result
+    """
+    def __init__(self, item):
+        # type: (Dict[str, Any]) -> _BatchItem
+        self.group_id = item.get('id')
+        self.file_field = item.get('file')
+        self.url = item.get('url')
+        self.group = None
+        self.file = None  # type: Optional[FileStorage]
+        self.uploader = None  # type: Optional[uploader.AssetUploader]
+        self.image_url = None  # type: Optional[str]
+        self.error = None  # type: Optional[str]
+
+    def as_dict(self):
+        # type: () -> Dict[str, Any]
+        result = {'id': self.group_id, 'success': self.error is None}
+        if self.error is None:
+            result['image_url'] = self.image_url
+        else:
+            result['error'] = self.error
+        return result
+
+
+def upload_batch(context, data_dict):
+    """Upload images of many groups and organizations at once
+
+    :param items: list of images to upload, each a dict with the ``id`` (or
+        name) of a group or organization, and either ``file``, the name of
+        a multipart form field holding the uploaded file, or ``url``, an
+        HTTP(S) URL to fetch the image from. May be a JSON string.
+    :type items: list of dicts
+
+    Images are validated and uploaded to storage concurrently. All
+    successfully uploaded groups are then updated with ``group_patch`` or
+    ``organization_patch`` in a single transaction. Items which fail to
+    upload or to validate are skipped, and their new images deleted. If the
+    transaction fails, all items fail and all new images are deleted;
+    Previous images are only deleted once the transaction is committed.
+
+    :returns: a dict with ``results``, a result dict per item (in the same
+        order) with ``success`` and either the new ``image_url`` or an
+        ``error``; the number of ``uploaded`` and ``failed`` items; the
+        total ``elapsed`` seconds; and ``throughput`` in items per second.
+    :rtype: dict
+    """
+    toolkit.check_access('asset_storage_upload_batch', context, data_dict)
+    start = monotonic()
+    items = [_BatchItem(item) for item in _parse_items(data_dict)]
+    model = context['model']
+    max_size = toolkit.asint(toolkit.config.get('ckan.max_image_size', 2))
+    workers = toolkit.asint(toolkit.config.get(CONF_BATCH_UPLOAD_WORKERS, 8))
+
+    seen_groups = set()
+    for item in items:
+        _prepare_item(item, model, data_dict, seen_groups)
+    _assign_files(items, data_dict)
+    _run_concurrently(lambda item: _fetch_item(item, max_size), items, workers)
+
+    storage = uploader.get_configured_storage()
+    for item in items:
+        _create_uploader(item, storage)
+    _run_concurrently(lambda item: item.uploader.upload(max_size), items, workers)
+
+    _update_groups(items, context, storage)
+
+    elapsed = monotonic() - start
+    uploaded = sum(1 for item in items if item.error is None)
+    return {'results': [item.as_dict() for item in items],
+            'uploaded': uploaded,
+            'failed': len(items) - uploaded,
+            'elapsed': elapsed,
+            'throughput': len(items) / elapsed if elapsed else 0.0}
+
+
+def _parse_items(data_dict):
+    # type: (Dict[str, Any]) -> List[Dict[str, Any]]
+    items = data_dict.get('items')
+    if isinstance(items, six.string_types):
+        try:
+            items = json.loads(items)
+        except ValueError:
+            raise toolkit.ValidationError({'items': ['Expecting a JSON list']})
+    if not isinstance(items, list) or not items or not all(isinstance(item, dict) for item in items):
+        raise toolkit.ValidationError({'items': ['Expecting a non-empty list of items']})
+
+    max_items = toolkit.asint(toolkit.config.get(CONF_BATCH_UPLOAD_MAX_ITEMS, 500))
+    if len(items) > max_items:
+        raise toolkit.ValidationError({'items': ['At most {} items may be uploaded at once'.format(max_items)]})
+    return items
+
+
+def _prepare_item(item, model, data_dict, seen_groups):
+    # type: (_BatchItem, Any, Dict[str, Any], Set[str]) -> None
+    """Validate a batch item, and find its group and uploaded file
+    """
+    item.group = model.Group.get(item.group_id) if item.group_id else None
+    if item.group is None:
+        item.error = 'Group not found'
+    elif item.group.id in seen_groups:
+        item.error = 'Group is listed more than once'
+    elif bool(item.file_field) == bool(item.url):
+        item.error = 'Expecting either a file or a url'
+    elif item.url and urlparse(item.url).scheme not in {'http', 'https'}:
+        item.error = 'Expecting an HTTP or HTTPS url'
+    elif item.file_field and not uploader._is_uploaded_file_field(data_dict.get(item.file_field)):
+        item.error = 'No file was uploaded in field {}'.format(item.file_field)
+    else:
+        seen_groups.add(item.group.id)
+
+
+def _assign_files(items, data_dict):
+    # type: (List[_BatchItem], Dict[str, Any]) -> None
+    """Assign uploaded files to batch items
+
+    A file may be used for several groups; As files are uploaded
+    concurrently, each of these gets its own copy of the file.
+    """
+    used_fields = set()
+    for item in items:
+        if item.error is not None or not item.file_field:
+            continue
+        uploaded = data_dict[item.file_field]
+        if item.file_field in used_fields:
+            stream = uploader._get_underlying_file(uploaded)
+            stream.seek(0)
+            content = stream.read()
+            stream.seek(0)
+            uploaded = FileStorage(stream=BytesIO(content), filename=uploaded.filename, name=item.file_field,
+                                   content_type=uploader.get_uploaded_mimetype(uploaded))
+        used_fields.add(item.file_field)
+        item.file = uploaded
+
+
+def _fetch_item(item, max_size):
+    # type: (_BatchItem, int) -> None
+    """Fetch the image of a batch item from its remote URL
+    """
+    if item.url is None:
+        return
+
+    response = urlopen(item.url, timeout=FETCH_TIMEOUT)
+    try:
+        content = response.read(max_size * uploader.MB + 1)
+        content_type = response.info().get('Content-Type')
+    finally:
+        response.close()
+    if len(content) > max_size * uploader.MB:
+        raise toolkit.ValidationError({'upload': ['File upload too large']})
+
+    filename = posixpath.basename(urlparse(item.url).path) or 'image'
+    headers = Headers([('Content-Type', content_type)]) if content_type else None
+    item.file = FileStorage(stream=BytesIO(content), filename=filename, name='image_upload', headers=headers)
+
+
+def _create_uploader(item, storage):
+    # type: (_BatchItem, Any) -> None
+    """Create an uploader for a batch item
+
+    This needs to run in the request thread, to build the new image URL
+    """
+    if item.error is not None:
+        return
+    item.uploader = uploader.AssetUploader(storage, 'group')
+    data = {'image_url': '', 'image_upload': item.file}
+    item.uploader.update_data_dict(data, 'image_url', 'image_upload', 'clear_upload')
+    item.image_url = data['image_url']
+
+
+def _run_concurrently(func, items, workers):
+    """Run `func` for each batch item without an error on a bounded thread pool, recording errors
+    """
+    pending = [item for item in items if item.error is None]
+    if not pending:
+        return
+    with ThreadPoolExecutor(max_workers=min(workers, len(pending))) as executor:
+        futures = [(item, executor.submit(func, item)) for item in pending]
+        for item, future in futures:
+            try:
+                future.result()
+            except toolkit.ValidationError as e:
+                item.error = '; '.join(_error_messages(e.error_dict))
+            except Exception as e:
+                _log.warning("Batch upload of image for group %s failed: %s", item.group_id, e)
+                item.error = str(e) or e.__class__.__name__
+
+
+def _error_messages(error_dict):
+    # type: (Dict[str, Any]) -> List[str]
+    messages = []
+    for errors in error_dict.values():
+        messages.extend(errors if isinstance(errors, list) else [errors])
+    return [str(message) for message in messages]
+
+
+def _update_groups(items, context, storage):
+    # type: (List[_BatchItem], Dict[str, Any], Any) -> None
+    """Update the image URL of all successfully uploaded groups in a single transaction
+
+    Groups are updated through the patch actions, so plugins and validation
+    apply as with any other update. Previous images are only deleted once the
+    transaction is committed, so if it fails all groups keep their images.
+    """
+    model = context['model']
+    patch_context = {'model': model,
+                     'session': model.Session,
+                     'user': context.get('user'),
+                     'auth_user_obj': context.get('auth_user_obj'),
+                     'defer_commit': True}
+    pending = [item for item in items if item.error is None]
+    old_uris = []  # type: List[str]
+    try:
+        with uploader.defer_old_file_deletes() as deferred:
+            for item in pending:
+                _patch_group(item, patch_context)
+        model.repo.commit()
+        old_uris = deferred
+    except Exception as e:
+        _log.error("Failed to update groups with uploaded images, deleting new images: %s", e)
+        model.Session.rollback()
+        for item in pending:
+            item.error = item.error or 'Failed to update group'
+
+    for item in pending:
+        if item.error is not None:
+            _delete_image(storage, item.image_url)
+    for uri in old_uris:
+        _delete_image(storage, uri)
+
+
+def _patch_group(item, patch_context):
+    # type: (_BatchItem, Dict[str, Any]) -> None
+    """Patch a group with its new image URL, without committing
+
+    Clearing the previous upload makes the update action replace the image
+    URL; The previous image is kept until the transaction is committed.
+    """
+    action = 'organization_patch' if item.group.is_organization else 'group_patch'
+    try:
+        toolkit.get_action(action)(dict(patch_context), {'id': item.group.id,
+                                                         'image_url': item.image_url,
+                                                         'clear_upload': True})
+    except toolkit.ValidationError as e:
+        item.error = '; '.join(_error_messages(e.error_dict))
+
+
+def _delete_image(storage, image_url):
+    # type: (Any, str) -> None
+    """Delete a group image which is no longer referenced from the database
+    """
+    old_uploader = uploader.AssetUploader(storage, 'group', old_filename=image_url)
+    old_uploader.update_data_dict({'image_url': image_url, 'clear_upload': True},
+                                  'image_url', 'image_upload', 'clear_upload')
+    try:
+        old_uploader.upload()
+    except Exception as e:
+        _log.warning("Failed to delete group image %s: %s", image_url, e)
+
+
+def get_actions():
+    return {'asset_storage_upload_batch': upload_batch}
@@ -0,0 +1,165 @@
+"""Admission control for asset uploads
+
+Limits the number of uploads processed concurrently in each process, and
+optionally across all processes on the same host. Uploads exceeding the
+limit wait in a bounded queue; if the queue is full, or if they have waited
+for too long, they are rejected, so that a burst of uploads cannot tie up
+all workers and starve other requests.
+"""
+import errno
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from ckanext.asset_storage import metrics
+from ckanext.asset_storage.storage.stats import monotonic
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_log = logging.getLogger(__name__)
+
+
+class AdmissionRejected(Exception):
+    """An upload was not admitted, because too many uploads are in progress
+    """
+    pass
+
+
+class AdmissionController(object):
+    """Limit the number of concurrent uploads
+    """
+    def __init__(self, max_concurrent=None, max_queued=10, timeout=5.0, host_max_concurrent=None, host_lock_dir=None,
+                 poll_interval=0.05):
+        # type: (Optional[int], int, float, Optional[int], Optional[str], float) -> AdmissionController
+        """Create a new admission controller
+
+        Args:
+            max_concurrent: Max number of concurrent uploads in this process, or `None` for no limit
+            max_queued: Max number of uploads waiting to be admitted in this process
+            timeout: Max number of seconds an upload may wait to be admitted
+            host_max_concurrent: Max number of concurrent uploads across all processes on this host, or `None`
+                for no limit. Requires `host_lock_dir`, and is only supported on POSIX systems.
+            host_lock_dir: A directory for lock files used to coordinate processes on this host
+            poll_interval: Number of seconds between attempts to get a host-wide upload slot
+        """
+        self._max_concurrent = max_concurrent
+        self._max_queued = max_queued
+        self._timeout = timeout
+        self._active = 0
+        self._waiting = 0
+        self._condition = threading.Condition()
+
+        if host_max_concurrent and fcntl is None:
+            _log.warning('Host-wide upload limits are not supported on this platform, ignoring')
+            host_max_concurrent = None
+        self._host_slots = HostSlots(host_lock_dir, host_max_concurrent, poll_interval) if host_max_concurrent else None
+
+    @contextmanager
+    def admit(self):
+        # type: () -> Iterator[None]
+        """Wait for the upload to be admitted, and hold an upload slot until done
+
+        Raises `AdmissionRejected` if the upload is not admitted.
+        """
+        start = monotonic()
+        deadline = start + self._timeout
+        self._acquire(deadline)
+        try:
+            if self._host_slots is None:
+                metrics.timing('admission.wait', monotonic() - start)
+                yield
+            else:
+                with self._host_slots.acquire(deadline):
+                    metrics.timing('admission.wait', monotonic() - start)
+                    yield
+        finally:
+            self._release()
+
+    def _acquire(self, deadline):
+        # type: (float) -> None
+        if not self._max_concurrent:
+            with self._condition:
+                self._active += 1
+            return
+
+        with self._condition:
+            if self._active >= self._max_concurrent and self._waiting >= self._max_queued:
+                metrics.incr('admission.rejected')
+                raise AdmissionRejected('Too many uploads are waiting to be processed')
+
+            self._waiting += 1
+            try:
+                while self._active >= self._max_concurrent:
+                    remaining = deadline - monotonic()
+                    if remaining <= 0:
+                        metrics.incr('admission.rejected')
+                        raise AdmissionRejected('Timed out waiting for other uploads to complete')
+                    self._condition.wait(remaining)
+            finally:
+                self._waiting -= 1
+            self._active += 1
+
+    def _release(self):
+        # type: () -> None
+        with self._condition:
+            self._active -= 1
+            self._condition.notify()
+
+
+class HostSlots(object):
+    """A fixed number of upload slots shared by all processes on a host
+
+    Each slot is an exclusive lock on a file in a shared directory. Locks
+    are released by the OS if a process dies while holding one.
+    """
+    def __init__(self, lock_dir, slots, poll_interval=0.05):
+        # type: (str, int, float) -> HostSlots
+        self._lock_dir = lock_dir
+        self._slots = slots
+        self._poll_interval = poll_interval
+        try:
+            os.makedirs(lock_dir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    @contextmanager
+    def acquire(self, deadline):
+        # type: (float) -> Iterator[None]
+        """Hold one of the slots, waiting for one to be free until `deadline`
+
+        Raises `AdmissionRejected` if no slot was free until `deadline`
+        """
+        fd = self._try_acquire()
+        while fd is None:
+            if monotonic() >= deadline:
+                metrics.incr('admission.rejected')
+                raise AdmissionRejected('Timed out waiting for uploads in other processes to complete')
+            time.sleep(min(self._poll_interval, max(deadline - monotonic(), 0)))
+            fd = self._try_acquire()
+
+        try:
+            yield
+        finally:
+            fcntl.flock(fd, fcntl.LOCK_UN)
+            os.close(fd)
+
+    def _try_acquire(self):
+        # type: () -> Optional[int]
+        """Try to lock any of the slot files, returning the locked file descriptor or None
+        """
+        for slot in range(self._slots):
+            fd = os.open(os.path.join(self._lock_dir, 'slot-{}.lock'.format(slot)), os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError):
+                os.close(fd)
+                continue
+            return fd
+        return None
@@ -0,0 +1,31 @@
+"""ckanext-asset-storage authorization functions
+"""
+from ckan.authz import is_sysadmin
+
+
+def upload_url(context, data_dict):
+    """Check if the user is allowed to request a direct upload URL
+
+    Any logged in user may upload group and user images, but only sysadmins
+    may upload site (admin) assets.
+    """
+    user = context.get('user')
+    if not user:
+        return {'success': False, 'msg': 'You must be logged in to upload assets'}
+    if data_dict.get('object_type') == 'admin' and not is_sysadmin(user):
+        return {'success': False, 'msg': 'Only system administrators may upload site assets'}
+    return {'success': True}
+
+
+def upload_batch(context, data_dict):
+    """Check if the user is allowed to upload images of many groups at once
+
+    Only sysadmins may do this, as the action updates groups directly and
+    fetches images from arbitrary URLs.
+    """
+    return {'success': False, 'msg': 'Only system administrators may upload images in batches'}
+
+
+def get_auth_functions():
+    return {'asset_storage_upload_url': upload_url,
+            'asset_storage_upload_batch': upload_batch}
@@ -0,0 +1,145 @@
+"""Benchmarking of storage backends
+
+This uploads, downloads (or signs download URLs for) and deletes a set of
+synthetic assets of given sizes, under a scratch prefix, and reports the
+latency percentiles and throughput of each operation. It is meant to show
+how a configured storage backend actually performs from a given node.
+"""
+import logging
+import os
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set
+
+from six import BytesIO
+
+from ckanext.asset_storage.storage import StorageBackend
+from ckanext.asset_storage.storage.stats import LatencySummary, monotonic
+
+_log = logging.getLogger(__name__)
+
+
+class OperationResult(LatencySummary):
+    """Benchmark results of a single operation on assets of a given size
+    """
+    def __init__(self, operation, size, latencies, errors, elapsed):
+        # type: (str, int, List[float], int, float) -> OperationResult
+        super(OperationResult, self).__init__(latencies)
+        self.operation = operation
+        self.size = size
+        self.errors = errors
+        self.elapsed = elapsed
+
+    @property
+    def throughput(self):
+        # type: () -> float
+        """Successful operations per second
+        """
+        return len(self.latencies) / self.elapsed if self.elapsed else 0.0
+
+    def as_dict(self):
+        # type: () -> Dict[str, Any]
+        result = {'operation': self.operation,
+                  'size': self.size,
+                  'count': len(self.latencies),
+                  'errors': self.errors,
+                  'elapsed': self.elapsed,
+                  'throughput': self.throughput}
+        for pct, value in self.percentiles():
+            result['p{}'.format(pct)] = value
+        return result
+
+
+class Benchmark(object):
+    """Benchmark a storage backend
+
+    Every asset uploaded by the benchmark is deleted by `cleanup()`, unless
+    already deleted as part of the benchmark. `run()` always cleans up,
+    even if interrupted.
+    """
+    def __init__(self, storage, sizes, count=10, concurrency=4, prefix=None):
+        # type: (StorageBackend, Iterable[int], int, int, Optional[str]) -> Benchmark
+        self._storage = storage
+        self._sizes = list(sizes)
+        self._count = count
+        self._concurrency = concurrency
+        self.prefix = prefix or 'asset-storage-bench-{}'.format(uuid.uuid4().hex[:8])
+        self._pending_cleanup = set()  # type: Set[str]
+
+    def run(self):
+        # type: () -> List[OperationResult]
+        results = []
+        try:
+            for size in self._sizes:
+                results.extend(self._run_size(size))
+        finally:
+            self.cleanup()
+        return results
+
+    def cleanup(self):
+        # type: () -> None
+        """Delete any assets uploaded by the benchmark, which were not deleted yet
+        """
+        for uri in sorted(self._pending_cleanup):
+            try:
+                self._storage.delete(uri)
+            except Exception as e:
+                _log.warning('Failed to delete benchmark asset %s: %s', uri, e)
+        self._pending_cleanup.clear()
+
+    def _run_size(self, size):
+        # type: (int) -> List[OperationResult]
+        content = os.urandom(size)
+        names = ['asset-{}-{:04d}.bin'.format(size, i) for i in range(self._count)]
+        uris = ['{}/{}'.format(self.prefix, name) for name in names]
+
+        def upload(name):
+            self._pending_cleanup.add('{}/{}'.format(self.prefix, name))
+            self._storage.upload(BytesIO(content), name, self.prefix, mimetype='application/octet-stream')
+
+        def delete(uri):
+            self._storage.delete(uri)
+            self._pending_cleanup.discard(uri)
+
+        return [self._run_operation('upload', size, upload, names),
+                self._run_operation('download', size, self._download, uris),
+                self._run_operation('delete', size, delete, uris)]
+
+    def _download(self, uri):
+        # type: (str) -> None
+        """Download a file, or get a URL to download it from
+        """
+        target = self._storage.download(uri)
+        if target.fileobj:
+            try:
+                target.fileobj.read()
+            finally:
+                target.fileobj.close()
+
+    def _run_operation(self, operation, size, func, items):
+        # type: (str, int, Callable[[str], None], List[str]) -> OperationResult
+        latencies = []  # type: List[float]
+        errors = 0
+        start = monotonic()
+        executor = ThreadPoolExecutor(max_workers=self._concurrency)
+        futures = [executor.submit(_timed, func, item) for item in items]
+        try:
+            for future in futures:
+                try:
+                    latencies.append(future.result())
+                except Exception as e:
+                    _log.debug('Benchmark %s operation failed: %s', operation, e)
+                    errors += 1
+        finally:
+            # If interrupted, don't start any more operations
+            for future in futures:
+                future.cancel()
+            executor.shutdown(wait=True)
+        return OperationResult(operation, size, latencies, errors, monotonic() - start)
+
+
+def _timed(func, item):
+    # type: (Callable[[str], None], str) -> float
+    start = monotonic()
+    func(item)
+    return monotonic() - start
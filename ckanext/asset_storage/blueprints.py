@@ -1,10 +1,22 @@
 """ckanext-external-storage Flask blueprints
 """
+import mimetypes
+import os
+
 from ckan.plugins import toolkit
-from flask import Blueprint, redirect, send_file
+from flask import Blueprint, Response, jsonify, redirect, request, send_file
+from werkzeug.wsgi import wrap_file
 
+from . import compression, direct_upload, tracing
+from .cache import CachedAsset
 from .storage import exc
-from .uploader import decode_uri, get_configured_storage
+from .uploader import (MB, RESOURCES_PREFIX, create_storage_filename, decode_uri, get_configured_cache,
+                       get_configured_storage, get_download_url, get_missing_variants, get_resource_uri, get_secret,
+                       is_direct_upload_enabled, is_precompress_enabled, is_server_timing_enabled)
+
+DIRECT_UPLOAD_OBJECT_TYPES = {'group', 'user', 'admin'}
+
+DIRECT_UPLOAD_EXPIRES_IN = 3600
 
 blueprint = Blueprint(
     'asset_storage',
@@ -17,27 +29,256 @@ def uploaded_file(file_uri):
 
     This may either return a redirect response to the canonical asset URL,
     or the asset itself as a stream of bytes (?)
+
+    If enabled, a `Server-Timing` header breaks down the time spent in
+    each phase of handling the request.
     """
-    storage = get_configured_storage()
+    server_timing = is_server_timing_enabled()
+    if server_timing:
+        tracing.start_timings()
     try:
-        storage_result = storage.download(decode_uri(file_uri))
+        with tracing.span('request'):
+            response = _uploaded_file(file_uri)
+    finally:
+        timings = tracing.stop_timings()
+
+    if server_timing:
+        response.headers['Server-Timing'] = tracing.format_server_timing(timings)
+    return response
+
+
+def _uploaded_file(file_uri):
+    with tracing.span('get_storage'):
+        storage = get_configured_storage()
+    uri = decode_uri(file_uri)
+    if uri.split('/', 1)[0] == RESOURCES_PREFIX:
+        # Resource files may belong to private datasets, and are served by `resource_download`
+        return toolkit.abort(404, "The requested asset was not found in storage: {}".format(uri))
+    mimetype = mimetypes.guess_type(uri)[0]
+    negotiate_encoding = is_precompress_enabled() and compression.is_compressible(mimetype)
+    encodings = compression.accepted_encodings(request.headers.get('Accept-Encoding')) if negotiate_encoding else []
+
+    try:
+        storage_result, encoding = _download(storage, uri, encodings, mimetype, get_configured_cache(),
+                                             get_missing_variants())
     except exc.ObjectNotFound:
         return toolkit.abort(
             404,
-            "The requested asset was not found in storage: {}".format(
-                decode_uri(file_uri)
-            ),
+            "The requested asset was not found in storage: {}".format(uri),
         )
 
-    if storage_result.fileobj:
+    response = _make_response(storage_result, mimetype if encoding else None, encoding)
+    if negotiate_encoding:
+        response.vary.add('Accept-Encoding')
+    return response
+
+
+def _make_response(storage_result, mimetype, encoding):
+    """Make a response from a storage result or a cached asset
+
+    If `mimetype` is not set, the MIME type provided by storage is used
+    """
+    if isinstance(storage_result, CachedAsset):
+        # Asset served from the in-memory cache
+        response = Response(storage_result.content, mimetype=storage_result.mimetype)
+        response.set_etag(storage_result.etag)
+        if storage_result.content_encoding:
+            response.headers['Content-Encoding'] = storage_result.content_encoding
+        return response.make_conditional(request)
+    elif storage_result.fileobj:
         # File-like object, just serve it
-        return send_file(storage_result.fileobj, mimetype=storage_result.mimetype)
+        response = send_file(storage_result.fileobj, mimetype=mimetype or storage_result.mimetype)
+        if encoding:
+            response.headers['Content-Encoding'] = encoding
+        return response
     elif storage_result.redirect_to:
         # Got a redirect response to an external URL
         return redirect(storage_result.redirect_to, storage_result.redirect_code)
+    else:
+        raise ValueError("Unexpected response from storage backend: {}".
+                         format(storage_result))
+
+
+def _download(storage, uri, encodings, mimetype, cache=None, missing_variants=None):
+    """Download the first available precompressed variant of an asset in
+    one of the given encodings, or the asset itself if none is available
+
+    Variants recorded in `missing_variants` are not looked up, and variants
+    found to be missing are recorded there.
+
+    Returns a tuple of the storage result (or a `CachedAsset` if the asset is
+    cached in memory) and the content encoding of the downloaded variant, if any
+    """
+    for encoding in encodings:
+        variant = compression.variant_name(uri, encoding)
+        if missing_variants is not None and variant in missing_variants:
+            continue
+        try:
+            with tracing.span('download_{}'.format(encoding), {'asset_storage.uri': uri}):
+                return _download_cached(storage, variant, cache, mimetype, encoding), encoding
+        except exc.ObjectNotFound:
+            if missing_variants is not None:
+                missing_variants.add(variant)
+            continue
+    with tracing.span('download', {'asset_storage.uri': uri}):
+        return _download_cached(storage, uri, cache), None
+
+
+def _download_cached(storage, uri, cache, mimetype=None, encoding=None):
+    """Get an asset from the in-memory cache, or download it from storage
+
+    Downloaded files which are small enough are added to the cache. If
+    `mimetype` is not set, the MIME type provided by storage is used.
+    """
+    if cache is None:
+        return storage.download(uri)
+
+    cached = cache.get(uri)
+    if cached is not None:
+        return cached
+
+    storage_result = storage.download(uri)
+    if not storage_result.fileobj:
+        return storage_result
+
+    content = _read_cacheable(storage_result.fileobj, cache.max_item_size)
+    if content is None:
+        return storage_result
+    storage_result.fileobj.close()
+    return cache.set(uri, content, mimetype or storage_result.mimetype, encoding)
+
+
+def _read_cacheable(fileobj, max_size):
+    """Read the content of a file if it is small enough to cache
+
+    Returns None, and rewinds the file, if the file is too large or cannot be rewound
+    """
+    seekable = getattr(fileobj, 'seekable', None)
+    if seekable is None or not seekable():
+        return None
+    content = fileobj.read(max_size + 1)
+    if len(content) <= max_size:
+        return content
+    fileobj.seek(0)
+    return None
+
+
+def resource_download(id, resource_id, filename=None):
+    """Download an uploaded resource file
+
+    This replaces CKAN's own resource download view. Private files are
+    redirected to a signed URL, while files served by CKAN (e.g. from local
+    storage) support `Range` requests.
+    """
+    context = {'user': toolkit.c.user}
+    try:
+        resource = toolkit.get_action('resource_show')(context, {'id': resource_id})
+        toolkit.get_action('package_show')(context, {'id': id})
+    except (toolkit.ObjectNotFound, toolkit.NotAuthorized):
+        return toolkit.abort(404, "Resource not found")
+
+    if resource.get('url_type') != 'upload':
+        if not resource.get('url'):
+            return toolkit.abort(404, "No download is available")
+        return redirect(resource['url'])
+
+    # Always use the stored file name, whatever file name was requested
+    filename = os.path.basename(resource['url'])
+    with tracing.span('resource_download', {'asset_storage.resource_id': resource_id}):
+        try:
+            storage_result = get_configured_storage().download(get_resource_uri(resource_id, filename))
+        except exc.ObjectNotFound:
+            return toolkit.abort(404, "Resource data not found")
+
+    if storage_result.fileobj:
+        return _send_ranged_file(storage_result.fileobj, resource.get('mimetype') or storage_result.mimetype)
+    return _make_response(storage_result, None, None)
+
+
+def _send_ranged_file(fileobj, mimetype):
+    """Stream a file, supporting conditional and `Range` requests
+
+    Validators are derived from the file's size and modification time, if
+    the file is on disk.
+    """
+    try:
+        stat = os.fstat(fileobj.fileno())
+    except (AttributeError, IOError, OSError):
+        stat = None
+    size = stat.st_size if stat else None
+    response = Response(wrap_file(request.environ, fileobj), mimetype=mimetype, direct_passthrough=True)
+    if stat:
+        response.content_length = stat.st_size
+        response.last_modified = int(stat.st_mtime)
+        response.set_etag('{:x}-{:x}'.format(int(stat.st_mtime), stat.st_size))
+    return response.make_conditional(request, accept_ranges=size is not None, complete_length=size)
 
-    raise ValueError("Unexpected response from storage backend: {}".
-                     format(storage_result))
+
+def upload_url():
+    """Get a target for uploading a new asset directly to storage
+
+    Expects `object_type`, `filename` and optionally `mimetype` as JSON or
+    form data. Responds with the upload URL, HTTP method and headers to
+    use, along with a token to submit in place of the uploaded file.
+
+    Only images may be uploaded directly, and their MIME type is taken from
+    the file name; A `mimetype` which does not match it is rejected.
+    """
+    if not is_direct_upload_enabled():
+        return toolkit.abort(404, "Direct uploads are not enabled")
+
+    data = request.get_json(silent=True) or request.form
+    object_type = data.get('object_type')
+    filename = data.get('filename')
+    if object_type not in DIRECT_UPLOAD_OBJECT_TYPES or not filename:
+        return toolkit.abort(400, "Expecting a valid object_type and a filename")
+
+    mimetype = mimetypes.guess_type(filename)[0]
+    if not mimetype or not mimetype.startswith('image/') or data.get('mimetype') not in (None, '', mimetype):
+        return toolkit.abort(400, "Only images with a MIME type matching their file name may be uploaded directly")
+
+    try:
+        toolkit.check_access('asset_storage_upload_url', {'user': toolkit.c.user}, {'object_type': object_type})
+    except toolkit.NotAuthorized:
+        return toolkit.abort(403, "Not authorized to upload assets")
+
+    storage = get_configured_storage()
+    name = create_storage_filename(filename)
+    max_size = toolkit.asint(toolkit.config.get('ckan.max_image_size', 2)) * MB
+    target = storage.get_upload_target(name,
+                                       prefix=object_type,
+                                       mimetype=mimetype,
+                                       max_size=max_size,
+                                       expires_in=DIRECT_UPLOAD_EXPIRES_IN)
+    if target is None:
+        return toolkit.abort(400, "The configured storage backend does not support direct uploads")
+
+    return jsonify({
+        'url': target.url,
+        'method': target.method,
+        'headers': target.headers,
+        'uri': get_download_url(storage, name, object_type),
+        'token': direct_upload.create_token(get_secret(), object_type, name, DIRECT_UPLOAD_EXPIRES_IN),
+        'expires_in': DIRECT_UPLOAD_EXPIRES_IN,
+    })
 
 
 blueprint.add_url_rule(u'/uploads/<path:file_uri>', view_func=uploaded_file)
+blueprint.add_url_rule(u'/asset-storage/upload-url', view_func=upload_url, methods=[u'POST'])
+
+
+def get_resource_download_blueprint():
+    """Get a blueprint serving resource downloads from storage
+
+    The rules match CKAN's own resource download URLs, and take over resource
+    downloads from CKAN's `dataset_resource.download` view: CKAN sorts the
+    rules of extension blueprints ahead of its own (see
+    `CKANFlask.register_extension_blueprint`), so they are matched first. A
+    new blueprint is created on each call, as rules cannot be added to a
+    blueprint once it is registered with an app.
+    """
+    resource_blueprint = Blueprint('asset_storage_resources', __name__)
+    resource_blueprint.add_url_rule(u'/dataset/<id>/resource/<resource_id>/download', view_func=resource_download)
+    resource_blueprint.add_url_rule(u'/dataset/<id>/resource/<resource_id>/download/<filename>',
+                                    view_func=resource_download)
+    return resource_blueprint
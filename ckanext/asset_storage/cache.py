@@ -0,0 +1,126 @@
+"""In-memory cache for small, frequently requested assets
+
+Some assets (e.g. the site logo) are requested on nearly every page view.
+Caching them in memory allows serving them without touching the storage
+backend. The cache is per process, bounded by the total size of cached
+assets, and evicts the least recently used assets first.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from ckanext.asset_storage import metrics
+from ckanext.asset_storage.storage.stats import monotonic
+
+
+class CachedAsset(object):
+    """A cached asset, along with precomputed response metadata
+    """
+    __slots__ = ('content', 'mimetype', 'content_encoding', 'etag', 'expires_at')
+
+    def __init__(self, content, mimetype=None, content_encoding=None, expires_at=None):
+        # type: (bytes, Optional[str], Optional[str], Optional[float]) -> CachedAsset
+        self.content = content
+        self.mimetype = mimetype
+        self.content_encoding = content_encoding
+        self.etag = hashlib.md5(content).hexdigest()
+        self.expires_at = expires_at
+
+    def __len__(self):
+        return len(self.content)
+
+
+class AssetCache(object):
+    """A thread safe, size bounded LRU cache of assets
+    """
+    def __init__(self, max_size, max_item_size=256 * 1024, ttl=300):
+        # type: (int, int, Optional[float]) -> AssetCache
+        """Create a new asset cache
+
+        Args:
+            max_size: Max total size in bytes of cached assets
+            max_item_size: Max size in bytes of a single asset to cache
+            ttl: Max number of seconds to keep an asset in cache. As the
+                cache is per process, this limits how long other processes
+                may serve a deleted asset. If `None`, assets do not expire.
+        """
+        self._max_size = max_size
+        self._max_item_size = min(max_item_size, max_size)
+        self._ttl = ttl
+        self._items = OrderedDict()  # type: OrderedDict[str, CachedAsset]
+        self._size = 0
+        self._lock = threading.Lock()
+
+    @property
+    def max_item_size(self):
+        # type: () -> int
+        return self._max_item_size
+
+    @property
+    def size(self):
+        # type: () -> int
+        """Total size in bytes of cached assets
+        """
+        return self._size
+
+    def __len__(self):
+        return len(self._items)
+
+    def get(self, key):
+        # type: (str) -> Optional[CachedAsset]
+        """Get a cached asset, or None if it is not in cache
+        """
+        with self._lock:
+            asset = self._items.pop(key, None)
+            if asset is not None and asset.expires_at is not None and asset.expires_at < monotonic():
+                self._size -= len(asset)
+                asset = None
+            if asset is not None:
+                # Re-insert to mark as most recently used
+                self._items[key] = asset
+
+        metrics.incr('cache.hits' if asset is not None else 'cache.misses')
+        return asset
+
+    def set(self, key, content, mimetype=None, content_encoding=None):
+        # type: (str, bytes, Optional[str], Optional[str]) -> Optional[CachedAsset]
+        """Cache an asset
+
+        Returns the cached asset, or None if it is too large to cache
+        """
+        if len(content) > self._max_item_size:
+            return None
+
+        expires_at = monotonic() + self._ttl if self._ttl is not None else None
+        asset = CachedAsset(content, mimetype, content_encoding, expires_at)
+        with self._lock:
+            self._remove(key)
+            self._items[key] = asset
+            self._size += len(asset)
+            while self._size > self._max_size:
+                _, evicted = self._items.popitem(last=False)
+                self._size -= len(evicted)
+            size = self._size
+
+        metrics.gauge('cache.size', size)
+        return asset
+
+    def invalidate(self, key):
+        # type: (str) -> None
+        """Remove an asset from the cache, if it is cached
+        """
+        with self._lock:
+            self._remove(key)
+
+    def clear(self):
+        # type: () -> None
+        with self._lock:
+            self._items.clear()
+            self._size = 0
+
+    def _remove(self, key):
+        # type: (str) -> None
+        asset = self._items.pop(key, None)
+        if asset is not None:
+            self._size -= len(asset)
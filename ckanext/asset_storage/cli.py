@@ -0,0 +1,274 @@
+"""ckanext-asset-storage CLI commands
+"""
+import json
+import logging
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import click
+from ckan.plugins import toolkit
+
+from ckanext.asset_storage import bench, loadtest, uploader
+from ckanext.asset_storage.storage.local import LAYOUTS, LocalStorage
+from ckanext.asset_storage.storage.sharded import ShardedStorage
+
+# Prefixes of asset files, for each type of object assets are uploaded for
+ASSET_PREFIXES = ('group', 'user', 'admin')
+
+_log = logging.getLogger(__name__)
+
+
+@click.group('asset-storage', short_help='Asset storage management commands')
+def asset_storage():
+    pass
+
+
+@asset_storage.command('migrate-layout')
+@click.option('--storage-path', help='Local storage directory to migrate. Defaults to the configured local storage.')
+@click.option('--layout', type=click.Choice(sorted(LAYOUTS)), help='Layout to migrate to, if --storage-path is set')
+@click.option('--shard-depth', type=int, default=2, help='Shard depth for the hashed layout, if --storage-path is set')
+@click.option('--prefix', 'prefixes', multiple=True, default=ASSET_PREFIXES, show_default=True,
+              help='Only move files with this prefix; May be repeated')
+@click.option('--dry-run', is_flag=True, help='Only list files to be moved')
+def migrate_layout(storage_path, layout, shard_depth, prefixes, dry_run):
+    """Move files in local storage to their location in the configured directory layout
+
+    Only asset files are moved by default, so that other files kept in the
+    same directory (e.g. CKAN's own resource files) are left in place.
+    """
+    if storage_path:
+        storage = LocalStorage(storage_path, layout=layout or 'flat', shard_depth=shard_depth)
+    else:
+        storage = uploader.get_configured_storage()
+        if not isinstance(storage, LocalStorage):
+            raise click.UsageError('The configured storage backend is not local storage; use --storage-path')
+
+    moved = 0
+    for old_path, new_path in storage.migrate_layout(prefixes, dry_run=dry_run):
+        click.echo('{} -> {}'.format(old_path, new_path))
+        moved += 1
+
+    click.echo('{} {} files'.format('Would move' if dry_run else 'Moved', moved))
+
+
+@asset_storage.command('backfill-cache-control')
+@click.option('--prefix', help='Only update files with this prefix (e.g. `group`)')
+@click.option('--workers', type=int, default=8, help='Number of files to update in parallel')
+@click.option('--dry-run', is_flag=True, help='Only list files to be updated')
+def backfill_cache_control(prefix, workers, dry_run):
+    """Set the configured Cache-Control metadata on existing files in storage
+    """
+    storage = uploader.get_configured_storage()
+    try:
+        uris = storage.iter_uris(prefix)
+        if dry_run:
+            count = 0
+            for uri in uris:
+                click.echo(uri)
+                count += 1
+            click.echo('Would update {} files'.format(count))
+            return
+
+        updated = failed = 0
+        for uri, result in _parallel_map(lambda u: _update_cache_control(storage, u), uris, workers):
+            if result:
+                updated += 1
+            else:
+                failed += 1
+                click.echo('Could not update {}'.format(uri), err=True)
+    except NotImplementedError as e:
+        raise click.UsageError(str(e))
+
+    click.echo('Updated {} files, could not update {} files'.format(updated, failed))
+
+
+@asset_storage.command('reshard')
+@click.option('--workers', type=int, default=8, help='Number of files to move in parallel')
+@click.option('--dry-run', is_flag=True, help='Only list files to be moved')
+def reshard(workers, dry_run):
+    """Move files in sharded storage to their shard, after changing the number of backends or key prefixes
+    """
+    storage = uploader.get_configured_storage()
+    if not isinstance(storage, ShardedStorage):
+        raise click.UsageError('The configured storage backend is not sharded storage')
+
+    try:
+        misplaced = storage.iter_misplaced()
+        if dry_run:
+            count = 0
+            for uri, source, target in misplaced:
+                click.echo('{}: {} -> {}'.format(uri, _format_location(source), _format_location(target)))
+                count += 1
+            click.echo('Would move {} files'.format(count))
+            return
+
+        moved = failed = 0
+        for (uri, source, target), result in _parallel_map(lambda m: _move(storage, *m), misplaced, workers):
+            if result:
+                click.echo('{}: {} -> {}'.format(uri, _format_location(source), _format_location(target)))
+                moved += 1
+            else:
+                failed += 1
+                click.echo('Could not move {}'.format(uri), err=True)
+    except NotImplementedError as e:
+        raise click.UsageError(str(e))
+
+    click.echo('Moved {} files, could not move {} files'.format(moved, failed))
+
+
+def _format_location(location):
+    index, key = location
+    return '{} in backend {}'.format(key, index)
+
+
+def _move(storage, uri, source, target):
+    try:
+        storage.move(source, target)
+    except Exception as e:
+        _log.warning('Failed to move %s: %s', uri, e)
+        return False
+    return True
+
+
+def _parallel_map(func, items, workers):
+    """Call `func` on each item in a pool of worker threads, yielding `(item, result)` tuples in order
+
+    Unlike `Executor.map()`, this does not consume all items upfront, so it can
+    be used with long, lazily listed sequences of files
+    """
+    pending = deque()
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for item in items:
+            pending.append((item, executor.submit(func, item)))
+            if len(pending) >= workers * 2:
+                item, future = pending.popleft()
+                yield item, future.result()
+        while pending:
+            item, future = pending.popleft()
+            yield item, future.result()
+
+
+def _update_cache_control(storage, uri):
+    try:
+        return storage.update_cache_control(uri)
+    except Exception as e:
+        _log.warning('Failed to update Cache-Control of %s: %s', uri, e)
+        return False
+
+
+@asset_storage.command('bench')
+@click.option('--sizes', default='1k,100k,1m',
+              help='Comma separated sizes of synthetic assets, in bytes, or with a `k` or `m` suffix')
+@click.option('--count', type=int, default=20, help='Number of assets of each size')
+@click.option('--concurrency', type=int, default=4, help='Number of concurrent operations')
+@click.option('--prefix', help='Scratch prefix to store assets under. Defaults to a random prefix.')
+@click.option('--json', 'as_json', is_flag=True, help='Output results as JSON')
+def bench_command(sizes, count, concurrency, prefix, as_json):
+    """Benchmark uploading, downloading and deleting assets in the configured storage backend
+    """
+    try:
+        sizes = [_parse_size(size) for size in sizes.split(',')]
+    except ValueError as e:
+        raise click.BadParameter(str(e), param_hint='--sizes')
+
+    storage = uploader.get_configured_storage()
+    benchmark = bench.Benchmark(storage, sizes, count, concurrency, prefix)
+    if not as_json:
+        click.echo('Benchmarking {} under {}'.format(storage, benchmark.prefix))
+    results = benchmark.run()
+
+    if as_json:
+        click.echo(json.dumps([result.as_dict() for result in results], indent=2))
+        return
+
+    for result in results:
+        click.echo('{:<8} {:>10} bytes: {} ok, {} errors, {:.1f} ops/s, {}'.format(
+            result.operation, result.size, len(result.latencies), result.errors, result.throughput,
+            result.format_percentiles()))
+
+
+def _parse_size(size):
+    # type: (str) -> int
+    size = size.strip().lower()
+    multiplier = {'k': 1024, 'm': 1024 * 1024}.get(size[-1:], 1)
+    if multiplier > 1:
+        size = size[:-1]
+    try:
+        return int(size) * multiplier
+    except ValueError:
+        raise ValueError('Invalid size: {}'.format(size))
+
+
+@asset_storage.command('loadtest')
+@click.option('--url', help='Base URL of a running CKAN instance to test, sharing the configured storage. By default, '
+                            'the asset storage blueprint is served by the Werkzeug development server.')
+@click.option('--storage-path', help='Use local storage in this directory instead of the configured storage. Only '
+                                     'applies when --url is not set.')
+@click.option('--assets', type=int, default=100, help='Number of test assets to seed')
+@click.option('--size', type=int, default=4096, help='Size in bytes of each test asset')
+@click.option('--concurrency', type=int, default=10, help='Number of concurrent clients')
+@click.option('--requests', type=int, default=1000, help='Total number of requests to send')
+@click.option('--duration', type=float, help='Send requests for this many seconds, instead of a number of requests')
+@click.option('--hot-fraction', type=float, default=0.1, help='Fraction of assets which are hot')
+@click.option('--hot-traffic', type=float, default=0.9, help='Fraction of requests sent for hot assets')
+@click.option('--seed', type=int, help='Random seed, for reproducible request sequences')
+@click.option('--keep-assets', is_flag=True, help='Do not delete seeded test assets when done')
+def loadtest_command(url, storage_path, assets, size, concurrency, requests, duration, hot_fraction, hot_traffic,
+                     seed, keep_assets):
+    """Load test the asset download endpoint, reporting throughput and latency percentiles
+    """
+    if storage_path:
+        if url:
+            raise click.UsageError('--storage-path cannot be used with --url')
+        toolkit.config[uploader.CONF_BACKEND_TYPE] = 'local'
+        toolkit.config[uploader.CONF_BACKEND_CONFIG] = {'storage_path': storage_path}
+    storage = uploader.get_configured_storage()
+
+    click.echo('Seeding {} assets of {} bytes in {}'.format(assets, size, storage))
+    uris = loadtest.seed_assets(storage, assets, size)
+    server = None
+    try:
+        if not url:
+            server = _start_server()
+            url = 'http://{}:{}'.format(*server.server_address[:2])
+            click.echo('Serving the asset storage blueprint with the Werkzeug development server, without the rest '
+                       'of the CKAN app; Use --url to test CKAN as deployed, e.g. under gunicorn or uwsgi')
+        click.echo('Sending {} to {} with {} concurrent clients'.format(
+            '{}s of requests'.format(duration) if duration else '{} requests'.format(requests), url, concurrency))
+        chooser = loadtest.KeyChooser(uris, hot_fraction=hot_fraction, hot_traffic=hot_traffic, seed=seed)
+        result = loadtest.run(loadtest.http_fetcher(url), chooser, concurrency, requests, duration)
+        click.echo(result.summary())
+    finally:
+        if server is not None:
+            server.shutdown()
+        if not keep_assets:
+            for uri in uris:
+                storage.delete(uri)
+
+
+def _start_server():
+    """Serve the asset storage blueprint by a threaded WSGI server on a free local port
+
+    This is Werkzeug's development server, serving a bare Flask app with only
+    the asset storage blueprint: Latency excludes CKAN's middleware and
+    request setup, and throughput is limited by the server, not by CKAN.
+    """
+    from flask import Flask
+    from werkzeug.serving import make_server
+
+    from ckanext.asset_storage.blueprints import blueprint
+
+    # Request logging would dominate the cost of serving small assets
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    app = Flask(__name__)
+    app.register_blueprint(blueprint)
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server
+
+
+def get_commands():
+    return [asset_storage]
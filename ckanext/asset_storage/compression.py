@@ -0,0 +1,139 @@
+"""Precompressed variants of compressible assets
+
+For compressible assets (e.g. SVG images), compressed variants of the asset
+are stored alongside the original asset, with the encoding name appended
+to the file name (e.g. `logo.svg.br` and `logo.svg.gz`). These can then be
+served to clients which accept the encoding.
+"""
+import gzip
+import threading
+from collections import OrderedDict
+from typing import List, Optional
+
+from six import BytesIO
+
+from ckanext.asset_storage.storage.stats import monotonic
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Variants are stored and preferred in this order
+ENCODINGS = ['br', 'gzip']
+
+COMPRESSIBLE_TYPES = {'image/svg+xml',
+                      'image/bmp',
+                      'image/x-icon',
+                      'image/vnd.microsoft.icon',
+                      'application/json',
+                      'application/xml',
+                      'application/javascript'}
+
+# Do not bother compressing files smaller than this
+MIN_SIZE = 256
+
+_SUFFIXES = {'br': '.br', 'gzip': '.gz'}
+
+
+class MissingVariants(object):
+    """A thread safe, bounded record of variants known not to exist in storage
+
+    Most assets have no precompressed variants, and looking them up on
+    every request costs a storage round trip per accepted encoding. Missing
+    variants are remembered for a while, so they are only looked up again
+    once their entry expires. As this is per process, variants uploaded
+    through another process are served once entries expire.
+    """
+    def __init__(self, max_items=10000, ttl=300):
+        # type: (int, float) -> MissingVariants
+        self._max_items = max_items
+        self._ttl = ttl
+        self._items = OrderedDict()  # type: OrderedDict[str, float]
+        self._lock = threading.Lock()
+
+    def __contains__(self, uri):
+        # type: (str) -> bool
+        with self._lock:
+            expires_at = self._items.get(uri)
+            if expires_at is None:
+                return False
+            if expires_at < monotonic():
+                del self._items[uri]
+                return False
+            return True
+
+    def add(self, uri):
+        # type: (str) -> None
+        with self._lock:
+            self._items.pop(uri, None)
+            self._items[uri] = monotonic() + self._ttl
+            while len(self._items) > self._max_items:
+                self._items.popitem(last=False)
+
+    def discard(self, uri):
+        # type: (str) -> None
+        with self._lock:
+            self._items.pop(uri, None)
+
+
+def is_compressible(mimetype):
+    # type: (Optional[str]) -> bool
+    """Tell if files of the given MIME type are worth compressing
+    """
+    if not mimetype:
+        return False
+    return mimetype in COMPRESSIBLE_TYPES or mimetype.startswith('text/')
+
+
+def available_encodings():
+    # type: () -> List[str]
+    """Get the list of encodings supported in this environment
+    """
+    return [e for e in ENCODINGS if e != 'br' or brotli is not None]
+
+
+def variant_name(name, encoding):
+    # type: (str, str) -> str
+    """Get the name (or URI) of a compressed variant of a file
+    """
+    return name + _SUFFIXES[encoding]
+
+
+def compress(content, encoding):
+    # type: (bytes, str) -> bytes
+    """Compress content using the given encoding
+    """
+    if encoding == 'br':
+        return brotli.compress(content, mode=brotli.MODE_TEXT)
+    elif encoding == 'gzip':
+        buffer = BytesIO()
+        with gzip.GzipFile(fileobj=buffer, mode='wb', compresslevel=9, mtime=0) as f:
+            f.write(content)
+        return buffer.getvalue()
+    raise ValueError('Unsupported encoding: {}'.format(encoding))
+
+
+def accepted_encodings(accept_encoding):
+    # type: (Optional[str]) -> List[str]
+    """Get the list of available encodings accepted according to an `Accept-Encoding` header value
+
+    Returned encodings are ordered by preference.
+    """
+    if not accept_encoding:
+        return []
+
+    accepted = {}
+    for item in accept_encoding.split(','):
+        parts = [p.strip() for p in item.split(';')]
+        quality = 1.0
+        for param in parts[1:]:
+            if param.startswith('q='):
+                try:
+                    quality = float(param[2:])
+                except ValueError:
+                    quality = 0.0
+        accepted[parts[0].lower()] = quality
+
+    wildcard = accepted.get('*', 0.0)
+    return [e for e in available_encodings() if accepted.get(e, wildcard) > 0]
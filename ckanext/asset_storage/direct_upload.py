@@ -0,0 +1,50 @@
+"""Support for direct-to-storage uploads
+
+Clients request an upload target (typically a signed URL) for a new asset,
+and upload the asset directly to storage. Along with the upload target,
+they get a token, which they then send to CKAN in place of the uploaded
+file, proving that the asset name was issued by CKAN.
+"""
+import hashlib
+import hmac
+import time
+from typing import Optional
+
+TOKEN_FIELD_SUFFIX = '_token'
+
+
+def create_token(secret, object_type, name, expires_in=3600, now=None):
+    # type: (str, str, str, int, Optional[float]) -> str
+    """Create a token for a direct upload of an asset
+    """
+    if now is None:
+        now = time.time()
+    expires_at = int(now + expires_in)
+    return '{}:{}:{}'.format(expires_at, _sign(secret, object_type, name, expires_at), name)
+
+
+def verify_token(secret, object_type, token, now=None):
+    # type: (str, str, str, Optional[float]) -> Optional[str]
+    """Verify a direct upload token for an asset of the given type
+
+    Returns the asset name if the token is valid and not expired, or None
+    """
+    if now is None:
+        now = time.time()
+    try:
+        expires_at, signature, name = token.split(':', 2)
+        expires_at = int(expires_at)
+    except (AttributeError, ValueError):
+        return None
+
+    if expires_at < now:
+        return None
+    if not hmac.compare_digest(signature, _sign(secret, object_type, name, expires_at)):
+        return None
+    return name
+
+
+def _sign(secret, object_type, name, expires_at):
+    # type: (str, str, str, int) -> str
+    message = u'{}\n{}\n{}'.format(object_type, name, expires_at).encode('utf-8')
+    return hmac.new(secret.encode('utf-8'), message, hashlib.sha256).hexdigest()
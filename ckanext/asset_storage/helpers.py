@@ -0,0 +1,81 @@
+"""Template helpers
+"""
+import json
+import logging
+from typing import Any, Dict, Optional
+
+from six.moves.urllib_parse import unquote, urlparse
+
+from ckanext.asset_storage import placeholders, uploader
+from ckanext.asset_storage.cache import AssetCache
+
+OBJECT_TYPES = {'group', 'user', 'admin'}
+
+# Placeholder metadata never changes, as uploaded file names are unique
+PLACEHOLDER_CACHE_SIZE = 1024 * 1024
+
+# Images without metadata (or which failed to load) are only looked up again after this many seconds
+PLACEHOLDER_MISS_TTL = 60
+
+_MISSING = b'null'
+
+_log = logging.getLogger(__name__)
+
+
+def image_placeholder(image_url):
+    # type: (Optional[str]) -> Optional[Dict[str, Any]]
+    """Get the placeholder metadata of an uploaded image, given its URL
+
+    Returns a dict with `width`, `height`, `color` and `placeholder` keys, or
+    None if placeholders are not enabled, or there is no metadata for the
+    image (e.g. it is an external URL, was uploaded before placeholders were
+    enabled, or is not an image).
+
+    Metadata is cached in memory, so this only accesses storage the first
+    time an image is rendered by each process. Images without metadata, and
+    failures to load it, are cached for `PLACEHOLDER_MISS_TTL` seconds.
+    """
+    if not uploader.is_placeholders_enabled():
+        return None
+    uri = _get_image_uri(image_url)
+    if uri is None:
+        return None
+
+    cache = uploader._get_instance(('placeholder_cache', PLACEHOLDER_CACHE_SIZE),
+                                   lambda: AssetCache(PLACEHOLDER_CACHE_SIZE, ttl=None))
+    misses = uploader._get_instance(('placeholder_misses', PLACEHOLDER_MISS_TTL),
+                                    lambda: AssetCache(PLACEHOLDER_CACHE_SIZE, ttl=PLACEHOLDER_MISS_TTL))
+    cached = cache.get(uri) or misses.get(uri)
+    if cached is not None:
+        return json.loads(cached.content.decode('utf-8'))
+
+    try:
+        metadata = placeholders.load_metadata(uploader.get_configured_storage(), uri)
+    except Exception as e:
+        _log.warning("Failed to load placeholder metadata of %s: %s", uri, e)
+        metadata = None
+
+    if metadata is None:
+        misses.set(uri, _MISSING, 'application/json')
+    else:
+        cache.set(uri, json.dumps(metadata).encode('utf-8'), 'application/json')
+    return metadata
+
+
+def _get_image_uri(image_url):
+    # type: (Optional[str]) -> Optional[str]
+    """Get the storage URI of an uploaded image from its URL
+
+    Uploaded images are stored as `<object type>/<file name>`, whether they
+    are served through CKAN or directly from cloud storage.
+    """
+    if not image_url:
+        return None
+    parts = unquote(urlparse(image_url).path).split('/')
+    if len(parts) < 2 or parts[-2] not in OBJECT_TYPES or not parts[-1]:
+        return None
+    return '/'.join(parts[-2:])
+
+
+def get_helpers():
+    return {'asset_storage_image_placeholder': image_placeholder}
@@ -0,0 +1,186 @@
+"""Load testing for the asset download endpoint
+
+This seeds a storage backend with test assets, and then drives concurrent
+HTTP traffic to `/uploads/<path>`, with a configurable skew between a small
+set of "hot" assets and the rest. It reports throughput and latency
+percentiles, which helps with sizing worker counts and with checking that
+caching actually changes latency under concurrency.
+"""
+import os
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Optional, Sequence
+
+from six import BytesIO
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import HTTPRedirectHandler, build_opener
+
+from ckanext.asset_storage.storage import StorageBackend
+from ckanext.asset_storage.storage.stats import LatencySummary, monotonic
+
+
+def seed_assets(storage, count, size=1024, prefix='loadtest'):
+    # type: (StorageBackend, int, int, str) -> List[str]
+    """Upload `count` test assets of `size` bytes to storage
+
+    Returns the URIs of seeded assets, relative to the `/uploads/` endpoint
+    """
+    uris = []
+    for i in range(count):
+        name = 'asset-{:06d}.bin'.format(i)
+        storage.upload(BytesIO(os.urandom(size)), name, prefix, mimetype='application/octet-stream')
+        uris.append('{}/{}'.format(prefix, name))
+    return uris
+
+
+class KeyChooser(object):
+    """Choose keys to request, with a skew towards a set of hot keys
+
+    `hot_fraction` of the keys are considered hot, and get `hot_traffic` of
+    all requests; The rest of the requests are spread evenly across the
+    remaining (cold) keys.
+    """
+    def __init__(self, keys, hot_fraction=0.1, hot_traffic=0.9, seed=None):
+        # type: (Sequence[str], float, float, Optional[int]) -> KeyChooser
+        if not keys:
+            raise ValueError('Expecting at least one key')
+        hot_count = max(1, int(len(keys) * hot_fraction))
+        self._hot = keys[:hot_count]
+        self._cold = keys[hot_count:] or self._hot
+        self._hot_traffic = hot_traffic
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def choose(self):
+        # type: () -> str
+        with self._lock:
+            keys = self._hot if self._random.random() < self._hot_traffic else self._cold
+            return self._random.choice(keys)
+
+
+class LoadTestResult(LatencySummary):
+    """Results of a load test run
+    """
+    def __init__(self, latencies, errors, elapsed, statuses):
+        # type: (List[float], int, float, Dict[int, int]) -> LoadTestResult
+        super(LoadTestResult, self).__init__(latencies)
+        self.errors = errors
+        self.elapsed = elapsed
+        self.statuses = statuses
+
+    @property
+    def requests(self):
+        # type: () -> int
+        return len(self.latencies) + self.errors
+
+    @property
+    def throughput(self):
+        # type: () -> float
+        """Requests per second
+        """
+        return self.requests / self.elapsed if self.elapsed else 0.0
+
+    def summary(self):
+        # type: () -> str
+        lines = ['Requests: {} ({} errors) in {:.2f}s, {:.1f} req/s'.format(
+                 self.requests, self.errors, self.elapsed, self.throughput),
+                 'Latency: {}'.format(self.format_percentiles())]
+        lines.append('Status codes: {}'.format(', '.join(
+            '{}: {}'.format(code, count) for code, count in sorted(self.statuses.items()))))
+        return '\n'.join(lines)
+
+
+def run(fetch, chooser, concurrency=10, requests=1000, duration=None):
+    # type: (Callable[[str], int], KeyChooser, int, int, Optional[float]) -> LoadTestResult
+    """Run a load test
+
+    `fetch` is called with a key for each request, and is expected to return
+    an HTTP status code, or raise an exception if the request has failed.
+    Stops after `requests` requests in total, or after `duration` seconds if
+    set.
+    """
+    latencies = []  # type: List[float]
+    statuses = {}  # type: Dict[int, int]
+    errors = [0]
+    lock = threading.Lock()
+    budget = _Budget(requests, duration)
+    start = monotonic()
+
+    def worker():
+        while budget.take():
+            key = chooser.choose()
+            request_start = monotonic()
+            try:
+                status = fetch(key)
+            except Exception:
+                status = None
+            latency = monotonic() - request_start
+            with lock:
+                if status is None:
+                    errors[0] += 1
+                else:
+                    latencies.append(latency)
+                    statuses[status] = statuses.get(status, 0) + 1
+
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+
+    return LoadTestResult(latencies, errors[0], monotonic() - start, statuses)
+
+
+class _Budget(object):
+    """Keep track of how many more requests load test workers should send
+    """
+    def __init__(self, requests, duration=None):
+        # type: (int, Optional[float]) -> _Budget
+        self._remaining = requests
+        self._deadline = monotonic() + duration if duration else None
+        self._lock = threading.Lock()
+
+    def take(self):
+        # type: () -> bool
+        """Tell if another request should be sent
+        """
+        if self._deadline is not None:
+            return monotonic() < self._deadline
+        with self._lock:
+            if self._remaining <= 0:
+                return False
+            self._remaining -= 1
+            return True
+
+
+class _NoRedirectHandler(HTTPRedirectHandler):
+    """Do not follow redirects to cloud storage; We only measure the asset endpoint
+    """
+    def redirect_request(self, req, fp, code, msg, headers, newurl):
+        return None
+
+
+def http_fetcher(base_url):
+    # type: (str) -> Callable[[str], int]
+    """Create a fetch function for `run()`, downloading assets over HTTP from
+    the `/uploads/` endpoint under `base_url`
+
+    Redirects are not followed, and any response with a status code below
+    400 is considered successful.
+    """
+    opener = build_opener(_NoRedirectHandler)
+    base_url = base_url.rstrip('/')
+
+    def fetch(key):
+        try:
+            response = opener.open('{}/uploads/{}'.format(base_url, key))
+        except HTTPError as e:
+            if e.code >= 400:
+                raise
+            return e.code
+        try:
+            response.read()
+        finally:
+            response.close()
+        return response.getcode()
+
+    return fetch
@@ -0,0 +1,57 @@
+"""Lightweight metrics reporting
+
+Metrics are sent to a statsd server if one is configured and the `statsd`
+Python package is installed. Otherwise, they are only logged at debug level.
+"""
+import logging
+from typing import Optional
+
+try:
+    import statsd
+except ImportError:
+    statsd = None
+
+_log = logging.getLogger(__name__)
+
+_client = None
+
+
+def configure(host=None, port=8125, prefix='ckan.asset_storage'):
+    # type: (Optional[str], int, str) -> None
+    """Configure metrics reporting
+    """
+    global _client
+    if not host:
+        _client = None
+    elif statsd is None:
+        _log.warning('A statsd host is configured, but the statsd package is not installed')
+        _client = None
+    else:
+        _client = statsd.StatsClient(host, int(port), prefix=prefix)
+
+
+def incr(name, count=1):
+    # type: (str, int) -> None
+    """Increment a counter
+    """
+    _log.debug('metric %s += %s', name, count)
+    if _client is not None:
+        _client.incr(name, count)
+
+
+def timing(name, seconds):
+    # type: (str, float) -> None
+    """Record a duration, in seconds
+    """
+    _log.debug('metric %s = %.3fs', name, seconds)
+    if _client is not None:
+        _client.timing(name, seconds * 1000)
+
+
+def gauge(name, value):
+    # type: (str, float) -> None
+    """Record the current value of a gauge
+    """
+    _log.debug('metric %s = %s', name, value)
+    if _client is not None:
+        _client.gauge(name, value)
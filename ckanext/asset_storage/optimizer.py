@@ -0,0 +1,241 @@
+"""Upload-time optimization of asset files
+
+An optimizer is a callable accepting the content of an uploaded file and its
+MIME type, and returning optimized content (or `None` if the file could not
+be optimized). Optimizers run in a bounded process pool, so that CPU-heavy
+work does not block request threads beyond a configured deadline.
+"""
+import logging
+import struct
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from importlib import import_module
+from typing import BinaryIO, Callable, Optional
+
+from six import BytesIO
+
+from ckanext.asset_storage import metrics
+from ckanext.asset_storage.storage.stats import monotonic
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:
+    Image = None
+
+NAMED_OPTIMIZERS = {'pillow': 'ckanext.asset_storage.optimizer:optimize_image'}
+
+_EXIF_ORIENTATION = 0x0112
+
+# Offset of the bit depth in the IHDR chunk, which is always first in PNG files
+_PNG_BIT_DEPTH_OFFSET = 24
+
+_JPEG_APP1 = 0xE1
+_JPEG_APP14 = 0xEE
+_JPEG_APP15 = 0xEF
+_JPEG_COM = 0xFE
+_JPEG_SOS = 0xDA
+_JPEG_EOI = 0xD9
+
+_log = logging.getLogger(__name__)
+
+
+def get_optimizer(optimizer_type, workers=2, timeout=5.0, max_input_size=None):
+    # type: (str, int, float, Optional[int]) -> AssetOptimizer
+    """Get an asset optimizer, given a named optimizer or a `package.module:callable` name
+    """
+    optimizer_type = NAMED_OPTIMIZERS.get(optimizer_type, optimizer_type)
+    try:
+        module_name, func_name = optimizer_type.split(':')
+    except ValueError:
+        raise ValueError('Invalid optimizer type `{}`; expecting either a named optimizer, or a callable '
+                         'designated in the format `package.module:callable`'.format(optimizer_type))
+
+    try:
+        optimize = getattr(import_module(module_name), func_name)
+    except (ImportError, AttributeError) as e:
+        raise ValueError('Invalid optimizer type `{}`: unable to import; Error was: {}'.format(optimizer_type, e))
+
+    return AssetOptimizer(optimize, workers=workers, timeout=timeout, max_input_size=max_input_size)
+
+
+class AssetOptimizer(object):
+    """Run an optimizer callable on uploaded files
+    """
+    def __init__(self, optimize, workers=2, timeout=5.0, max_input_size=None):
+        # type: (Callable[[bytes, str], Optional[bytes]], int, float, Optional[int]) -> AssetOptimizer
+        """Create a new asset optimizer
+
+        Args:
+            optimize: The optimizer callable. It may have a `mimetypes` attribute, listing the MIME types it
+                supports. If `workers` is not 0, it must be picklable (e.g. a module level function).
+            workers: Number of worker processes to run the optimizer in. If 0, the optimizer will run in the
+                calling thread, without enforcing `timeout`.
+            timeout: Max number of seconds to wait for optimization; If optimization takes longer, the original
+                file is used
+            max_input_size: Max size in bytes of files to optimize; Larger files are not optimized
+        """
+        self._optimize = optimize
+        self._mimetypes = getattr(optimize, 'mimetypes', None)
+        self._workers = workers
+        self._timeout = timeout
+        self._max_input_size = max_input_size
+        self._pool = None  # type: Optional[ProcessPoolExecutor]
+        self._lock = threading.Lock()
+
+    def process(self, stream, mimetype):
+        # type: (BinaryIO, Optional[str]) -> BinaryIO
+        """Optimize an uploaded file
+
+        Returns a stream of the optimized file, or the original stream rewound
+        to its original position if the file could not be made smaller.
+        """
+        if self._mimetypes is not None and mimetype not in self._mimetypes:
+            return stream
+
+        try:
+            start_pos = stream.tell()
+        except (AttributeError, IOError):
+            _log.debug("Uploaded file stream is not seekable, not optimizing")
+            return stream
+
+        content = stream.read()
+        stream.seek(start_pos)
+        if self._max_input_size and len(content) > self._max_input_size:
+            return stream
+
+        start = monotonic()
+        optimized = self._run(content, mimetype)
+        metrics.timing('optimizer.duration', monotonic() - start)
+        if optimized is None or len(optimized) >= len(content):
+            return stream
+
+        saved = len(content) - len(optimized)
+        _log.info("Optimized uploaded %s file from %d to %d bytes (saved %.1f%%)",
+                  mimetype, len(content), len(optimized), 100.0 * saved / len(content))
+        metrics.incr('optimizer.optimized')
+        metrics.incr('optimizer.bytes_saved', saved)
+        return BytesIO(optimized)
+
+    def _run(self, content, mimetype):
+        # type: (bytes, Optional[str]) -> Optional[bytes]
+        """Run the optimizer, returning None if it has failed or timed out
+        """
+        try:
+            if not self._workers:
+                return self._optimize(content, mimetype)
+
+            future = self._get_pool().submit(self._optimize, content, mimetype)
+            try:
+                return future.result(timeout=self._timeout)
+            except FutureTimeoutError:
+                if not future.cancel():
+                    self._reset_pool()
+                _log.warning("Optimizing uploaded file took longer than %s seconds, skipping", self._timeout)
+                metrics.incr('optimizer.timeouts')
+        except Exception as e:
+            _log.warning("Failed to optimize uploaded file: %s", e)
+            metrics.incr('optimizer.errors')
+        return None
+
+    def _get_pool(self):
+        # type: () -> ProcessPoolExecutor
+        with self._lock:
+            if self._pool is None:
+                self._pool = ProcessPoolExecutor(max_workers=self._workers)
+            return self._pool
+
+    def _reset_pool(self):
+        # type: () -> None
+        """Kill the worker processes, and have the next optimization start a new pool
+
+        Cancelling a running future does not stop its worker process, which
+        would keep using CPU time after the deadline and hold a worker slot.
+        Other optimizations running in the same pool fail, and their original
+        file is used.
+        """
+        with self._lock:
+            pool, self._pool = self._pool, None
+        if pool is None:
+            return
+
+        # The `futures` backport for Python 2 keeps worker processes in a set, Python 3 in a dict by PID
+        processes = getattr(pool, '_processes', None) or {}
+        for process in list(processes.values() if isinstance(processes, dict) else processes):
+            process.terminate()
+        pool.shutdown(wait=False)
+        metrics.incr('optimizer.pool_resets')
+
+
+def optimize_image(content, mimetype):
+    # type: (bytes, Optional[str]) -> Optional[bytes]
+    """Optimize PNG and JPEG images losslessly using Pillow
+
+    This strips metadata (EXIF, color profiles, text chunks) from PNG images
+    after applying their EXIF orientation, and recompresses them. PNG images
+    with 16 bit samples are left as they are, as Pillow would reduce them to
+    8 bits. JPEG images are not decoded: metadata segments are removed from
+    the file, keeping the EXIF data of images which need to be rotated, so
+    the compressed image data is unchanged.
+    """
+    if Image is None:
+        raise RuntimeError('The Pillow package is required for optimizing images')
+
+    original = Image.open(BytesIO(content))
+    image_format = original.format
+    if image_format not in {'PNG', 'JPEG'} or getattr(original, 'is_animated', False):
+        return None
+
+    orientation = original.getexif().get(_EXIF_ORIENTATION, 1)
+    if image_format == 'JPEG':
+        return _strip_jpeg_metadata(content, keep_exif=orientation != 1)
+
+    if bytearray(content[_PNG_BIT_DEPTH_OFFSET:_PNG_BIT_DEPTH_OFFSET + 1]) == bytearray([16]):
+        return None
+    image = ImageOps.exif_transpose(original) if orientation != 1 else original
+    for key in ('exif', 'icc_profile'):
+        image.info.pop(key, None)
+
+    output = BytesIO()
+    image.save(output, 'PNG', optimize=True)
+    if Image.open(BytesIO(output.getvalue())).mode != original.mode:
+        return None
+    return output.getvalue()
+
+
+def _strip_jpeg_metadata(content, keep_exif=False):
+    # type: (bytes, bool) -> Optional[bytes]
+    """Remove comments and application segments from a JPEG file, without decoding it
+
+    The JFIF (APP0) and Adobe (APP14) segments are kept, as they affect how
+    the image is decoded. Returns None if the file cannot be parsed.
+    """
+    data = bytearray(content)
+    if data[:2] != bytearray(b'\xff\xd8'):
+        return None
+
+    output = [content[:2]]
+    pos = 2
+    while pos + 4 <= len(data):
+        if data[pos] != 0xFF:
+            return None
+        marker = data[pos + 1]
+        if marker == 0xFF:
+            # Fill byte
+            pos += 1
+            continue
+        if marker in {_JPEG_SOS, _JPEG_EOI}:
+            output.append(content[pos:])
+            return b''.join(output)
+
+        end = pos + 2 + struct.unpack('>H', content[pos + 2:pos + 4])[0]
+        segment = content[pos:end]
+        is_exif = marker == _JPEG_APP1 and segment[4:10] == b'Exif\x00\x00'
+        if not (marker == _JPEG_COM or _JPEG_APP1 <= marker <= _JPEG_APP15 and marker != _JPEG_APP14) \
+                or keep_exif and is_exif:
+            output.append(segment)
+        pos = end
+    return None
+
+
+optimize_image.mimetypes = {'image/png', 'image/jpeg'}
@@ -0,0 +1,184 @@
+"""Low-quality image placeholders
+
+When an image is uploaded, a tiny blurred thumbnail of it (encoded as a data
+URI), its dominant colour and its dimensions can be computed and stored next
+to it, as a small JSON metadata object. Templates can then render a sized box
+with an inline placeholder immediately, while the real image is loading.
+"""
+import base64
+import itertools
+import json
+import logging
+from typing import Any, BinaryIO, Dict, Optional
+
+from six import BytesIO
+from six.moves.urllib.error import HTTPError
+from six.moves.urllib.request import urlopen
+
+from ckanext.asset_storage.storage import StorageBackend, exc
+
+try:
+    from PIL import Image, ImageFilter, ImageOps
+except ImportError:
+    Image = None
+
+METADATA_SUFFIX = '.meta.json'
+
+MIMETYPES = {'image/png', 'image/jpeg', 'image/gif', 'image/webp'}
+
+PLACEHOLDER_SIZE = 20
+
+FETCH_TIMEOUT = 5
+
+_EXIF_ORIENTATION = 0x0112
+
+_ROTATED_ORIENTATIONS = {5, 6, 7, 8}
+
+_log = logging.getLogger(__name__)
+
+
+def metadata_name(name):
+    # type: (str) -> str
+    """Get the name (or URI) of the metadata object of an image
+    """
+    return name + METADATA_SUFFIX
+
+
+def compute(content, size=PLACEHOLDER_SIZE):
+    # type: (bytes, int) -> Dict[str, Any]
+    """Compute the placeholder metadata of an image
+
+    Returns a dict with the `width` and `height` of the image as displayed
+    (i.e. after applying its EXIF orientation), its dominant `color` as a
+    `#rrggbb` string (or None if the image is fully transparent), and a
+    `placeholder` data URI of a blurred thumbnail no larger than `size`
+    pixels on each side.
+
+    Images with more pixels than Pillow's `Image.MAX_IMAGE_PIXELS` are
+    rejected with a `ValueError`, before they are decoded.
+    """
+    if Image is None:
+        raise RuntimeError('The Pillow package is required for computing image placeholders')
+
+    image = Image.open(BytesIO(content))
+    width, height = image.size
+    # Pillow only refuses to open images over twice this limit, and merely warns below that
+    if Image.MAX_IMAGE_PIXELS and width * height > Image.MAX_IMAGE_PIXELS:
+        raise ValueError('Image is too large: {}x{} pixels'.format(width, height))
+    orientation = image.getexif().get(_EXIF_ORIENTATION, 1)
+    if orientation in _ROTATED_ORIENTATIONS:
+        width, height = height, width
+
+    # Let JPEG decoders downscale while decoding, which is much cheaper than a full decode. Other images are
+    # downscaled before being transposed or converted, so no full size copy of the image is made.
+    image.draft('RGB', (size * 2, size * 2))
+    image.thumbnail((size, size))
+    if orientation != 1:
+        image = ImageOps.exif_transpose(image)
+    thumbnail = image.convert('RGBA')
+
+    return {'width': width,
+            'height': height,
+            'color': _dominant_color(thumbnail),
+            'placeholder': _encode_data_uri(thumbnail.filter(ImageFilter.GaussianBlur(1)))}
+
+
+def _dominant_color(image):
+    # type: (Image.Image) -> Optional[str]
+    """Find the dominant colour of a (small) RGBA image, ignoring transparent pixels
+
+    Pixels are grouped by similar colour, and the average colour of the
+    largest group is returned.
+    """
+    groups = {}
+    pixels = image.load()
+    for x, y in itertools.product(range(image.width), range(image.height)):
+        r, g, b, a = pixels[x, y]
+        if a < 128:
+            continue
+        group = groups.setdefault((r >> 5, g >> 5, b >> 5), [0, 0, 0, 0])
+        group[0] += r
+        group[1] += g
+        group[2] += b
+        group[3] += 1
+
+    if not groups:
+        return None
+    r, g, b, count = max(groups.values(), key=lambda group: group[3])
+    return '#{:02x}{:02x}{:02x}'.format(r // count, g // count, b // count)
+
+
+def _encode_data_uri(image):
+    # type: (Image.Image) -> str
+    """Encode a thumbnail as a data URI; Opaque images are encoded as JPEG, which is smaller
+    """
+    output = BytesIO()
+    if image.getextrema()[3][0] == 255:
+        image.convert('RGB').save(output, 'JPEG', quality=70)
+        mimetype = 'image/jpeg'
+    else:
+        image.save(output, 'PNG', optimize=True)
+        mimetype = 'image/png'
+    return 'data:{};base64,{}'.format(mimetype, base64.b64encode(output.getvalue()).decode('ascii'))
+
+
+def upload_metadata(storage, stream, name, prefix):
+    # type: (StorageBackend, BinaryIO, str, Optional[str]) -> Optional[Dict[str, Any]]
+    """Compute placeholder metadata of an uploaded image, and upload it next to the image
+
+    Returns the metadata, or None if it could not be computed
+    """
+    try:
+        stream.seek(0)
+        metadata = compute(stream.read())
+    except Exception as e:
+        _log.warning("Failed to compute placeholder for %s: %s", name, e)
+        return None
+
+    storage.upload(BytesIO(json.dumps(metadata).encode('utf-8')),
+                   metadata_name(name),
+                   prefix,
+                   mimetype='application/json')
+    return metadata
+
+
+def load_metadata(storage, uri):
+    # type: (StorageBackend, str) -> Optional[Dict[str, Any]]
+    """Load the placeholder metadata of an image in storage
+
+    Returns None if the image has no metadata. Other errors are raised.
+    """
+    try:
+        target = storage.download(metadata_name(uri))
+    except exc.ObjectNotFound:
+        return None
+
+    if target.fileobj is not None:
+        try:
+            content = target.fileobj.read()
+        finally:
+            target.fileobj.close()
+    else:
+        # Cloud storage backends provide a (signed) URL to download from
+        content = _fetch(target.redirect_to)
+        if content is None:
+            return None
+
+    return json.loads(content.decode('utf-8'))
+
+
+def _fetch(url):
+    # type: (str) -> Optional[bytes]
+    """Fetch content from a URL, returning None if it was not found
+    """
+    try:
+        response = urlopen(url, timeout=FETCH_TIMEOUT)
+    except HTTPError as e:
+        # Public buckets may respond with 403 to requests for missing objects
+        if e.code in {403, 404}:
+            return None
+        raise
+    try:
+        return response.read()
+    finally:
+        response.close()
@@ -4,14 +4,24 @@ import ckan.plugins as plugins
 import ckan.plugins.toolkit as toolkit
 import six
 
-from ckanext.asset_storage import uploader
-from ckanext.asset_storage.blueprints import blueprint
+from ckanext.asset_storage import actions, auth, helpers, metrics, tracing, uploader
+from ckanext.asset_storage.blueprints import blueprint, get_resource_download_blueprint
+
+CONF_STATSD_HOST = 'ckanext.asset_storage.statsd_host'
+CONF_STATSD_PORT = 'ckanext.asset_storage.statsd_port'
+CONF_STATSD_PREFIX = 'ckanext.asset_storage.statsd_prefix'
+CONF_TRACING = 'ckanext.asset_storage.tracing'
 
 
 class AssetStoragePlugin(plugins.SingletonPlugin):
     plugins.implements(plugins.IConfigurer)
     plugins.implements(plugins.IUploader)
     plugins.implements(plugins.IBlueprint)
+    plugins.implements(plugins.IAuthFunctions)
+    plugins.implements(plugins.IActions)
+    plugins.implements(plugins.ITemplateHelpers)
+    if toolkit.check_ckan_version(min_version='2.9'):
+        plugins.implements(plugins.IClick)
 
     # IConfigurer
 
@@ -28,11 +38,39 @@ class AssetStoragePlugin(plugins.SingletonPlugin):
 
         config[uploader.CONF_BACKEND_CONFIG] = backend_config
 
+        metrics.configure(host=config.get(CONF_STATSD_HOST),
+                          port=config.get(CONF_STATSD_PORT, 8125),
+                          prefix=config.get(CONF_STATSD_PREFIX, 'ckan.asset_storage'))
+        tracing.configure(enabled=toolkit.asbool(config.get(CONF_TRACING, False)))
+
     # IBlueprint
 
     def get_blueprint(self):
+        if uploader.is_resource_uploads_enabled():
+            return [blueprint, get_resource_download_blueprint()]
         return blueprint
 
+    # IAuthFunctions
+
+    def get_auth_functions(self):
+        return auth.get_auth_functions()
+
+    # IActions
+
+    def get_actions(self):
+        return actions.get_actions()
+
+    # ITemplateHelpers
+
+    def get_helpers(self):
+        return helpers.get_helpers()
+
+    # IClick
+
+    def get_commands(self):
+        from ckanext.asset_storage import cli
+        return cli.get_commands()
+
     # IUploader
 
     def get_uploader(self, upload_to, old_filename):
@@ -41,6 +79,10 @@ class AssetStoragePlugin(plugins.SingletonPlugin):
                                       storage=uploader.get_configured_storage())
 
     def get_resource_uploader(self, data_dict):
-        """We do not handle resource uploading in this extension
+        """Get a resource uploader, if resource uploads are enabled
+
+        Otherwise, CKAN's own resource uploader is used
         """
-        return None
+        if not uploader.is_resource_uploads_enabled():
+            return None
+        return uploader.ResourceUploader(storage=uploader.get_configured_storage(), resource=data_dict)
@@ -1,10 +1,29 @@
 import mimetypes
 from importlib import import_module
-from typing import Any, BinaryIO, Dict, Optional
+from typing import Any, BinaryIO, Dict, Iterable, List, Optional
+
+from ckanext.asset_storage.storage import exc
 
 NAMED_BACKENDS = {'local': 'ckanext.asset_storage.storage.local:LocalStorage',
                   'google_cloud': 'ckanext.asset_storage.storage.google_cloud:GoogleCloudStorage',
-                  'azure_blobs': 'ckanext.asset_storage.storage.azure_blobs:AzureBlobStorage', }
+                  'azure_blobs': 'ckanext.asset_storage.storage.azure_blobs:AzureBlobStorage',
+                  'fallback': 'ckanext.asset_storage.storage.fallback:FallbackStorage',
+                  'replicated': 'ckanext.asset_storage.storage.replicated:ReplicatedStorage',
+                  'resilient': 'ckanext.asset_storage.storage.resilient:ResilientStorage',
+                  'sharded': 'ckanext.asset_storage.storage.sharded:ShardedStorage',
+                  'write_behind': 'ckanext.asset_storage.storage.write_behind:WriteBehindStorage', }
+
+# Stored asset names are unique, so their content never changes
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Assets which are not publicly readable must not be kept by shared caches
+PRIVATE_IMMUTABLE_CACHE_CONTROL = 'private, max-age=31536000, immutable'
+
+# Use the immutable `Cache-Control` value matching whether storage is publicly readable
+AUTO_CACHE_CONTROL = 'auto'
+
+# Brotli compressed files are not recognized by older versions of Python
+mimetypes.encodings_map.setdefault('.br', 'br')
 
 
 def get_storage(backend_type, backend_config):
@@ -29,6 +48,52 @@ def get_storage(backend_type, backend_config):
         raise TypeError('Are you storage missing backend configuration options? (was: {})'.format(e))
 
 
+def resolve_cache_control(cache_control, public_read):
+    # type: (Optional[str], bool) -> Optional[str]
+    """Get the `Cache-Control` value to set on stored files, resolving `AUTO_CACHE_CONTROL`
+    """
+    if cache_control == AUTO_CACHE_CONTROL:
+        return IMMUTABLE_CACHE_CONTROL if public_read else PRIVATE_IMMUTABLE_CACHE_CONTROL
+    return cache_control
+
+
+def get_storages(backend_configs):
+    # type: (List[Dict[str, Any]]) -> List[StorageBackend]
+    """Instantiate a list of storage backends
+
+    This is useful for storage backends that are composed of other storage
+    backends. Each item in `backend_configs` is expected to be a dict with a
+    `type` key (same as `backend_type`) and an optional `options` key (same as
+    `backend_options`).
+    """
+    backends = []
+    for backend_config in backend_configs:
+        try:
+            backend_type = backend_config['type']
+        except (KeyError, TypeError):
+            raise ValueError('Invalid backend configuration `{}`; expecting a dict with a `type` key'.format(
+                backend_config))
+        backends.append(get_storage(backend_type, backend_config.get('options', {})))
+    return backends
+
+
+def iter_unique_uris(backends, prefix=None):
+    # type: (List[StorageBackend], Optional[str]) -> Iterable[str]
+    """List the URIs of files in multiple storage backends, without duplicates
+
+    Backends which do not support listing files are skipped.
+    """
+    seen = set()
+    for backend in backends:
+        try:
+            for uri in backend.iter_uris(prefix):
+                if uri not in seen:
+                    seen.add(uri)
+                    yield uri
+        except NotImplementedError:
+            continue
+
+
 class DownloadTarget(object):
     """A response for a download request
 
@@ -36,16 +101,20 @@ class DownloadTarget(object):
     one of the two factory methods to represent either a redirection response
     or a direct download response.
     """
-    def __init__(self, fileobj=None, filename=None, mimetype=None, redirect_to=None, redirect_code=302):
-        # type: (Optional[BinaryIO], Optional[str], Optional[str], Optional[str], Optional[int]) -> DownloadTarget
+    def __init__(self, fileobj=None, filename=None, mimetype=None, redirect_to=None, redirect_code=302,
+                 content_encoding=None):
+        # type: (Optional[BinaryIO], Optional[str], Optional[str], Optional[str], Optional[int], Optional[str]) -> DownloadTarget  # noqa: E501
         if mimetype is None and filename:
-            mimetype = mimetypes.guess_type(filename)[0]
+            mimetype, guessed_encoding = mimetypes.guess_type(filename)
             if mimetype is None:
                 mimetype = 'application/octet-stream'
+            if content_encoding is None:
+                content_encoding = guessed_encoding
 
         self.fileobj = fileobj
         self.filename = filename
         self.mimetype = mimetype
+        self.content_encoding = content_encoding
         self.redirect_to = redirect_to
         self.redirect_code = redirect_code
 
@@ -64,6 +133,20 @@ class DownloadTarget(object):
         return cls(redirect_to=redirect_to, redirect_code=redirect_code)
 
 
+class UploadTarget(object):
+    """Instructions for a client to upload a file directly to storage
+
+    Typically, this is returned by `StorageBackend.get_upload_target()`. The
+    client is expected to send the file content in the body of an HTTP
+    request to `url`, using `method` and including all of `headers`.
+    """
+    def __init__(self, url, method='PUT', headers=None):
+        # type: (str, str, Optional[Dict[str, str]]) -> UploadTarget
+        self.url = url
+        self.method = method
+        self.headers = headers or {}
+
+
 class StorageBackend(object):
     """Interface for all storage backends
     """
@@ -80,12 +163,13 @@ class StorageBackend(object):
         """
         raise NotImplementedError("Inheriting classes must implement this")
 
-    def upload(self, stream, name, prefix=None, mimetype=None):
-        # type: (BinaryIO, str, Optional[str], Optional[str]) -> int
+    def upload(self, stream, name, prefix=None, mimetype=None, content_encoding=None):
+        # type: (BinaryIO, str, Optional[str], Optional[str], Optional[str]) -> int
         """Upload a file and return the number of bytes saved
 
-        Some storage backends may store metadata such as the file's MIME type,
-        but this is not supported by all storage backends.
+        Some storage backends may store metadata such as the file's MIME type
+        and content encoding (e.g. `gzip` for precompressed files), but this
+        is not supported by all storage backends.
         """
         raise NotImplementedError("Inheriting classes must implement this")
 
@@ -107,3 +191,47 @@ class StorageBackend(object):
         This may not be supported by all storage backends.
         """
         return False
+
+    def exists(self, uri):
+        # type: (str) -> bool
+        """Tell if a file exists in storage, given the file's URI
+
+        Storage backends should override this if they can check this more
+        efficiently than by downloading the file.
+        """
+        try:
+            target = self.download(uri)
+        except exc.ObjectNotFound:
+            return False
+        if target.fileobj:
+            target.fileobj.close()
+        return True
+
+    def get_upload_target(self, name, prefix=None, mimetype=None, max_size=None, expires_in=3600):
+        # type: (str, Optional[str], Optional[str], Optional[int], int) -> Optional[UploadTarget]
+        """Get instructions for a client to upload a file directly to storage
+
+        This allows clients to upload files without sending them through
+        CKAN, typically using a signed URL. `max_size` is the max file size
+        in bytes to allow, but may not be enforced by all storage backends.
+
+        Returns None if direct uploads are not supported by the backend.
+        """
+        return None
+
+    def iter_uris(self, prefix=None):
+        # type: (Optional[str]) -> Iterable[str]
+        """List the URIs of all files in storage, optionally only those with the given prefix
+
+        This may not be supported by all storage backends.
+        """
+        raise NotImplementedError("This storage backend does not support listing files")
+
+    def update_cache_control(self, uri):
+        # type: (str) -> bool
+        """Set the configured `Cache-Control` metadata on an existing file
+
+        Returns a bool indicating whether the file's metadata was updated.
+        This is only supported by storage backends which store HTTP metadata.
+        """
+        return False
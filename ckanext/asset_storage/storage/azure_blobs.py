@@ -1,26 +1,37 @@
+import threading
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Dict, Optional, Tuple
 
+import requests
 from azure.core.exceptions import ResourceNotFoundError
+from azure.core.pipeline.transport import RequestsTransport
 from azure.storage.blob import ContentSettings  # type: ignore
 from azure.storage.blob import BlobClient, BlobSasPermissions, BlobServiceClient, generate_blob_sas
 from memoized_property import memoized_property
+from requests.adapters import HTTPAdapter
 
-from ckanext.asset_storage.storage import DownloadTarget, StorageBackend, exc
+from ckanext.asset_storage import tracing
+from ckanext.asset_storage.storage import (AUTO_CACHE_CONTROL, DownloadTarget, StorageBackend, UploadTarget, exc,
+                                           resolve_cache_control)
 
 try:
     from dateutil.tz import UTC
 except ImportError:
     from pytz import UTC
 
+_transports = {}  # type: Dict[Tuple[int, float, float], RequestsTransport]
+_transports_lock = threading.Lock()
+
 
 class AzureBlobStorage(StorageBackend):
     """A storage backend for storing assets in Azure Blob Storage
 
     See https://azure.microsoft.com/en-us/services/storage/blobs/
     """
-    def __init__(self, container_name, connection_string, path_prefix=None, signed_url_lifetime=3600):
-        # type: (str, str, Optional[str], Optional[int]) -> AzureBlobStorage
+    def __init__(self, container_name, connection_string, path_prefix=None, signed_url_lifetime=3600,
+                 cache_control=AUTO_CACHE_CONTROL, pool_size=10, connection_timeout=10, read_timeout=60,
+                 upload_concurrency=4):
+        # type: (str, str, Optional[str], Optional[int], Optional[str], int, float, float, int) -> AzureBlobStorage
         """Constructor for Azure Blob Storage storage backend
 
         The Azure Blob Storage storage backend's behaviour regarding public URLs depend
@@ -37,12 +48,21 @@ class AzureBlobStorage(StorageBackend):
             connection_string: The Azure Blob Storage connection string to use
             path_prefix: A prefix to prepend to all stored assets in the container
             signed_url_lifetime: When public access is disabled, this sets the max lifetime in seconds of signed URLs
+            cache_control: `Cache-Control` header to set on uploaded blobs, or `None` to not set it. If `auto`,
+                blobs are cached as immutable, by shared caches only if the container allows public access.
+            pool_size: Max number of HTTP connections to keep open to Azure Blob Storage
+            connection_timeout: Number of seconds to wait for connecting to Azure Blob Storage
+            read_timeout: Number of seconds to wait for data to be received from Azure Blob Storage
+            upload_concurrency: Max number of blocks of a large file to upload in parallel
         """
         # self._container_name = container_name
         self._path_prefix = path_prefix
         self._signed_url_lifetime = signed_url_lifetime
+        self._cache_control_option = cache_control
+        self._upload_concurrency = upload_concurrency
 
-        self._svc_client = BlobServiceClient.from_connection_string(connection_string)
+        transport = _get_transport(pool_size, connection_timeout, read_timeout)
+        self._svc_client = BlobServiceClient.from_connection_string(connection_string, transport=transport)
         self._container_client = self._svc_client.get_container_client(container_name)
 
     def get_storage_uri(self, name, prefix=None):
@@ -56,24 +76,32 @@ class AzureBlobStorage(StorageBackend):
         else:
             return name
 
-    def upload(self, stream, name, prefix=None, mimetype=None):
-        """Save the file in storage
+    def upload(self, stream, name, prefix=None, mimetype=None, content_encoding=None):
+        """Save the file in storage, replacing any existing file with the same name
+
+        Large files are uploaded as blocks, `upload_concurrency` of which are
+        uploaded in parallel.
         """
         blob = self._blob_client(name, prefix)
-        blob.upload_blob(stream)
-        if mimetype:
-            blob.set_http_headers(ContentSettings(content_type=mimetype))
+        blob.upload_blob(stream,
+                         overwrite=True,
+                         max_concurrency=self._upload_concurrency,
+                         content_settings=ContentSettings(content_type=mimetype,
+                                                          content_encoding=content_encoding,
+                                                          cache_control=self._cache_control))
         return stream.tell()
 
     def download(self, uri):
         """Provide the direct URL to download the file from storage
         """
         blob = self._blob_client(uri)
-        if not self._blob_exists(blob):
-            raise exc.ObjectNotFound('The requested file was not found')
+        with tracing.span('azure_exists'):
+            if not self._blob_exists(blob):
+                raise exc.ObjectNotFound('The requested file was not found')
 
         # If we got here, we assume blob is private and return a signed URL
-        signed_url = self._get_signed_url(blob, self._signed_url_lifetime)
+        with tracing.span('azure_sign'):
+            signed_url = self._get_signed_url(blob, self._signed_url_lifetime)
         return DownloadTarget.redirect(signed_url)
 
     def delete(self, uri):
@@ -84,6 +112,44 @@ class AzureBlobStorage(StorageBackend):
             return False
         return True
 
+    def exists(self, uri):
+        return self._blob_exists(self._blob_client(uri))
+
+    def get_upload_target(self, name, prefix=None, mimetype=None, max_size=None, expires_in=3600):
+        """Get a SAS signed URL for uploading a file directly to storage
+
+        Note that Azure Blob Storage cannot enforce `max_size` for direct uploads
+        """
+        blob = self._blob_client(name, prefix)
+        headers = {'x-ms-blob-type': 'BlockBlob'}
+        if mimetype:
+            headers['x-ms-blob-content-type'] = mimetype
+        if self._cache_control:
+            headers['x-ms-blob-cache-control'] = self._cache_control
+        signed_url = self._get_signed_url(blob, expires_in, BlobSasPermissions(create=True, write=True))
+        return UploadTarget(signed_url, 'PUT', headers)
+
+    def iter_uris(self, prefix=None):
+        list_prefix = self._get_blob_path(prefix or '')
+        base_path_len = len(self._path_prefix) + 1 if self._path_prefix else 0
+        for blob in self._container_client.list_blobs(name_starts_with=list_prefix + '/' if list_prefix else None):
+            yield blob.name[base_path_len:]
+
+    def update_cache_control(self, uri):
+        """Update the `Cache-Control` header of an existing blob
+
+        Setting HTTP headers replaces all of them, so existing headers are
+        fetched first, and preserved.
+        """
+        blob = self._blob_client(uri)
+        try:
+            settings = blob.get_blob_properties().content_settings
+            settings.cache_control = self._cache_control
+            blob.set_http_headers(settings)
+        except ResourceNotFoundError:
+            return False
+        return True
+
     def _get_blob_path(self, name, prefix=None):
         # type: (str, Optional[str]) -> str
         path = [seg for seg in (self._path_prefix, prefix, name) if seg]
@@ -93,9 +159,10 @@ class AzureBlobStorage(StorageBackend):
         # type: (str, Optional[str]) -> BlobClient
         return self._container_client.get_blob_client(self._get_blob_path(name, prefix))
 
-    def _get_signed_url(self, blob, expires_in):
-        # type: (BlobClient, int) -> str
-        permissions = BlobSasPermissions(read=True)
+    def _get_signed_url(self, blob, expires_in, permissions=None):
+        # type: (BlobClient, int, Optional[BlobSasPermissions]) -> str
+        if permissions is None:
+            permissions = BlobSasPermissions(read=True)
         token_expires = (datetime.now(tz=UTC) + timedelta(seconds=expires_in))
 
         sas_token = generate_blob_sas(account_name=blob.account_name,
@@ -105,12 +172,11 @@ class AzureBlobStorage(StorageBackend):
                                       permission=permissions,
                                       expiry=token_expires)
 
-        blob_client = BlobClient(self._svc_client.url,
-                                 container_name=blob.container_name,
-                                 blob_name=blob.blob_name,
-                                 credential=sas_token)
+        return '{}?{}'.format(blob.url, sas_token)
 
-        return blob_client.url  # type: ignore
+    @memoized_property
+    def _cache_control(self):
+        return resolve_cache_control(self._cache_control_option, self._is_public_read)
 
     @memoized_property
     def _is_public_read(self):
@@ -126,3 +192,25 @@ class AzureBlobStorage(StorageBackend):
         except ResourceNotFoundError:
             return False
         return True
+
+
+def _get_transport(pool_size, connection_timeout, read_timeout):
+    # type: (int, float, float) -> RequestsTransport
+    """Get an HTTP transport with a connection pool of the given size
+
+    Transports are shared by all clients with the same settings, so that
+    connections are reused across storage backend instances
+    """
+    key = (pool_size, connection_timeout, read_timeout)
+    with _transports_lock:
+        if key not in _transports:
+            session = requests.Session()
+            # Retries are handled by the Azure SDK pipeline
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            _transports[key] = RequestsTransport(session=session,
+                                                 session_owner=False,
+                                                 connection_timeout=connection_timeout,
+                                                 read_timeout=read_timeout)
+        return _transports[key]
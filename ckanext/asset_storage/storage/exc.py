@@ -20,3 +20,17 @@ class InvalidInput(StorageError, ValueError):
 class ObjectNotFound(StorageError, IOError):
     """Exception indicating that a requested file was not found
     """
+    pass
+
+
+class StorageTimeout(StorageError):
+    """Exception indicating that a storage operation did not complete in time
+    """
+    pass
+
+
+class StorageUnavailable(StorageError):
+    """Exception indicating that storage is currently considered unavailable,
+    and requests to it are failing fast
+    """
+    pass
@@ -0,0 +1,157 @@
+import logging
+import posixpath
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import closing
+from typing import Any, Dict, List, Optional, Tuple
+
+from six import BytesIO
+from six.moves.urllib.request import urlopen
+
+from ckanext.asset_storage.storage import DownloadTarget, StorageBackend, exc, get_storages, iter_unique_uris
+
+_log = logging.getLogger(__name__)
+
+
+class FallbackStorage(StorageBackend):
+    """A storage backend that reads from an ordered chain of storage backends
+
+    New files are always written to the first (primary) backend. Reads are
+    attempted on each backend in order, and the first backend to have the
+    file wins. When a file is found in one of the secondary backends, it is
+    copied to the primary backend in the background, so that frequently
+    accessed files gradually migrate themselves to the primary backend.
+
+    This is mostly useful when migrating from one storage backend (e.g.
+    CKAN's local storage) to another.
+    """
+    def __init__(self, backends, copy_on_read=True, copy_workers=2, copy_timeout=30):
+        # type: (List[Dict[str, Any]], bool, int, int) -> FallbackStorage
+        """Constructor for the fallback storage backend
+
+        Args:
+            backends: An ordered list of backend configurations, each being a
+                dict with a `type` and `options` keys. The first backend is
+                the primary backend
+            copy_on_read: Whether to copy files found in a secondary backend
+                to the primary backend
+            copy_workers: Max number of background threads copying files to the
+                primary backend
+            copy_timeout: Timeout in seconds for fetching files to copy from
+                secondary backends that provide a redirect URL
+        """
+        self._backends = get_storages(backends)
+        if not self._backends:
+            raise ValueError('Fallback storage requires at least one backend to be configured')
+
+        self._copy_on_read = copy_on_read
+        self._copy_timeout = copy_timeout
+        self._executor = ThreadPoolExecutor(max_workers=copy_workers) if copy_on_read else None
+        self._pending = {}  # type: Dict[str, Any]
+        self._lock = threading.Lock()
+
+    @property
+    def _primary(self):
+        # type: () -> StorageBackend
+        return self._backends[0]
+
+    def get_storage_uri(self, name, prefix=None):
+        return self._primary.get_storage_uri(name, prefix)
+
+    def upload(self, stream, name, prefix=None, mimetype=None, content_encoding=None):
+        """Save the file in the primary storage backend
+        """
+        return self._primary.upload(stream, name, prefix, mimetype=mimetype, content_encoding=content_encoding)
+
+    def download(self, uri):
+        """Download the file from the first backend that has it
+        """
+        for index, backend in enumerate(self._backends):
+            try:
+                target = backend.download(uri)
+            except exc.ObjectNotFound:
+                continue
+
+            if index > 0:
+                _log.debug('Asset %s was found in secondary backend %s', uri, backend)
+                self._schedule_copy(backend, uri)
+            return target
+
+        raise exc.ObjectNotFound('The requested file was not found')
+
+    def delete(self, uri):
+        """Delete the file from all backends
+
+        Returns `True` if the file was deleted from at least one backend.
+        """
+        deleted = [backend.delete(uri) for backend in self._backends]
+        return any(deleted)
+
+    def exists(self, uri):
+        return any(backend.exists(uri) for backend in self._backends)
+
+    def get_upload_target(self, name, prefix=None, mimetype=None, max_size=None, expires_in=3600):
+        return self._primary.get_upload_target(name, prefix, mimetype=mimetype, max_size=max_size,
+                                               expires_in=expires_in)
+
+    def iter_uris(self, prefix=None):
+        """List the URIs of files in all backends which support listing files
+        """
+        return iter_unique_uris(self._backends, prefix)
+
+    def update_cache_control(self, uri):
+        updated = [backend.update_cache_control(uri) for backend in self._backends]
+        return any(updated)
+
+    def flush(self, timeout=None):
+        # type: (Optional[float]) -> None
+        """Wait for all pending background copies to complete
+        """
+        with self._lock:
+            pending = list(self._pending.values())
+        wait(pending, timeout=timeout)
+
+    def _schedule_copy(self, source, uri):
+        # type: (StorageBackend, str) -> None
+        if not self._copy_on_read:
+            return
+
+        with self._lock:
+            if uri in self._pending:
+                return
+            self._pending[uri] = self._executor.submit(self._copy_to_primary, source, uri)
+
+    def _copy_to_primary(self, source, uri):
+        # type: (StorageBackend, str) -> None
+        """Copy a file from a secondary backend to the primary backend
+        """
+        try:
+            stream, mimetype, encoding = self._fetch(source.download(uri))
+            with closing(stream):
+                name, prefix = _split_uri(uri)
+                written = self._primary.upload(stream, name, prefix, mimetype=mimetype, content_encoding=encoding)
+            _log.info('Copied asset %s to primary storage, %d bytes written', uri, written)
+        except Exception as e:
+            _log.warning('Failed to copy asset %s to primary storage: %s', uri, e)
+        finally:
+            with self._lock:
+                self._pending.pop(uri, None)
+
+    def _fetch(self, target):
+        # type: (DownloadTarget) -> Tuple[Any, Optional[str], Optional[str]]
+        """Get a readable stream, MIME type and content encoding from a download target
+        """
+        if target.fileobj:
+            return target.fileobj, target.mimetype, target.content_encoding
+
+        with closing(urlopen(target.redirect_to, timeout=self._copy_timeout)) as response:
+            headers = response.info()
+            return BytesIO(response.read()), headers.get('Content-Type'), headers.get('Content-Encoding')
+
+
+def _split_uri(uri):
+    # type: (str) -> Tuple[str, Optional[str]]
+    """Split a relative storage URI into a name and a prefix
+    """
+    prefix, name = posixpath.split(uri)
+    return name, prefix or None
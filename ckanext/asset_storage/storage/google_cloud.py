@@ -1,10 +1,18 @@
+import os
 from datetime import timedelta
-from typing import Optional
+from typing import BinaryIO, Dict, Optional
 
+from google.api_core.exceptions import NotFound
+from google.auth.credentials import AnonymousCredentials
 from google.cloud import storage
 from google.oauth2 import service_account
 
-from ckanext.asset_storage.storage import DownloadTarget, StorageBackend, exc
+from ckanext.asset_storage import tracing
+from ckanext.asset_storage.storage import (AUTO_CACHE_CONTROL, DownloadTarget, StorageBackend, UploadTarget, exc,
+                                           resolve_cache_control)
+from ckanext.asset_storage.storage.hmac_signing import DEFAULT_ENDPOINT, HmacSigner
+
+_MB = 1024 * 1024
 
 
 class GoogleCloudStorage(StorageBackend):
@@ -12,76 +20,160 @@ class GoogleCloudStorage(StorageBackend):
 
     See https://cloud.google.com/storage
     """
-    def __init__(self, project_name, bucket_name, account_key_file, public_read=True, path_prefix=None,
-                 signed_url_lifetime=3600):
-        # type: (str, str, str, bool, Optional[str], Optional[int]) -> GoogleCloudStorage
+    def __init__(self, project_name, bucket_name, account_key_file=None, public_read=True, path_prefix=None,
+                 signed_url_lifetime=3600, cache_control=AUTO_CACHE_CONTROL, uniform_bucket_level_access=False,
+                 api_endpoint=None, upload_chunk_size=8, hmac_access_id=None, hmac_secret=None):
+        # type: (str, str, Optional[str], bool, Optional[str], Optional[int], Optional[str], bool, Optional[str], int, Optional[str], Optional[str]) -> GoogleCloudStorage  # noqa: E501
         """Constructor for Google Cloud Storage backend
 
         Args:
             project_name: Google Cloud project name
             bucket_name: Google Cloud Storage bucket name
-            account_key_file: Path to the Google Cloud credentials JSON file
+            account_key_file: Path to the Google Cloud credentials JSON file. May only be omitted with `api_endpoint`.
             public_read: Whether to allow public read access to uploaded assets. Setting to False means the asset can
                 only be accessed after a request to this code to generate a signed URL. This will have some performance
                 impact.
             path_prefix: A prefix to prepend to all stored assets in the bucket
             signed_url_lifetime: When public access is not allowed, this sets the max lifetime of signed URLs.
+            cache_control: `Cache-Control` metadata to set on uploaded objects, or `None` to use the GCS default.
+                If `auto`, objects are cached as immutable, by shared caches only if `public_read` is set.
+            uniform_bucket_level_access: Set to True if the bucket has uniform bucket-level access enabled. Object
+                ACLs are not set in this case, and `public_read` should match the bucket's IAM policy.
+            api_endpoint: Custom Google Cloud Storage API endpoint, e.g. of a local emulator. If `account_key_file`
+                is not set, anonymous credentials are used, and signed URLs are not available.
+            upload_chunk_size: Size in megabytes of chunks to send large files in. This bounds the memory used by
+                each upload of a large file.
+            hmac_access_id: Access ID of an HMAC key to sign URLs with, instead of the service account's private key.
+                Signing with an HMAC key is done locally, and is much cheaper than signing with an RSA key.
+            hmac_secret: Secret of the HMAC key to sign URLs with
         """
-        self._bucket_name = bucket_name
         self._path_prefix = path_prefix
         self._public_read = public_read
         self._signed_url_lifetime = signed_url_lifetime
-        self._credentials = self._load_credentials(account_key_file)
-        self._client = storage.Client(project=project_name, credentials=self._credentials)
+        self._cache_control = resolve_cache_control(cache_control, public_read)
+        self._uniform_access = uniform_bucket_level_access
+        self._upload_chunk_size = upload_chunk_size * _MB
+        if account_key_file or not api_endpoint:
+            self._credentials = self._load_credentials(account_key_file)
+        else:
+            self._credentials = AnonymousCredentials()
+        client_options = {'api_endpoint': api_endpoint} if api_endpoint else None
+        self._client = storage.Client(project=project_name, credentials=self._credentials,
+                                      client_options=client_options)
+        # Creating a bucket handle does not make any API calls, so it can be safely reused
+        self._bucket = self._client.bucket(bucket_name)
+        if bool(hmac_access_id) != bool(hmac_secret):
+            raise ValueError('Both hmac_access_id and hmac_secret must be set to sign URLs with an HMAC key')
+        self._hmac_signer = HmacSigner(hmac_access_id, hmac_secret,
+                                       endpoint=api_endpoint or DEFAULT_ENDPOINT) if hmac_access_id else None
 
     def get_storage_uri(self, name, prefix=None):
         """Get the URL of the file in storage
         """
         if self._public_read:
-            bucket = self._client.bucket(self._bucket_name)
-            blob = bucket.blob(self._get_blob_path(name, prefix))
-            return blob.public_url
+            return self._bucket.blob(self._get_blob_path(name, prefix)).public_url
         elif prefix:
             return '{}/{}'.format(prefix, name)
         else:
             return name
 
-    def upload(self, stream, name, prefix=None, mimetype=None):
+    def upload(self, stream, name, prefix=None, mimetype=None, content_encoding=None):
         """Save the file in storage
-        """
-        bucket = self._client.bucket(self._bucket_name)
-        blob = bucket.blob(self._get_blob_path(name, prefix))
-        blob.upload_from_file(stream, content_type=mimetype)
-        if self._public_read:
-            blob.make_public()
-        else:
-            blob.make_private()
 
+        The object ACL is set in the same request as the upload, unless the
+        bucket uses uniform bucket-level access. If the size of the file is
+        known, small files are uploaded in a single request rather than in a
+        resumable upload session. Large files are streamed in chunks.
+        """
+        blob = self._bucket.blob(self._get_blob_path(name, prefix), chunk_size=self._upload_chunk_size)
+        blob.content_encoding = content_encoding
+        blob.cache_control = self._cache_control
+        blob.upload_from_file(stream, size=_remaining_size(stream), content_type=mimetype,
+                              predefined_acl=self._predefined_acl)
         return stream.tell()
 
     def download(self, uri):
         """Provide the direct URL to download the file from storage
         """
-        bucket = self._client.bucket(self._bucket_name)
-        blob = bucket.get_blob(self._get_blob_path(uri))
+        with tracing.span('gcs_get_blob'):
+            blob = self._bucket.get_blob(self._get_blob_path(uri))
         if blob is None:
             raise exc.ObjectNotFound('The requested file was not found')
 
         # If we got here, we assume blob is private and return a signed URL
-        signed_url = blob.generate_signed_url(expiration=timedelta(seconds=self._signed_url_lifetime),
-                                              method='GET',
-                                              version='v4',
-                                              credentials=self._credentials)
+        with tracing.span('gcs_sign'):
+            signed_url = self._sign_url(blob, 'GET', self._signed_url_lifetime)
         return DownloadTarget.redirect(signed_url)
 
     def delete(self, uri):
-        bucket = self._client.bucket(self._bucket_name)
-        blob = bucket.get_blob(self._get_blob_path(uri))
-        if blob is None:
+        try:
+            self._bucket.delete_blob(self._get_blob_path(uri))
+        except NotFound:
+            return False
+        return True
+
+    def exists(self, uri):
+        return self._bucket.blob(self._get_blob_path(uri)).exists()
+
+    def get_upload_target(self, name, prefix=None, mimetype=None, max_size=None, expires_in=3600):
+        """Get a V4 signed URL for uploading a file directly to storage
+
+        All returned headers are signed, and must be sent by the client
+        """
+        headers = {}
+        if not self._uniform_access:
+            headers['x-goog-acl'] = 'public-read' if self._public_read else 'private'
+        if mimetype:
+            headers['Content-Type'] = mimetype
+        if self._cache_control:
+            headers['Cache-Control'] = self._cache_control
+        if max_size:
+            headers['x-goog-content-length-range'] = '0,{}'.format(max_size)
+
+        blob = self._bucket.blob(self._get_blob_path(name, prefix))
+        signed_url = self._sign_url(blob, 'PUT', expires_in, headers, mimetype)
+        return UploadTarget(signed_url, 'PUT', headers)
+
+    def iter_uris(self, prefix=None):
+        list_prefix = self._get_blob_path(prefix or '')
+        base_path_len = len(self._path_prefix) + 1 if self._path_prefix else 0
+        for blob in self._client.list_blobs(self._bucket, prefix=list_prefix + '/' if list_prefix else None):
+            yield blob.name[base_path_len:]
+
+    def update_cache_control(self, uri):
+        """Patch the `Cache-Control` metadata of an existing object
+        """
+        blob = self._bucket.blob(self._get_blob_path(uri))
+        blob.cache_control = self._cache_control
+        try:
+            blob.patch()
+        except NotFound:
             return False
-        blob.delete()
         return True
 
+    def _sign_url(self, blob, method, expires_in, headers=None, content_type=None):
+        # type: (storage.Blob, str, int, Optional[Dict[str, str]], Optional[str]) -> str
+        """Get a V4 signed URL for an object, signed with the configured HMAC key or service account
+
+        `headers` must include the `Content-Type` header if `content_type` is set
+        """
+        if self._hmac_signer is not None:
+            return self._hmac_signer.sign_url(method, '/{}/{}'.format(self._bucket.name, blob.name), expires_in,
+                                              headers=headers)
+        return blob.generate_signed_url(expiration=timedelta(seconds=expires_in),
+                                        method=method,
+                                        version='v4',
+                                        content_type=content_type,
+                                        headers=headers,
+                                        credentials=self._credentials)
+
+    @property
+    def _predefined_acl(self):
+        # type: () -> Optional[str]
+        if self._uniform_access:
+            return None
+        return 'publicRead' if self._public_read else 'private'
+
     def _get_blob_path(self, name, prefix=None):
         # type: (str, Optional[str]) -> str
         path = [seg for seg in (self._path_prefix, prefix, name) if seg]
@@ -93,3 +185,17 @@ class GoogleCloudStorage(StorageBackend):
         """Load Google Cloud credentials from JSON file
         """
         return service_account.Credentials.from_service_account_file(account_key_file)
+
+
+def _remaining_size(stream):
+    # type: (BinaryIO) -> Optional[int]
+    """Get the number of bytes left to read in a stream, or None if it is not seekable
+    """
+    try:
+        position = stream.tell()
+        stream.seek(0, os.SEEK_END)
+        size = stream.tell() - position
+        stream.seek(position)
+    except (AttributeError, IOError, ValueError):
+        return None
+    return size
@@ -1,8 +1,13 @@
+import errno
+import hashlib
 import logging
 import os.path
+import posixpath
+import uuid
 from shutil import copyfileobj
-from typing import Optional, Tuple
+from typing import Iterable, Optional, Tuple
 
+from ckanext.asset_storage import tracing
 from ckanext.asset_storage.storage import DownloadTarget, StorageBackend, exc
 
 try:
@@ -13,12 +18,39 @@ except ImportError:
 
 _log = logging.getLogger(__name__)
 
+LAYOUTS = {'flat', 'hashed'}
+
+_TEMP_FILE_PREFIX = '.tmp-'
+
+# Directories CKAN itself keeps in its storage path, which may also be the
+# local storage directory; These are skipped when walking all stored files
+CKAN_DIRS = {'resources', 'storage'}
+
+# `os.replace` is not available in Python 2, but `os.rename` is atomic on POSIX systems
+_replace = getattr(os, 'replace', os.rename)
+
 
 class LocalStorage(StorageBackend):
     """A storage backend for storing assets in the local file system
     """
-    def __init__(self, storage_path):
+    def __init__(self, storage_path, layout='flat', shard_depth=2):
+        # type: (str, str, int) -> LocalStorage
+        """Constructor for the local storage backend
+
+        Args:
+            storage_path: The local directory to store files in
+            layout: Either `flat` to store all files with the same prefix in
+                the same directory, or `hashed` to spread them across nested
+                subdirectories (e.g. `group/ab/cd/<name>`) based on a hash
+                of the file name. This does not affect file URIs.
+            shard_depth: Number of nested subdirectories to use with the
+                `hashed` layout
+        """
+        if layout not in LAYOUTS:
+            raise ValueError('Invalid local storage layout `{}`; expecting one of {}'.format(layout, LAYOUTS))
         self._path = storage_path
+        self._layout = layout
+        self._shard_depth = shard_depth
 
     def get_storage_uri(self, name, prefix=None):
         if prefix:
@@ -26,44 +58,139 @@ class LocalStorage(StorageBackend):
         else:
             return name
 
-    def upload(self, stream, name, prefix=None, mimetype=None):
+    def upload(self, stream, name, prefix=None, mimetype=None, content_encoding=None):
         """Save the file in local storage
+
+        The file is first written to a temporary file, which is then moved to
+        its final location, so readers never see partially written files.
         """
         file_path = self._get_file_path(name, prefix)
-        if not file_path.parent.exists():
-            file_path.parent.mkdir(parents=True)
+        _ensure_dir(file_path.parent)
 
-        with file_path.open('wb') as f:
-            copyfileobj(stream, f)
-            return f.tell()
+        temp_path = file_path.parent / '{}{}'.format(_TEMP_FILE_PREFIX, uuid.uuid4().hex)
+        try:
+            with _create_file(temp_path) as f:
+                copyfileobj(stream, f)
+                written = f.tell()
+            _replace(str(temp_path), str(file_path))
+        except Exception:
+            _remove_quietly(temp_path)
+            raise
+        return written
 
     def download(self, uri):
         """Download the file from local storage
         """
         name, prefix = self._parse_uri(uri)
-        file_path = self._get_file_path(name, prefix)
-        try:
-            fileobj = file_path.open('rb')
-        except IOError:
-            raise exc.ObjectNotFound('The requested file was not found')
-        return DownloadTarget.send_file(fileobj, name)
+        for file_path in self._get_candidate_paths(name, prefix):
+            try:
+                with tracing.span('local_open'):
+                    fileobj = file_path.open('rb')
+            except IOError:
+                continue
+            return DownloadTarget.send_file(fileobj, name)
+        raise exc.ObjectNotFound('The requested file was not found')
 
     def delete(self, uri):
-        file_path = self._get_file_path(*self._parse_uri(uri))
-        try:
-            file_path.unlink()
-        except (IOError, OSError) as e:
-            _log.warning('Failed to remove local file {}: {}'.format(file_path, e))
-            return False
-        return True
+        name, prefix = self._parse_uri(uri)
+        for file_path in self._get_candidate_paths(name, prefix):
+            try:
+                file_path.unlink()
+            except (IOError, OSError) as e:
+                _log.debug('Failed to remove local file {}: {}'.format(file_path, e))
+                continue
+            return True
+        _log.warning('Failed to remove local file for {}: file not found'.format(uri))
+        return False
+
+    def exists(self, uri):
+        name, prefix = self._parse_uri(uri)
+        return any(p.is_file() for p in self._get_candidate_paths(name, prefix))
+
+    def iter_uris(self, prefix=None):
+        """List stored files, optionally only under a prefix
+
+        Without a prefix, files in CKAN's own directories (see `CKAN_DIRS`)
+        are not listed.
+        """
+        for file_path, file_prefix in self._iter_files(prefix):
+            yield posixpath.join(file_prefix, file_path.name) if file_prefix else file_path.name
+
+    def migrate_layout(self, prefixes=None, dry_run=False):
+        # type: (Optional[Iterable[str]], bool) -> Iterable[Tuple[Path, Path]]
+        """Move existing files to their location in the configured layout
+
+        This is useful after changing the layout of an existing storage
+        directory. Only files under the given prefixes are moved, or if not
+        set, all files except those in CKAN's own directories (see
+        `CKAN_DIRS`). Yields `(old_path, new_path)` for each moved file.
+        """
+        for prefix in prefixes or [None]:
+            for old_path, file_prefix in self._iter_files(prefix):
+                new_path = self._get_file_path(old_path.name, file_prefix)
+                if old_path == new_path:
+                    continue
+                if not dry_run:
+                    _ensure_dir(new_path.parent)
+                    _replace(str(old_path), str(new_path))
+                yield old_path, new_path
+
+    def _iter_files(self, prefix=None):
+        # type: (Optional[str]) -> Iterable[Tuple[Path, Optional[str]]]
+        """Iterate over stored files, optionally only under a prefix
+
+        Without a prefix, CKAN's own directories are skipped. Yields
+        `(file_path, prefix)` for each file
+        """
+        root = Path(self._path)
+        top = root / prefix if prefix else root
+        for dir_path, dir_names, file_names in os.walk(str(top)):
+            if not prefix and dir_path == str(root):
+                dir_names[:] = [d for d in dir_names if d not in CKAN_DIRS]
+            for file_name in file_names:
+                if file_name.startswith(_TEMP_FILE_PREFIX):
+                    continue
+                file_path = Path(dir_path) / file_name
+                yield file_path, self._get_prefix(file_path.parent.relative_to(root), file_name)
 
     def _get_file_path(self, name, prefix):
         # type: (str, Optional[str]) -> Path
         path = Path(self._path)
         if prefix:
             path = path / prefix
+        if self._layout == 'hashed':
+            path = path.joinpath(*self._get_shards(name))
         return path / name
 
+    def _get_candidate_paths(self, name, prefix):
+        # type: (str, Optional[str]) -> Iterable[Path]
+        """Get the possible locations of a file
+
+        With the `hashed` layout, files which have not been migrated yet may
+        still be found in their flat layout location.
+        """
+        yield self._get_file_path(name, prefix)
+        if self._layout == 'hashed':
+            path = Path(self._path)
+            yield (path / prefix if prefix else path) / name
+
+    def _get_shards(self, name):
+        # type: (str) -> Tuple[str, ...]
+        digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+        return tuple(digest[i * 2:i * 2 + 2] for i in range(self._shard_depth))
+
+    def _get_prefix(self, rel_dir, name):
+        # type: (Path, str) -> Optional[str]
+        """Get the prefix of a file from the directory it is in, relative to the storage path
+
+        This strips the file's shard subdirectories from the directory path, if any
+        """
+        parts = rel_dir.parts
+        shards = self._get_shards(name)
+        if shards and parts[-len(shards):] == shards:
+            parts = parts[:-len(shards)]
+        return os.path.join(*parts) if parts else None
+
     @staticmethod
     def _parse_uri(uri):
         # type: (str) -> Tuple[str, Optional[str]]
@@ -74,3 +201,29 @@ class LocalStorage(StorageBackend):
             return parts[1], parts[0]
         else:
             raise ValueError("Invalid file URI for this storage module")
+
+
+def _ensure_dir(path):
+    # type: (Path) -> None
+    """Create a directory and its parents, unless it already exists
+    """
+    try:
+        path.mkdir(parents=True)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _create_file(path):
+    """Create a new file for writing, respecting the process umask for its permissions
+    """
+    fd = os.open(str(path), os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o666)
+    return os.fdopen(fd, 'wb')
+
+
+def _remove_quietly(path):
+    # type: (Path) -> None
+    try:
+        path.unlink()
+    except OSError:
+        pass
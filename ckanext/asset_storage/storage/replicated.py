@@ -0,0 +1,180 @@
+import logging
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
+from typing import Any, Callable, Dict, List, Optional
+
+from six import BytesIO
+
+from ckanext.asset_storage.storage import StorageBackend, exc, get_storages, iter_unique_uris
+from ckanext.asset_storage.storage.stats import LatencyWindow, monotonic
+
+_log = logging.getLogger(__name__)
+
+
+class ReplicatedStorage(StorageBackend):
+    """A storage backend that replicates all files to multiple storage backends
+
+    Uploads and deletes are sent to all backends concurrently, and return as
+    soon as a quorum of backends has completed the operation successfully;
+    The rest of the backends complete the operation in the background.
+
+    Downloads are served from the backend with the best recent latency and
+    health, falling back to the other backends if the file could not be
+    downloaded.
+    """
+    def __init__(self, backends, quorum=None, workers=None, error_cooldown=30, latency_window=100):
+        # type: (List[Dict[str, Any]], Optional[int], Optional[int], int, int) -> ReplicatedStorage
+        """Constructor for the replicated storage backend
+
+        Args:
+            backends: A list of backend configurations, each being a dict with a `type` and `options` keys.
+                URIs are generated by the first backend, so all backends are expected to generate the same
+                relative URIs for the same file.
+            quorum: The number of backends that must complete an upload or delete for it to be considered
+                successful. Defaults to a majority of the backends.
+            workers: Max number of threads used to send operations to backends. Defaults to 4 threads per
+                backend.
+            error_cooldown: Number of seconds for which a backend that has failed is not preferred for downloads
+            latency_window: Number of recent calls to each backend to keep latency measurements for
+        """
+        self._backends = get_storages(backends)
+        if not self._backends:
+            raise ValueError('Replicated storage requires at least one backend to be configured')
+
+        if quorum is None:
+            quorum = len(self._backends) // 2 + 1
+        if not 0 < quorum <= len(self._backends):
+            raise ValueError('Replicated storage quorum must be between 1 and the number of backends')
+
+        self._quorum = quorum
+        self._error_cooldown = error_cooldown
+        self._stats = [LatencyWindow(latency_window) for _ in self._backends]
+        self._executor = ThreadPoolExecutor(max_workers=workers or 4 * len(self._backends))
+
+    def get_storage_uri(self, name, prefix=None):
+        return self._backends[0].get_storage_uri(name, prefix)
+
+    def upload(self, stream, name, prefix=None, mimetype=None, content_encoding=None):
+        """Save the file in all backends
+        """
+        content = stream.read()
+        results = self._fan_out('upload', lambda backend: backend.upload(BytesIO(content), name, prefix,
+                                                                         mimetype=mimetype,
+                                                                         content_encoding=content_encoding))
+        return results[0]
+
+    def download(self, uri):
+        """Download the file from the best available backend
+        """
+        not_found = 0
+        for index in self._ranked_backends():
+            try:
+                return self._timed(index, lambda backend: backend.download(uri))
+            except exc.ObjectNotFound:
+                not_found += 1
+            except Exception as e:
+                _log.warning('Failed to download %s from replica %s: %s', uri, self._backends[index], e)
+
+        if not_found == len(self._backends):
+            raise exc.ObjectNotFound('The requested file was not found')
+        raise exc.StorageError('Failed to download {} from any of the replicas'.format(uri))
+
+    def delete(self, uri):
+        """Delete the file from all backends
+
+        Returns `True` if the file was deleted from at least one of the
+        backends that have completed the deletion.
+        """
+        results = self._fan_out('delete', lambda backend: backend.delete(uri))
+        return any(results)
+
+    def exists(self, uri):
+        """Tell if the file exists in any of the backends
+        """
+        for index in self._ranked_backends():
+            try:
+                if self._timed(index, lambda backend: backend.exists(uri)):
+                    return True
+            except Exception as e:
+                _log.warning('Failed to check if %s exists in replica %s: %s', uri, self._backends[index], e)
+        return False
+
+    def iter_uris(self, prefix=None):
+        """List the URIs of files in all replicas which support listing files
+        """
+        return iter_unique_uris(self._backends, prefix)
+
+    def update_cache_control(self, uri):
+        results = self._fan_out('update_cache_control', lambda backend: backend.update_cache_control(uri))
+        return any(results)
+
+    def _fan_out(self, operation, call):
+        # type: (str, Callable[[StorageBackend], Any]) -> List[Any]
+        """Call all backends concurrently, and return once a quorum of them have succeeded
+
+        Returns the results of successful calls. Raises a `StorageError` if
+        a quorum can no longer be reached.
+        """
+        futures = []
+        for index, backend in enumerate(self._backends):
+            future = self._executor.submit(self._timed, index, call)
+            future.add_done_callback(partial(_log_failure, operation, backend))
+            futures.append(future)
+
+        max_failures = len(self._backends) - self._quorum
+        results = []
+        failures = 0
+        for future in as_completed(futures):
+            if future.exception() is None:
+                results.append(future.result())
+            else:
+                failures += 1
+
+            if len(results) >= self._quorum:
+                return results
+            if failures > max_failures:
+                break
+
+        raise exc.StorageError('Failed to {} in a quorum of {} replicas'.format(operation, self._quorum))
+
+    def _timed(self, index, call):
+        # type: (int, Callable[[StorageBackend], Any]) -> Any
+        """Call a backend and record the call's latency and health
+        """
+        start = monotonic()
+        try:
+            result = call(self._backends[index])
+        except exc.ObjectNotFound:
+            self._stats[index].record(monotonic() - start)
+            raise
+        except Exception:
+            self._stats[index].record_error()
+            raise
+        self._stats[index].record(monotonic() - start)
+        return result
+
+    def _ranked_backends(self):
+        # type: () -> List[int]
+        """Get the backend indexes, ordered by recent health and latency
+        """
+        return sorted(range(len(self._backends)), key=self._score)
+
+    def _score(self, index):
+        """Score a backend for download preference; Lower is better
+
+        Backends that recently failed are ranked last; backends without
+        latency measurements are ranked first, so that they get measured.
+        """
+        stats = self._stats[index]
+        since_error = stats.seconds_since_error()
+        unhealthy = since_error is not None and since_error < self._error_cooldown and stats.consecutive_errors > 0
+        latency = stats.mean()
+        return unhealthy, latency if latency is not None else 0.0
+
+
+def _log_failure(operation, backend, future):
+    """Log failed calls to replicas, including calls completing after a quorum was reached
+    """
+    error = future.exception()
+    if error is not None:
+        _log.warning('Replica %s failed to %s: %s', backend, operation, error)
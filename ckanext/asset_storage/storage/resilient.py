@@ -0,0 +1,256 @@
+import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from concurrent.futures import TimeoutError as FutureTimeoutError
+from concurrent.futures import as_completed, wait
+from typing import Any, Callable, Dict, List, Optional
+
+from ckanext.asset_storage.storage import StorageBackend, exc, get_storages
+from ckanext.asset_storage.storage.stats import LatencyWindow, monotonic
+
+_log = logging.getLogger(__name__)
+
+# Errors that indicate the backend is healthy, and should not be retried
+_NON_RETRIABLE_ERRORS = (exc.ObjectNotFound, exc.InvalidInput)
+
+_FAIL_FAST_ERRORS = _NON_RETRIABLE_ERRORS + (exc.StorageUnavailable, )
+
+
+class ResilientStorage(StorageBackend):
+    """A storage backend that wraps another storage backend, making calls to it more resilient
+
+    This enforces a deadline for each storage operation, including any
+    retries, retries failed operations with exponential backoff and jitter, and stops calling the
+    wrapped backend for a while after repeated failures (i.e. a circuit
+    breaker). Optionally, if a download takes longer than usual, a second
+    "hedged" download request is sent and the first response is used.
+    """
+    def __init__(self, backend, timeout=10, upload_timeout=60, retries=2, backoff_base=0.1, backoff_max=2.0,
+                 circuit_threshold=5, circuit_reset_timeout=30, hedge_percentile=None, hedge_min_samples=20,
+                 workers=16):
+        # type: (Dict[str, Any], float, float, int, float, float, int, float, Optional[float], int, int) -> ResilientStorage  # noqa: E501
+        """Constructor for the resilient storage backend
+
+        Args:
+            backend: The wrapped backend configuration, a dict with a `type` and `options` keys
+            timeout: Deadline in seconds for download and delete operations, including retries
+            upload_timeout: Deadline in seconds for upload operations, including retries
+            retries: Max number of times to retry a failed operation. Uploads are only retried if the uploaded
+                stream is seekable, and are not retried after timing out.
+            backoff_base: Base delay in seconds for exponential backoff between retries
+            backoff_max: Max delay in seconds between retries
+            circuit_threshold: Number of consecutive failures after which calls to the backend will fail fast.
+                Set to 0 to disable the circuit breaker.
+            circuit_reset_timeout: Number of seconds after which a single call is allowed through an open circuit,
+                to test if the backend has recovered
+            hedge_percentile: If set, send a second download request if the first one takes longer than this
+                percentile of recent download latencies
+            hedge_min_samples: Min number of recent downloads required before hedging requests
+            workers: Max number of threads used to call the wrapped backend
+        """
+        self._backend = get_storages([backend])[0]
+        self._timeout = timeout
+        self._upload_timeout = upload_timeout
+        self._retries = retries
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._circuit = CircuitBreaker(circuit_threshold, circuit_reset_timeout)
+        self._hedge_percentile = hedge_percentile
+        self._hedge_min_samples = hedge_min_samples
+        self._read_latency = LatencyWindow()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    def get_storage_uri(self, name, prefix=None):
+        return self._backend.get_storage_uri(name, prefix)
+
+    def upload(self, stream, name, prefix=None, mimetype=None, content_encoding=None):
+        try:
+            start_pos = stream.tell()
+        except (AttributeError, IOError, ValueError):
+            start_pos = None
+
+        def call():
+            if start_pos is not None:
+                stream.seek(start_pos)
+            return self._backend.upload(stream, name, prefix, mimetype=mimetype, content_encoding=content_encoding)
+
+        return self._call('upload', call, self._upload_timeout, retry=start_pos is not None)
+
+    def download(self, uri):
+        return self._call('download', lambda: self._backend.download(uri), self._timeout, hedge=True)
+
+    def delete(self, uri):
+        return self._call('delete', lambda: self._backend.delete(uri), self._timeout)
+
+    def exists(self, uri):
+        return self._call('exists', lambda: self._backend.exists(uri), self._timeout, hedge=True)
+
+    def get_upload_target(self, name, prefix=None, mimetype=None, max_size=None, expires_in=3600):
+        return self._call('get_upload_target',
+                          lambda: self._backend.get_upload_target(name, prefix, mimetype=mimetype, max_size=max_size,
+                                                                  expires_in=expires_in),
+                          self._timeout)
+
+    def iter_uris(self, prefix=None):
+        return self._backend.iter_uris(prefix)
+
+    def update_cache_control(self, uri):
+        return self._call('update_cache_control', lambda: self._backend.update_cache_control(uri), self._timeout)
+
+    def _call(self, operation, call, timeout, retry=True, hedge=False):
+        # type: (str, Callable[[], Any], float, bool, bool) -> Any
+        """Call the wrapped backend, enforcing deadlines, retries and the circuit breaker
+
+        `timeout` is a deadline for the whole operation: retries and backoff
+        delays only use the time left, and no retry is made once it is over.
+        """
+        deadline = monotonic() + timeout
+        attempts = self._retries + 1 if retry else 1
+        error = None  # type: Optional[Exception]
+        for attempt in range(1, attempts + 1):
+            try:
+                return self._guarded_attempt(operation, call, deadline - monotonic(), hedge)
+            except _FAIL_FAST_ERRORS:
+                raise
+            except Exception as e:
+                error = e
+            if attempt == attempts or not self._wait_to_retry(operation, error, attempt, attempts, deadline):
+                break
+
+        if isinstance(error, exc.StorageError):
+            raise error
+        raise exc.StorageError('Storage {} failed: {}'.format(operation, error))
+
+    def _guarded_attempt(self, operation, call, timeout, hedge):
+        # type: (str, Callable[[], Any], float, bool) -> Any
+        """Make an attempt to call the backend, if allowed by the circuit breaker
+        """
+        if not self._circuit.allow():
+            raise exc.StorageUnavailable('Storage backend is unavailable after repeated failures')
+        try:
+            result = self._attempt(operation, call, timeout, hedge)
+        except _NON_RETRIABLE_ERRORS:
+            self._circuit.record_success()
+            raise
+        except Exception:
+            self._circuit.record_failure()
+            raise
+        self._circuit.record_success()
+        return result
+
+    def _attempt(self, operation, call, timeout, hedge):
+        # type: (str, Callable[[], Any], float, bool) -> Any
+        """Make a single attempt to call the backend, possibly hedging it with a second request
+        """
+        start = monotonic()
+        futures = [self._executor.submit(self._timed, call, hedge)]
+        hedge_delay = self._hedge_delay() if hedge else None
+        if hedge_delay is not None and hedge_delay < timeout:
+            done, _ = wait(futures, timeout=hedge_delay)
+            if not done:
+                _log.debug('Storage %s is taking longer than %.3f seconds, sending hedged request',
+                           operation, hedge_delay)
+                futures.append(self._executor.submit(self._timed, call, hedge))
+
+        try:
+            return _first_result(futures, timeout - (monotonic() - start))
+        except FutureTimeoutError:
+            raise exc.StorageTimeout('Storage {} did not complete within its deadline'.format(operation))
+
+    def _timed(self, call, record):
+        # type: (Callable[[], Any], bool) -> Any
+        start = monotonic()
+        result = call()
+        if record:
+            self._read_latency.record(monotonic() - start)
+        return result
+
+    def _hedge_delay(self):
+        # type: () -> Optional[float]
+        if self._hedge_percentile is None or self._read_latency.count < self._hedge_min_samples:
+            return None
+        return self._read_latency.percentile(self._hedge_percentile)
+
+    def _wait_to_retry(self, operation, error, attempt, attempts, deadline):
+        # type: (str, Exception, int, int, float) -> bool
+        """Wait before retrying a failed attempt, returning `False` without waiting if it should not be retried
+        """
+        _log.warning('Storage %s failed (attempt %d of %d): %s', operation, attempt, attempts, error)
+        # A timed out upload may still be reading from the stream, so it is not safe to retry
+        if isinstance(error, exc.StorageTimeout) and operation == 'upload':
+            return False
+        delay = self._backoff(attempt)
+        if deadline - monotonic() - delay <= 0:
+            _log.warning('Storage %s deadline is over, not retrying', operation)
+            return False
+        time.sleep(delay)
+        return True
+
+    def _backoff(self, attempt):
+        # type: (int) -> float
+        """Get a random delay before retrying, using exponential backoff with "full jitter"
+        """
+        return random.uniform(0, min(self._backoff_max, self._backoff_base * 2 ** attempt))
+
+
+class CircuitBreaker(object):
+    """A simple circuit breaker
+
+    After `threshold` consecutive failures the circuit opens, and calls are
+    not allowed through. Once `reset_timeout` seconds have passed, a single
+    call is allowed through; If it succeeds the circuit is closed again.
+    """
+    def __init__(self, threshold, reset_timeout):
+        # type: (int, float) -> CircuitBreaker
+        self._threshold = threshold
+        self._reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None  # type: Optional[float]
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        # type: () -> bool
+        return self._opened_at is not None
+
+    def allow(self):
+        # type: () -> bool
+        with self._lock:
+            if self._opened_at is None:
+                return True
+            if monotonic() - self._opened_at >= self._reset_timeout:
+                self._opened_at = monotonic()
+                return True
+            return False
+
+    def record_success(self):
+        # type: () -> None
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        # type: () -> None
+        with self._lock:
+            self._failures += 1
+            if self._threshold and self._failures >= self._threshold:
+                self._opened_at = monotonic()
+
+
+def _first_result(futures, timeout):
+    # type: (List[Any], float) -> Any
+    """Get the result of the first of `futures` to complete successfully
+
+    If all futures fail, the error raised by the last one is raised.
+    """
+    error = None
+    for future in as_completed(futures, timeout=max(timeout, 0)):
+        try:
+            return future.result()
+        except _NON_RETRIABLE_ERRORS:
+            raise
+        except Exception as e:
+            error = e
+    raise error
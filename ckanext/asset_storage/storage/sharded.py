@@ -0,0 +1,285 @@
+import hashlib
+import logging
+import posixpath
+import re
+import tempfile
+from contextlib import closing
+from shutil import copyfileobj
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+from six.moves.urllib.request import urlopen
+
+from ckanext.asset_storage.storage import DownloadTarget, StorageBackend, exc, get_storages
+
+_log = logging.getLogger(__name__)
+
+MAX_KEY_PREFIXES = 256
+
+# Files fetched from redirect URLs to be moved are kept in memory up to this size, and in a temporary file if larger
+COPY_SPOOL_SIZE = 1024 * 1024
+
+# Hashed key prefixes are always two hex digits, so they can be told apart from object prefixes when listing files
+_KEY_PREFIX_RE = re.compile(r'^[0-9a-f]{2}/')
+
+# A location of a file in sharded storage: the index of a backend, and the file's key (relative URI) in it
+Location = Tuple[int, str]
+
+_UINT64_MASK = (1 << 64) - 1
+
+
+class ShardedStorage(StorageBackend):
+    """A storage backend that spreads files across multiple storage backends
+
+    Each file is stored in one of the backends (e.g. one of several
+    buckets), and optionally under one of a number of hashed key prefixes
+    in it, both chosen from a stable hash of the file name. This avoids
+    concentrating writes of sequentially named files on a single bucket or
+    key range, which is subject to per-bucket or per-prefix request rate
+    limits in cloud storage.
+
+    Shards are chosen with jump consistent hashing, so that adding a backend
+    or key prefix only moves the files which belong to it. File URIs do not
+    include the shard, which is computed again from the file name when the
+    file is downloaded or deleted. After changing the number of backends or
+    key prefixes, existing files can be moved to their new location using
+    `reshard()`.
+    """
+    def __init__(self, backends, key_prefixes=0, search_all_shards=False, copy_timeout=30):
+        # type: (List[Dict[str, Any]], int, bool, int) -> ShardedStorage
+        """Constructor for the sharded storage backend
+
+        Args:
+            backends: A list of backend configurations, each being a dict with a `type` and `options` keys.
+                All backends are expected to generate the same relative URIs for the same file.
+            key_prefixes: Number of hashed key prefixes (e.g. `0f/group/<name>`) to spread files across within
+                each backend, up to 256, or 0 to store files under their URI
+            search_all_shards: Whether to look for files which are not found in their shard in the other
+                shards, under any key prefix they may have had with another number of key prefixes, and under
+                their unprefixed key. This keeps files available while resharding, but costs several requests
+                to each backend for every missing file, so it should only be enabled while resharding.
+            copy_timeout: Timeout in seconds for fetching files to move from backends that provide a redirect URL
+        """
+        self._backends = get_storages(backends)
+        if not self._backends:
+            raise ValueError('Sharded storage requires at least one backend to be configured')
+        if not 0 <= key_prefixes <= MAX_KEY_PREFIXES:
+            raise ValueError('Sharded storage key_prefixes must be between 0 and {}'.format(MAX_KEY_PREFIXES))
+
+        self._key_prefixes = key_prefixes
+        self._search_all_shards = search_all_shards
+        self._copy_timeout = copy_timeout
+
+    def get_storage_uri(self, name, prefix=None):
+        index, key_prefix = self._get_shard(name)
+        uri = self._backends[index].get_storage_uri(name, _join(key_prefix, prefix))
+        if key_prefix and uri.startswith(key_prefix + '/'):
+            return uri[len(key_prefix) + 1:]
+        return uri
+
+    def upload(self, stream, name, prefix=None, mimetype=None, content_encoding=None):
+        """Save the file in its shard
+        """
+        index, key_prefix = self._get_shard(name)
+        return self._backends[index].upload(stream, name, _join(key_prefix, prefix), mimetype=mimetype,
+                                            content_encoding=content_encoding)
+
+    def download(self, uri):
+        """Download the file from its shard, or from any other shard having it
+        """
+        for index, key in self._get_candidate_locations(uri):
+            try:
+                return self._backends[index].download(key)
+            except exc.ObjectNotFound:
+                continue
+        raise exc.ObjectNotFound('The requested file was not found')
+
+    def delete(self, uri):
+        """Delete the file from its shard, or from any other shard having it
+
+        Returns `True` if the file was deleted.
+        """
+        for index, key in self._get_candidate_locations(uri):
+            if self._backends[index].delete(key):
+                return True
+        return False
+
+    def exists(self, uri):
+        return any(self._backends[index].exists(key) for index, key in self._get_candidate_locations(uri))
+
+    def get_upload_target(self, name, prefix=None, mimetype=None, max_size=None, expires_in=3600):
+        index, key_prefix = self._get_shard(name)
+        return self._backends[index].get_upload_target(name, _join(key_prefix, prefix), mimetype=mimetype,
+                                                       max_size=max_size, expires_in=expires_in)
+
+    def iter_uris(self, prefix=None):
+        """List the URIs of files in all shards
+
+        Raises `NotImplementedError` if any of the backends does not support
+        listing files, as the listing would otherwise be incomplete.
+        """
+        key_prefixes = [_format_key_prefix(p) for p in range(self._key_prefixes)] or [None]
+        for backend in self._backends:
+            for key_prefix in key_prefixes:
+                for key in backend.iter_uris(_join(key_prefix, prefix)):
+                    yield key[len(key_prefix) + 1:] if key_prefix else key
+
+    def update_cache_control(self, uri):
+        for index, key in self._get_candidate_locations(uri):
+            if self._backends[index].update_cache_control(key):
+                return True
+        return False
+
+    def get_location(self, uri):
+        # type: (str) -> Location
+        """Get the location of a file in its shard
+        """
+        index, key_prefix = self._get_shard(posixpath.basename(uri))
+        return index, _join(key_prefix, uri)
+
+    def iter_misplaced(self):
+        # type: () -> Iterable[Tuple[str, Location, Location]]
+        """Find files which are not stored in their shard
+
+        This is the case for existing files after changing the number of
+        backends or key prefixes. Yields `(uri, current_location, location)`
+        for each misplaced file.
+        """
+        for index, backend in enumerate(self._backends):
+            for key in backend.iter_uris():
+                uri = _KEY_PREFIX_RE.sub('', key, count=1)
+                location = self.get_location(uri)
+                if location != (index, key):
+                    yield uri, (index, key), location
+
+    def move(self, source, target):
+        # type: (Location, Location) -> int
+        """Move a file from one location to another, and return the number of bytes written
+
+        The file is only deleted from its current location once it has been
+        written to its new location.
+        """
+        source_index, source_key = source
+        target_index, target_key = target
+        stream, mimetype, encoding = self._fetch(self._backends[source_index].download(source_key))
+        with closing(stream):
+            prefix, name = posixpath.split(target_key)
+            written = self._backends[target_index].upload(stream, name, prefix or None, mimetype=mimetype,
+                                                          content_encoding=encoding)
+        self._backends[source_index].delete(source_key)
+        return written
+
+    def reshard(self, dry_run=False):
+        # type: (bool) -> Iterable[Tuple[str, Location, Location]]
+        """Move all misplaced files to their shard
+
+        Yields `(uri, old_location, new_location)` for each moved file.
+        """
+        for uri, source, target in self.iter_misplaced():
+            if not dry_run:
+                self.move(source, target)
+            yield uri, source, target
+
+    def _get_shard(self, name):
+        # type: (str) -> Tuple[int, Optional[str]]
+        """Get the backend index and key prefix of a file from a hash of its name
+
+        The key prefix is computed independently of the number of backends,
+        so that adding backends does not move files across key prefixes.
+        """
+        backend_key, prefix_key = _hash_name(name)
+        index = _jump_hash(backend_key, len(self._backends))
+        if not self._key_prefixes:
+            return index, None
+        return index, _format_key_prefix(_jump_hash(prefix_key, self._key_prefixes))
+
+    def _get_candidate_locations(self, uri):
+        # type: (str) -> Iterable[Location]
+        """Get the possible locations of a file, starting with its shard
+
+        When searching all shards, every key prefix the file may have had
+        with any number of key prefixes is searched in each backend.
+        """
+        name = posixpath.basename(uri)
+        shard_index, key_prefix = self._get_shard(name)
+        shard_key = _join(key_prefix, uri)
+        yield shard_index, shard_key
+        if not self._search_all_shards:
+            return
+
+        key_prefixes = [_format_key_prefix(p) for p in _iter_jump_buckets(_hash_name(name)[1], MAX_KEY_PREFIXES)]
+        keys = [shard_key] + [_join(p, uri) for p in reversed(key_prefixes) if p != key_prefix] + [uri]
+        for index in [shard_index] + [i for i in range(len(self._backends)) if i != shard_index]:
+            for key in keys:
+                if (index, key) != (shard_index, shard_key):
+                    yield index, key
+
+    def _fetch(self, target):
+        # type: (DownloadTarget) -> Tuple[Any, Optional[str], Optional[str]]
+        """Get a readable stream, MIME type and content encoding from a download target
+
+        Files are fetched from redirect URLs into a temporary file, which is
+        only kept in memory if small, as backends may need to seek or tell
+        the position of the stream they upload. The caller is responsible for
+        closing the returned stream.
+        """
+        if target.fileobj:
+            return target.fileobj, target.mimetype, target.content_encoding
+
+        buffer = tempfile.SpooledTemporaryFile(max_size=COPY_SPOOL_SIZE)
+        try:
+            with closing(urlopen(target.redirect_to, timeout=self._copy_timeout)) as response:
+                headers = response.info()
+                copyfileobj(response, buffer)
+            buffer.seek(0)
+        except Exception:
+            buffer.close()
+            raise
+        return buffer, headers.get('Content-Type'), headers.get('Content-Encoding')
+
+
+def _hash_name(name):
+    # type: (str) -> Tuple[int, int]
+    """Get two independent 64 bit hashes of a file name, for choosing its backend and key prefix
+    """
+    digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+    return int(digest[:16], 16), int(digest[16:], 16)
+
+
+def _iter_jump_buckets(key, num_buckets):
+    # type: (int, int) -> Iterable[int]
+    """Iterate over the buckets a key is assigned to by jump consistent hashing, with up to `num_buckets` buckets
+
+    The last bucket is the one for `num_buckets` buckets; Each previous
+    bucket is the one for all smaller numbers of buckets until the next.
+    See https://arxiv.org/abs/1406.2294
+    """
+    bucket, jump = -1, 0
+    while jump < num_buckets:
+        bucket = jump
+        yield bucket
+        key = (key * 2862933555777941757 + 1) & _UINT64_MASK
+        jump = int(float(bucket + 1) * (float(1 << 31) / float((key >> 33) + 1)))
+
+
+def _jump_hash(key, num_buckets):
+    # type: (int, int) -> int
+    """Get the bucket of a key using jump consistent hashing
+    """
+    bucket = 0
+    for bucket in _iter_jump_buckets(key, num_buckets):
+        pass
+    return bucket
+
+
+def _format_key_prefix(value):
+    # type: (int) -> str
+    return '{:02x}'.format(value)
+
+
+def _join(key_prefix, path):
+    # type: (Optional[str], Optional[str]) -> Optional[str]
+    """Join an optional key prefix and an optional path
+    """
+    if key_prefix and path:
+        return '{}/{}'.format(key_prefix, path)
+    return key_prefix or path
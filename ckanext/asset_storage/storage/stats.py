@@ -0,0 +1,107 @@
+"""Rolling latency and error statistics for storage operations
+"""
+import math
+import threading
+import time
+from collections import deque
+from typing import List, Optional, Sequence, Tuple
+
+monotonic = getattr(time, 'monotonic', time.time)
+
+# Latency percentiles reported by benchmarks and load tests
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(samples, pct):
+    # type: (Sequence[float], float) -> Optional[float]
+    """Get the nearest-rank percentile of a sequence of samples
+
+    Returns `None` if there are no samples
+    """
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = int(math.ceil(pct / 100.0 * len(ordered))) - 1
+    return ordered[max(0, min(rank, len(ordered) - 1))]
+
+
+class LatencySummary(object):
+    """Latency percentiles of a set of timed operations, e.g. in benchmark or load test results
+    """
+    def __init__(self, latencies):
+        # type: (List[float]) -> LatencySummary
+        self.latencies = latencies
+
+    def percentile(self, pct):
+        # type: (float) -> Optional[float]
+        return percentile(self.latencies, pct)
+
+    def percentiles(self):
+        # type: () -> List[Tuple[int, Optional[float]]]
+        """Get the reported percentiles, as `(percentile, latency)` pairs
+        """
+        return [(pct, self.percentile(pct)) for pct in PERCENTILES]
+
+    def format_percentiles(self):
+        # type: () -> str
+        return ', '.join('p{}: {}'.format(pct, '-' if value is None else '{:.2f}ms'.format(value * 1000))
+                         for pct, value in self.percentiles())
+
+
+class LatencyWindow(object):
+    """Keep track of the latency and errors of recent calls to a storage backend
+    """
+    def __init__(self, size=100):
+        # type: (int) -> LatencyWindow
+        self._samples = deque(maxlen=size)
+        self._last_error = None  # type: Optional[float]
+        self._consecutive_errors = 0
+        self._lock = threading.Lock()
+
+    def record(self, seconds):
+        # type: (float) -> None
+        """Record the latency of a successful call
+        """
+        with self._lock:
+            self._samples.append(seconds)
+            self._consecutive_errors = 0
+
+    def record_error(self):
+        # type: () -> None
+        """Record a failed call
+        """
+        with self._lock:
+            self._last_error = monotonic()
+            self._consecutive_errors += 1
+
+    @property
+    def count(self):
+        # type: () -> int
+        return len(self._samples)
+
+    @property
+    def consecutive_errors(self):
+        # type: () -> int
+        return self._consecutive_errors
+
+    def percentile(self, pct):
+        # type: (float) -> Optional[float]
+        with self._lock:
+            samples = list(self._samples)
+        return percentile(samples, pct)
+
+    def mean(self):
+        # type: () -> Optional[float]
+        with self._lock:
+            samples = list(self._samples)
+        if not samples:
+            return None
+        return sum(samples) / len(samples)
+
+    def seconds_since_error(self):
+        # type: () -> Optional[float]
+        """Get the number of seconds since the last recorded error, or `None` if no error was recorded
+        """
+        if self._last_error is None:
+            return None
+        return monotonic() - self._last_error
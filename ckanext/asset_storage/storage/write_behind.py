@@ -0,0 +1,549 @@
+import errno
+import hashlib
+import heapq
+import json
+import logging
+import os
+import posixpath
+import random
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from shutil import copyfileobj
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from ckanext.asset_storage import metrics
+from ckanext.asset_storage.storage import DownloadTarget, StorageBackend, exc, get_storages
+from ckanext.asset_storage.storage.stats import monotonic
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+_log = logging.getLogger(__name__)
+
+_DATA_SUFFIX = '.data'
+_ENTRY_SUFFIX = '.json'
+_TEMP_FILE_PREFIX = '.tmp-'
+_LOCK_DIR = '.locks'
+
+# Temporary files and files without an entry older than this are left over by crashed processes
+ORPHAN_MAX_AGE = 3600
+
+_RESCAN = object()
+
+# `os.replace` is not available in Python 2, but `os.rename` is atomic on POSIX systems
+_replace = getattr(os, 'replace', os.rename)
+
+
+class WriteBehindStorage(StorageBackend):
+    """A storage backend that writes files to a local spool, and pushes them to another backend in the background
+
+    Uploads complete as soon as the file is durably written to the spool, so
+    they are not slowed down by the latency of the wrapped backend. Files are
+    served from the spool until they have been pushed, after which they are
+    evicted from it. Pushes are retried with exponential backoff until they
+    succeed.
+
+    Deletes are spooled too, as tombstone entries which the workers apply to
+    the wrapped backend, so they do not wait for the wrapped backend or for
+    pushes in progress.
+
+    Spooled files survive restarts and crashes: when the spool is first used
+    by a process, it is scanned and all files in it are pushed. The spool may
+    be shared by all processes on a host; files are also periodically
+    rescanned, so files left over by a process which died are pushed by
+    another one. Workers are started lazily, and again in forked processes,
+    as threads do not survive forking.
+    """
+    def __init__(self, backend, spool_path, workers=2, backoff_base=1.0, backoff_max=60.0, rescan_interval=60):
+        # type: (Dict[str, Any], str, int, float, float, float) -> WriteBehindStorage
+        """Constructor for the write-behind storage backend
+
+        Args:
+            backend: The wrapped backend configuration, a dict with a `type` and `options` keys
+            spool_path: Local directory to spool files in. This should be on a local, persistent file system.
+            workers: Number of background threads pushing files to the wrapped backend
+            backoff_base: Base delay in seconds for exponential backoff between push attempts
+            backoff_max: Max delay in seconds between push attempts
+            rescan_interval: Interval in seconds between scans of the spool for files not pushed by their process,
+                or 0 to only scan the spool on start-up
+        """
+        self._backend = get_storages([backend])[0]
+        if _is_absolute_url(self._backend.get_storage_uri('asset', 'group')):
+            # Public URLs point straight at the wrapped backend, so spooled files would never be served
+            raise ValueError('Write-behind storage requires the wrapped backend to generate relative URIs, '
+                             'i.e. not to allow public access')
+        self._spool_path = spool_path
+        self._backoff_base = backoff_base
+        self._backoff_max = backoff_max
+        self._rescan_interval = rescan_interval
+        self._workers = workers
+        _ensure_dir(os.path.join(spool_path, _LOCK_DIR))
+
+        self._pid = None  # type: Optional[int]
+        self._start_lock = threading.Lock()
+        self._stopped = False
+        self._threads = []  # type: List[threading.Thread]
+        self._reset()
+
+    def get_storage_uri(self, name, prefix=None):
+        return self._backend.get_storage_uri(name, prefix)
+
+    def upload(self, stream, name, prefix=None, mimetype=None, content_encoding=None):
+        """Save the file in the spool, and schedule pushing it to the wrapped backend
+        """
+        self._ensure_started()
+        key = _spool_key(_join(prefix, name))
+        entry = {'id': uuid.uuid4().hex, 'name': name, 'prefix': prefix, 'mimetype': mimetype,
+                 'content_encoding': content_encoding}
+        data_temp, written = self._write_temp(lambda f: copyfileobj(stream, f))
+        try:
+            entry_temp, _ = self._write_temp(lambda f: f.write(json.dumps(entry).encode('utf-8')))
+        except Exception:
+            _remove_quietly(data_temp)
+            raise
+
+        with self._commit_lock.hold(key):
+            _replace(data_temp, self._path(key, _DATA_SUFFIX))
+            _replace(entry_temp, self._path(key, _ENTRY_SUFFIX))
+        _fsync_dir(self._spool_path)
+
+        metrics.incr('write_behind.spooled')
+        self._enqueue(key)
+        return written
+
+    def download(self, uri):
+        """Download the file from the spool if it has not been pushed yet, or from the wrapped backend
+        """
+        self._ensure_started()
+        key = _spool_key(uri)
+        entry = self._read_entry(key)
+        if entry is not None and entry.get('deleted'):
+            raise exc.ObjectNotFound('The requested file was deleted')
+        target = self._open_spooled(key, entry, uri) if entry is not None else None
+        if target is not None:
+            metrics.incr('write_behind.spool_hits')
+            return target
+        return self._backend.download(uri)
+
+    def delete(self, uri):
+        """Schedule deleting the file from the wrapped backend, and delete it from the spool
+
+        A tombstone entry replaces any spooled file, so the file is no longer
+        served; Workers then delete the file from the wrapped backend. This
+        does not wait for pushes in progress: a file being pushed is deleted
+        from the wrapped backend once pushed. Returns `True`, as whether the
+        file exists in the wrapped backend is not known yet.
+        """
+        self._ensure_started()
+        key = _spool_key(uri)
+        prefix, name = posixpath.split(uri)
+        entry = {'id': uuid.uuid4().hex, 'name': name, 'prefix': prefix or None, 'deleted': True}
+        entry_temp, _ = self._write_temp(lambda f: f.write(json.dumps(entry).encode('utf-8')))
+
+        with self._commit_lock.hold(key):
+            _replace(entry_temp, self._path(key, _ENTRY_SUFFIX))
+            _remove_quietly(self._path(key, _DATA_SUFFIX))
+        _fsync_dir(self._spool_path)
+
+        metrics.incr('write_behind.delete_spooled')
+        self._enqueue(key)
+        return True
+
+    def exists(self, uri):
+        self._ensure_started()
+        entry = self._read_entry(_spool_key(uri))
+        if entry is not None:
+            return not entry.get('deleted')
+        return self._backend.exists(uri)
+
+    def get_upload_target(self, name, prefix=None, mimetype=None, max_size=None, expires_in=3600):
+        return self._backend.get_upload_target(name, prefix, mimetype=mimetype, max_size=max_size,
+                                               expires_in=expires_in)
+
+    def iter_uris(self, prefix=None):
+        """List the URIs of files in the wrapped backend, and of files not pushed yet, except deleted files
+        """
+        self._ensure_started()
+        spooled, deleted = set(), set()
+        for uri, entry in self._iter_spooled_entries():
+            if _has_prefix(uri, prefix):
+                (deleted if entry.get('deleted') else spooled).add(uri)
+        for uri in self._backend.iter_uris(prefix):
+            if uri not in spooled and uri not in deleted:
+                yield uri
+        for uri in spooled:
+            yield uri
+
+    def update_cache_control(self, uri):
+        return self._backend.update_cache_control(uri)
+
+    def flush(self, timeout=None):
+        # type: (Optional[float]) -> bool
+        """Wait for all files spooled by this process to be pushed
+
+        Returns `False` if some files were still not pushed after `timeout` seconds
+        """
+        self._ensure_started()
+        deadline = None if timeout is None else monotonic() + timeout
+        with self._condition:
+            while self._pending:
+                remaining = None if deadline is None else deadline - monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+        return True
+
+    def close(self):
+        # type: () -> None
+        """Stop the background workers
+
+        Files which have not been pushed yet remain in the spool, and are
+        pushed when the spool is used again.
+        """
+        with self._condition:
+            self._stopped = True
+            self._condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+
+    def _reset(self):
+        """Reset the state of the workers, which is not valid in a forked process
+
+        Locks may have been held by threads of the parent process when it
+        forked, so these are replaced too.
+        """
+        lock_dir = os.path.join(self._spool_path, _LOCK_DIR)
+        self._commit_lock = _StripedLock(lock_dir, 'commit')
+        self._push_lock = _StripedLock(lock_dir, 'push')
+        self._queue = []  # type: List[Tuple[float, str]]
+        self._pending = set()  # type: Set[str]
+        self._attempts = {}  # type: Dict[str, int]
+        self._condition = threading.Condition()
+        self._last_scan = monotonic()
+
+    def _ensure_started(self):
+        """Start the workers on first use in a process, and recover spooled files
+
+        Workers are not started by the constructor, as the storage may be
+        created before a server forks its worker processes, e.g. when the
+        app is preloaded. If the process ID changes, this is a forked
+        process, in which threads of the parent do not exist.
+        """
+        pid = os.getpid()
+        if self._pid == pid or self._stopped:
+            return
+        if self._pid is not None:
+            self._start_lock = threading.Lock()
+        with self._start_lock:
+            if self._pid == pid:
+                return
+            if self._pid is not None:
+                _log.debug('Process forked, restarting write-behind workers')
+                self._reset()
+            self._pid = pid
+            self._recover()
+            self._threads = [threading.Thread(target=self._work, args=(pid, self._condition),
+                                              name='asset-storage-write-behind-{}'.format(i))
+                             for i in range(self._workers)]
+            for thread in self._threads:
+                thread.daemon = True
+                thread.start()
+
+    def _write_temp(self, write):
+        # type: (Callable[[Any], Any]) -> Tuple[str, int]
+        """Durably write a temporary file in the spool, and return its path and size
+        """
+        path = os.path.join(self._spool_path, '{}{}'.format(_TEMP_FILE_PREFIX, uuid.uuid4().hex))
+        try:
+            with open(path, 'wb') as f:
+                write(f)
+                f.flush()
+                os.fsync(f.fileno())
+                return path, f.tell()
+        except Exception:
+            _remove_quietly(path)
+            raise
+
+    def _open_spooled(self, key, entry, uri):
+        # type: (str, Dict[str, Any], str) -> Optional[DownloadTarget]
+        try:
+            fileobj = open(self._path(key, _DATA_SUFFIX), 'rb')
+        except (IOError, OSError):
+            # Evicted after being pushed
+            return None
+        return DownloadTarget(fileobj, posixpath.basename(uri), mimetype=entry.get('mimetype'),
+                              content_encoding=entry.get('content_encoding'))
+
+    def _enqueue(self, key, delay=0.0):
+        # type: (str, float) -> None
+        with self._condition:
+            self._pending.add(key)
+            heapq.heappush(self._queue, (monotonic() + delay, key))
+            metrics.gauge('write_behind.pending', len(self._pending))
+            self._condition.notify()
+
+    def _done(self, key):
+        # type: (str) -> None
+        with self._condition:
+            self._pending.discard(key)
+            self._attempts.pop(key, None)
+            metrics.gauge('write_behind.pending', len(self._pending))
+            self._condition.notify_all()
+
+    def _work(self, pid, condition):
+        # type: (int, threading.Condition) -> None
+        while True:
+            task = self._next_task(pid, condition)
+            if task is None:
+                return
+            elif task is _RESCAN:
+                self._scan(min_age=self._rescan_interval)
+            else:
+                self._push(task)
+
+    def _next_task(self, pid, condition):
+        # type: (int, threading.Condition) -> Any
+        """Wait for the next entry to push, or for the next scan of the spool
+
+        Returns `None` once the workers are stopped, or were started by
+        another process
+        """
+        with condition:
+            while not self._stopped and self._pid == pid:
+                now = monotonic()
+                if self._queue and self._queue[0][0] <= now:
+                    return heapq.heappop(self._queue)[1]
+                if self._rescan_interval and now - self._last_scan >= self._rescan_interval:
+                    self._last_scan = now
+                    return _RESCAN
+
+                timeouts = [self._queue[0][0] - now] if self._queue else []
+                if self._rescan_interval:
+                    timeouts.append(self._last_scan + self._rescan_interval - now)
+                condition.wait(min(timeouts) if timeouts else None)
+        return None
+
+    def _push(self, key):
+        # type: (str) -> None
+        start = monotonic()
+        try:
+            changed = self._push_entry(key)
+        except Exception as e:
+            with self._condition:
+                attempt = self._attempts.get(key, 0)
+                self._attempts[key] = attempt + 1
+            delay = self._backoff(attempt)
+            _log.warning('Failed to push spooled file %s (attempt %d), retrying in %.1f seconds: %s',
+                         key, attempt + 1, delay, e)
+            metrics.incr('write_behind.push_errors')
+            self._enqueue(key, delay)
+            return
+
+        if changed:
+            self._enqueue(key)
+        else:
+            metrics.timing('write_behind.push', monotonic() - start)
+            self._done(key)
+
+    def _push_entry(self, key):
+        # type: (str) -> bool
+        """Push a spooled file or delete to the wrapped backend, and evict it from the spool
+
+        Returns `True` if the file was replaced or deleted in the spool while
+        being pushed, in which case it needs to be pushed again.
+        """
+        with self._push_lock.hold(key):
+            with self._commit_lock.hold(key):
+                entry = self._read_entry(key)
+                if entry is None:
+                    # Already pushed by another process
+                    return False
+                stream = None if entry.get('deleted') else open(self._path(key, _DATA_SUFFIX), 'rb')
+
+            if stream is None:
+                self._backend.delete(_join(entry.get('prefix'), entry['name']))
+                metrics.incr('write_behind.deleted')
+            else:
+                with stream:
+                    self._backend.upload(stream, entry['name'], entry.get('prefix'), mimetype=entry.get('mimetype'),
+                                         content_encoding=entry.get('content_encoding'))
+                metrics.incr('write_behind.pushed')
+
+            with self._commit_lock.hold(key):
+                current = self._read_entry(key)
+                if current is not None and current.get('id') != entry.get('id'):
+                    return True
+                self._evict(key)
+        return False
+
+    def _evict(self, key):
+        # type: (str) -> bool
+        """Remove an entry from the spool, returning `True` if it existed
+        """
+        try:
+            os.unlink(self._path(key, _ENTRY_SUFFIX))
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+            return False
+        _remove_quietly(self._path(key, _DATA_SUFFIX))
+        return True
+
+    def _recover(self):
+        """Clean up files left over by crashed processes, and schedule pushing all spooled files
+        """
+        now = time.time()
+        names = set(os.listdir(self._spool_path))
+        for name in names:
+            orphan = name.startswith(_TEMP_FILE_PREFIX) or (
+                name.endswith(_DATA_SUFFIX) and name[:-len(_DATA_SUFFIX)] + _ENTRY_SUFFIX not in names)
+            if orphan and now - _mtime(os.path.join(self._spool_path, name), now) > ORPHAN_MAX_AGE:
+                _log.info('Removing orphaned spool file %s', name)
+                _remove_quietly(os.path.join(self._spool_path, name))
+
+        recovered = self._scan()
+        if recovered:
+            _log.info('Recovered %d spooled files to push', recovered)
+
+    def _scan(self, min_age=0):
+        # type: (float) -> int
+        """Schedule pushing spooled files at least `min_age` seconds old, which are not already scheduled
+
+        Returns the number of newly scheduled files
+        """
+        now = time.time()
+        scheduled = 0
+        for key in self._iter_keys():
+            with self._condition:
+                if key in self._pending:
+                    continue
+            if now - _mtime(self._path(key, _ENTRY_SUFFIX), now) >= min_age:
+                self._enqueue(key)
+                scheduled += 1
+        return scheduled
+
+    def _iter_keys(self):
+        # type: () -> Iterable[str]
+        for name in os.listdir(self._spool_path):
+            if name.endswith(_ENTRY_SUFFIX) and not name.startswith('.'):
+                yield name[:-len(_ENTRY_SUFFIX)]
+
+    def _iter_spooled_entries(self):
+        # type: () -> Iterable[Tuple[str, Dict[str, Any]]]
+        for key in self._iter_keys():
+            entry = self._read_entry(key)
+            if entry is not None:
+                yield _join(entry.get('prefix'), entry['name']), entry
+
+    def _read_entry(self, key):
+        # type: (str) -> Optional[Dict[str, Any]]
+        try:
+            with open(self._path(key, _ENTRY_SUFFIX), 'rb') as f:
+                return json.loads(f.read().decode('utf-8'))
+        except (IOError, OSError):
+            return None
+
+    def _path(self, key, suffix):
+        # type: (str, str) -> str
+        return os.path.join(self._spool_path, key + suffix)
+
+    def _backoff(self, attempt):
+        # type: (int) -> float
+        """Get a random delay before retrying, using exponential backoff with "full jitter"
+        """
+        return random.uniform(0, min(self._backoff_max, self._backoff_base * 2 ** attempt))
+
+
+class _StripedLock(object):
+    """Exclusive locks on spool entries, shared by all threads and processes using the spool
+
+    Entries are locked in 256 stripes, each locked using a lock file. Locks
+    are only shared across processes where `fcntl.flock()` is available.
+    """
+    def __init__(self, lock_dir, name):
+        # type: (str, str) -> _StripedLock
+        self._lock_dir = lock_dir
+        self._name = name
+        self._locks = [threading.Lock() for _ in range(256)]
+
+    @contextmanager
+    def hold(self, key):
+        # type: (str) -> Iterator[None]
+        stripe = key[:2]
+        with self._locks[int(stripe, 16)]:
+            if fcntl is None:
+                yield
+                return
+
+            fd = os.open(os.path.join(self._lock_dir, '{}-{}.lock'.format(self._name, stripe)),
+                         os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(fd)
+
+
+def _spool_key(uri):
+    # type: (str) -> str
+    return hashlib.sha1(uri.encode('utf-8')).hexdigest()
+
+
+def _is_absolute_url(uri):
+    # type: (str) -> bool
+    return uri.startswith(('http://', 'https://'))
+
+
+def _join(prefix, name):
+    # type: (Optional[str], str) -> str
+    return '{}/{}'.format(prefix, name) if prefix else name
+
+
+def _has_prefix(uri, prefix):
+    # type: (str, Optional[str]) -> bool
+    return not prefix or uri.startswith(prefix.rstrip('/') + '/')
+
+
+def _mtime(path, default):
+    # type: (str, float) -> float
+    try:
+        return os.path.getmtime(path)
+    except OSError:
+        return default
+
+
+def _ensure_dir(path):
+    # type: (str) -> None
+    try:
+        os.makedirs(path)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+
+
+def _fsync_dir(path):
+    # type: (str) -> None
+    """Make renames in a directory durable
+    """
+    try:
+        fd = os.open(path, os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def _remove_quietly(path):
+    # type: (str) -> None
+    try:
+        os.unlink(path)
+    except OSError:
+        pass
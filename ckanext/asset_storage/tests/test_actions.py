@@ -0,0 +1,142 @@
+"""Tests for the actions module
+"""
+import json
+import posixpath
+
+import pytest
+from ckan import model
+from ckan.plugins import toolkit
+from ckan.tests import factories
+from ckan.tests import helpers as test_helpers
+from six import BytesIO
+from werkzeug.datastructures import FileStorage
+
+from ckanext.asset_storage import uploader
+from ckanext.asset_storage.storage.local import LocalStorage
+
+
+def _image_file(filename='logo.png', content=b'\x89PNG\r\n\x1a\n'):
+    return FileStorage(name='file', filename=filename, stream=BytesIO(content))
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+def test_upload_batch(storage_path, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, uploader.CONF_BACKEND_CONFIG, {'storage_path': str(storage_path)})
+    sysadmin = factories.Sysadmin()
+    org = factories.Organization()
+    group = factories.Group()
+
+    result = test_helpers.call_action('asset_storage_upload_batch',
+                                      context={'user': sysadmin['name']},
+                                      items=json.dumps([{'id': org['id'], 'file': 'file_0'},
+                                                        {'id': group['name'], 'file': 'file_1'},
+                                                        {'id': 'no-such-group', 'file': 'file_0'},
+                                                        {'id': group['id']}]),
+                                      file_0=_image_file(),
+                                      file_1=_image_file('other.png'))
+
+    assert 2 == result['uploaded']
+    assert 2 == result['failed']
+    assert [True, True, False, False] == [r['success'] for r in result['results']]
+    assert 'Group not found' == result['results'][2]['error']
+
+    org_url = result['results'][0]['image_url']
+    assert org_url.endswith('-logo.png')
+    assert org_url == test_helpers.call_action('organization_show', id=org['id'])['image_url']
+    assert result['results'][1]['image_url'] == test_helpers.call_action('group_show', id=group['id'])['image_url']
+
+
+def _stored_name(image_url):
+    return 'group/' + posixpath.basename(image_url)
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+def test_upload_batch_deletes_previous_image(storage_path, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, uploader.CONF_BACKEND_CONFIG, {'storage_path': str(storage_path)})
+    backend = LocalStorage(str(storage_path))
+    sysadmin = factories.Sysadmin()
+    org = factories.Organization()
+
+    results = []
+    for filename in ('old.png', 'new.png'):
+        result = test_helpers.call_action('asset_storage_upload_batch', context={'user': sysadmin['name']},
+                                          items=[{'id': org['id'], 'file': 'file_0'}], file_0=_image_file(filename))
+        results.append(result['results'][0]['image_url'])
+
+    assert not backend.exists(_stored_name(results[0]))
+    assert backend.exists(_stored_name(results[1]))
+    assert results[1] == test_helpers.call_action('organization_show', id=org['id'])['image_url']
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+def test_upload_batch_commit_failure_deletes_new_images(storage_path, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, uploader.CONF_BACKEND_CONFIG, {'storage_path': str(storage_path)})
+    sysadmin = factories.Sysadmin()
+    group = factories.Group()
+
+    def failing_commit():
+        raise RuntimeError('The database is unavailable')
+
+    monkeypatch.setattr(model.repo, 'commit', failing_commit)
+    result = test_helpers.call_action('asset_storage_upload_batch', context={'user': sysadmin['name']},
+                                      items=[{'id': group['id'], 'file': 'file_0'}], file_0=_image_file())
+    monkeypatch.undo()
+
+    assert 0 == result['uploaded']
+    assert 'Failed to update group' == result['results'][0]['error']
+    assert [] == list(LocalStorage(str(storage_path)).iter_uris('group'))
+    assert not test_helpers.call_action('group_show', id=group['id'])['image_url']
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+def test_upload_batch_failure_keeps_previous_images(storage_path, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, uploader.CONF_BACKEND_CONFIG, {'storage_path': str(storage_path)})
+    backend = LocalStorage(str(storage_path))
+    sysadmin = factories.Sysadmin()
+    group = factories.Group()
+    org = factories.Organization()
+
+    old_url = test_helpers.call_action('asset_storage_upload_batch', context={'user': sysadmin['name']},
+                                       items=[{'id': group['id'], 'file': 'file_0'}],
+                                       file_0=_image_file('old.png'))['results'][0]['image_url']
+
+    get_action = toolkit.get_action
+
+    def failing_get_action(name):
+        if name == 'organization_patch':
+            raise RuntimeError('The database is unavailable')
+        return get_action(name)
+
+    monkeypatch.setattr(toolkit, 'get_action', failing_get_action)
+    result = test_helpers.call_action('asset_storage_upload_batch', context={'user': sysadmin['name']},
+                                      items=[{'id': group['id'], 'file': 'file_0'},
+                                             {'id': org['id'], 'file': 'file_1'}],
+                                      file_0=_image_file('new.png'), file_1=_image_file('org.png'))
+    monkeypatch.undo()
+
+    assert 0 == result['uploaded']
+    assert backend.exists(_stored_name(old_url))
+    assert [_stored_name(old_url)] == list(backend.iter_uris('group'))
+    assert old_url == test_helpers.call_action('group_show', id=group['id'])['image_url']
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+def test_upload_batch_requires_items():
+    sysadmin = factories.Sysadmin()
+    with pytest.raises(test_helpers.logic.ValidationError):
+        test_helpers.call_action('asset_storage_upload_batch', context={'user': sysadmin['name']}, items=[])
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+def test_upload_batch_sysadmin_only():
+    user = factories.User()
+    org = factories.Organization(user=user)
+    with pytest.raises(test_helpers.logic.NotAuthorized):
+        test_helpers.call_auth('asset_storage_upload_batch', {'user': user['name'], 'model': None},
+                               items=[{'id': org['id'], 'url': 'https://example.com/logo.png'}])
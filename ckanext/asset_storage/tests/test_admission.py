@@ -0,0 +1,119 @@
+"""Tests for upload admission control
+"""
+import threading
+
+import pytest
+
+from ckanext.asset_storage import admission
+from ckanext.asset_storage.admission import AdmissionController, AdmissionRejected, HostSlots
+from ckanext.asset_storage.storage.stats import monotonic
+
+requires_fcntl = pytest.mark.skipif(admission.fcntl is None, reason='Host-wide limits require fcntl')
+
+
+def _hold(controller, entered, release):
+    """Hold an upload slot in a background thread until `release` is set
+    """
+    def run():
+        with controller.admit():
+            entered.set()
+            release.wait(5)
+
+    thread = threading.Thread(target=run)
+    thread.start()
+    assert entered.wait(5)
+    return thread
+
+
+def test_unlimited_admits_immediately():
+    controller = AdmissionController()
+    with controller.admit():
+        with controller.admit():
+            pass
+
+
+def test_waiting_upload_is_admitted_when_slot_is_released():
+    controller = AdmissionController(max_concurrent=1, max_queued=1, timeout=5)
+    release = threading.Event()
+    thread = _hold(controller, threading.Event(), release)
+
+    threading.Timer(0.1, release.set).start()
+    start = monotonic()
+    with controller.admit():
+        assert monotonic() - start >= 0.05
+    thread.join()
+
+
+def test_rejected_after_timeout():
+    controller = AdmissionController(max_concurrent=1, max_queued=1, timeout=0.1)
+    release = threading.Event()
+    thread = _hold(controller, threading.Event(), release)
+    try:
+        with pytest.raises(AdmissionRejected):
+            with controller.admit():
+                pass
+    finally:
+        release.set()
+        thread.join()
+
+    # Slot was released and can be used again
+    with controller.admit():
+        pass
+
+
+def test_rejected_immediately_when_queue_is_full():
+    controller = AdmissionController(max_concurrent=1, max_queued=0, timeout=5)
+    release = threading.Event()
+    thread = _hold(controller, threading.Event(), release)
+    try:
+        start = monotonic()
+        with pytest.raises(AdmissionRejected):
+            with controller.admit():
+                pass
+        assert monotonic() - start < 1
+    finally:
+        release.set()
+        thread.join()
+
+
+def test_slot_released_on_error():
+    controller = AdmissionController(max_concurrent=1, max_queued=0, timeout=0.1)
+    with pytest.raises(ValueError):
+        with controller.admit():
+            raise ValueError('upload failed')
+    with controller.admit():
+        pass
+
+
+def test_wait_time_is_reported(monkeypatch):
+    timings = []
+    monkeypatch.setattr(admission.metrics, 'timing', lambda name, value: timings.append(name))
+    with AdmissionController(max_concurrent=1).admit():
+        pass
+    assert ['admission.wait'] == timings
+
+
+@requires_fcntl
+def test_host_slots_are_exclusive(tmpdir):
+    slots = HostSlots(str(tmpdir), 2)
+    deadline = monotonic() + 0.1
+    with slots.acquire(deadline):
+        with slots.acquire(deadline):
+            with pytest.raises(AdmissionRejected):
+                with slots.acquire(deadline):
+                    pass
+        # A slot was released
+        with slots.acquire(deadline):
+            pass
+
+
+@requires_fcntl
+def test_host_limit_applies_across_controllers(tmpdir):
+    first = AdmissionController(timeout=0.1, host_max_concurrent=1, host_lock_dir=str(tmpdir))
+    second = AdmissionController(timeout=0.1, host_max_concurrent=1, host_lock_dir=str(tmpdir))
+    with first.admit():
+        with pytest.raises(AdmissionRejected):
+            with second.admit():
+                pass
+    with second.admit():
+        pass
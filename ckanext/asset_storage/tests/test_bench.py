@@ -0,0 +1,62 @@
+"""Tests for the benchmark module
+"""
+import pytest
+from six import BytesIO
+
+from ckanext.asset_storage import bench
+from ckanext.asset_storage.storage.local import LocalStorage
+
+
+class InterruptingStorage(LocalStorage):
+    """Local storage which is interrupted after a number of uploads
+    """
+    def __init__(self, storage_path, interrupt_after):
+        super(InterruptingStorage, self).__init__(storage_path)
+        self._uploads_left = interrupt_after
+
+    def upload(self, stream, name, prefix=None, mimetype=None, content_encoding=None):
+        if self._uploads_left <= 0:
+            raise KeyboardInterrupt()
+        self._uploads_left -= 1
+        return super(InterruptingStorage, self).upload(stream, name, prefix, mimetype, content_encoding)
+
+
+def test_benchmark_results(storage_path):
+    storage = LocalStorage(storage_path=storage_path)
+    benchmark = bench.Benchmark(storage, [16, 1024], count=5, concurrency=2)
+    results = benchmark.run()
+
+    assert [('upload', 16), ('download', 16), ('delete', 16),
+            ('upload', 1024), ('download', 1024), ('delete', 1024)] == [(r.operation, r.size) for r in results]
+    for result in results:
+        assert 5 == len(result.latencies)
+        assert 0 == result.errors
+        assert result.percentile(99) is not None
+        assert {'operation', 'size', 'count', 'errors', 'elapsed', 'throughput', 'p50', 'p95', 'p99'} == \
+            set(result.as_dict())
+
+
+def test_benchmark_cleans_up(storage_path):
+    storage = LocalStorage(storage_path=storage_path)
+    storage.upload(BytesIO(b'content'), 'existing-file.txt', 'group')
+    bench.Benchmark(storage, [16], count=5, prefix='scratch').run()
+    assert ['group/existing-file.txt'] == list(storage.iter_uris())
+
+
+def test_benchmark_cleans_up_when_interrupted(storage_path):
+    storage = InterruptingStorage(storage_path, interrupt_after=3)
+    benchmark = bench.Benchmark(storage, [16], count=10, concurrency=1)
+    with pytest.raises(KeyboardInterrupt):
+        benchmark.run()
+    assert [] == list(storage.iter_uris())
+
+
+def test_benchmark_counts_errors(storage_path):
+    class FailingDeleteStorage(LocalStorage):
+        def delete(self, uri):
+            raise IOError('Failed')
+
+    storage = FailingDeleteStorage(storage_path=storage_path)
+    results = bench.Benchmark(storage, [16], count=3).run()
+    assert 3 == results[-1].errors
+    assert 0 == len(results[-1].latencies)
@@ -0,0 +1,171 @@
+"""Tests for the blueprints module
+"""
+import pytest
+from ckan.tests import factories
+from six import BytesIO
+
+from ckanext.asset_storage import blueprints, direct_upload, uploader
+from ckanext.asset_storage.storage import UploadTarget
+from ckanext.asset_storage.storage.local import LocalStorage
+
+DIRECT_UPLOAD_BACKEND = 'ckanext.asset_storage.tests.test_blueprints:DirectUploadStorage'
+
+RESOURCE_CONTENT = b'name,value\nfoo,1\nbar,2\n'
+
+
+class DirectUploadStorage(LocalStorage):
+    """A local storage backend which provides (fake) direct upload targets
+    """
+    def get_upload_target(self, name, prefix=None, mimetype=None, max_size=None, expires_in=3600):
+        headers = {'Content-Type': mimetype, 'x-max-size': str(max_size)}
+        return UploadTarget('https://storage.example.com/{}/{}'.format(prefix, name), 'PUT', headers)
+
+
+@pytest.fixture()
+def direct_upload_config(storage_path, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, uploader.CONF_BACKEND_TYPE, DIRECT_UPLOAD_BACKEND)
+    monkeypatch.setitem(ckan_config, uploader.CONF_BACKEND_CONFIG, {'storage_path': str(storage_path)})
+    monkeypatch.setitem(ckan_config, uploader.CONF_DIRECT_UPLOADS, 'true')
+    monkeypatch.setitem(ckan_config, 'SECRET_KEY', 'not-so-secret')
+
+
+def _request_upload_url(app, user, **data):
+    return app.post('/asset-storage/upload-url', data=data, extra_environ={'REMOTE_USER': str(user['name'])})
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'direct_upload_config')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+def test_upload_url(app):
+    user = factories.User()
+    response = _request_upload_url(app, user, object_type='group', filename='my logo.png')
+    assert 200 == response.status_code
+
+    result = response.json
+    assert 'PUT' == result['method']
+    assert result['url'].startswith('https://storage.example.com/group/')
+    assert 'image/png' == result['headers']['Content-Type']
+    assert str(2 * uploader.MB) == result['headers']['x-max-size']
+    assert blueprints.DIRECT_UPLOAD_EXPIRES_IN == result['expires_in']
+
+    name = direct_upload.verify_token('not-so-secret', 'group', result['token'])
+    assert name.endswith('-my-logo.png')
+    assert result['url'].endswith('/' + name)
+    assert result['uri'].endswith('/uploads/group/' + name)
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'direct_upload_config')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+@pytest.mark.parametrize('data', [
+    {'object_type': 'dataset', 'filename': 'logo.png'},
+    {'object_type': 'group'},
+    {'object_type': 'group', 'filename': 'script.js'},
+    {'object_type': 'group', 'filename': 'no-extension'},
+    {'object_type': 'group', 'filename': 'logo.png', 'mimetype': 'text/html'},
+])
+def test_upload_url_invalid_request(app, data):
+    user = factories.User()
+    assert 400 == _request_upload_url(app, user, **data).status_code
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'direct_upload_config')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+def test_upload_url_admin_assets_sysadmin_only(app):
+    user = factories.User()
+    assert 403 == _request_upload_url(app, user, object_type='admin', filename='logo.png').status_code
+    sysadmin = factories.Sysadmin()
+    assert 200 == _request_upload_url(app, sysadmin, object_type='admin', filename='logo.png').status_code
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+def test_upload_url_disabled(app):
+    user = factories.User()
+    assert 404 == _request_upload_url(app, user, object_type='group', filename='logo.png').status_code
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'direct_upload_config')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+def test_upload_url_unsupported_backend(app, storage_path, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, uploader.CONF_BACKEND_TYPE, 'local')
+    user = factories.User()
+    assert 400 == _request_upload_url(app, user, object_type='group', filename='logo.png').status_code
+
+
+@pytest.fixture()
+def resource_uploads_config(storage_path, ckan_config, monkeypatch):
+    monkeypatch.setitem(ckan_config, uploader.CONF_BACKEND_TYPE, 'local')
+    monkeypatch.setitem(ckan_config, uploader.CONF_BACKEND_CONFIG, {'storage_path': str(storage_path)})
+    monkeypatch.setitem(ckan_config, uploader.CONF_RESOURCE_UPLOADS, 'true')
+
+
+@pytest.fixture()
+def uploaded_resource(storage_path, resource_uploads_config):
+    resource = factories.Resource(url='data.csv', url_type='upload')
+    LocalStorage(str(storage_path)).upload(BytesIO(RESOURCE_CONTENT), 'data.csv', 'resources/' + resource['id'])
+    return resource
+
+
+def _resource_download_url(resource, filename='data.csv'):
+    return '/dataset/{}/resource/{}/download/{}'.format(resource['package_id'], resource['id'], filename)
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'resource_uploads_config')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+def test_resource_download(app, uploaded_resource):
+    response = app.get(_resource_download_url(uploaded_resource))
+    assert 200 == response.status_code
+    assert RESOURCE_CONTENT == response.data
+    assert 'bytes' == response.headers['Accept-Ranges']
+
+    # The stored file name is used, whatever file name was requested
+    assert RESOURCE_CONTENT == app.get(_resource_download_url(uploaded_resource, 'other.csv')).data
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'resource_uploads_config')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+def test_resource_download_range(app, uploaded_resource):
+    response = app.get(_resource_download_url(uploaded_resource), headers={'Range': 'bytes=4-7'})
+    assert 206 == response.status_code
+    assert RESOURCE_CONTENT[4:8] == response.data
+    assert 'bytes 4-7/{}'.format(len(RESOURCE_CONTENT)) == response.headers['Content-Range']
+
+    response = app.get(_resource_download_url(uploaded_resource),
+                       headers={'Range': 'bytes={}-'.format(len(RESOURCE_CONTENT))})
+    assert 416 == response.status_code
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'resource_uploads_config')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+def test_resource_download_conditional(app, uploaded_resource):
+    response = app.get(_resource_download_url(uploaded_resource))
+    etag = response.headers['ETag']
+    last_modified = response.headers['Last-Modified']
+
+    assert 304 == app.get(_resource_download_url(uploaded_resource), headers={'If-None-Match': etag}).status_code
+    assert 304 == app.get(_resource_download_url(uploaded_resource),
+                          headers={'If-Modified-Since': last_modified}).status_code
+
+    # A range is only served if the file has not changed since the client got its validator
+    response = app.get(_resource_download_url(uploaded_resource), headers={'Range': 'bytes=0-3', 'If-Range': etag})
+    assert 206 == response.status_code
+    response = app.get(_resource_download_url(uploaded_resource),
+                       headers={'Range': 'bytes=0-3', 'If-Range': '"outdated"'})
+    assert 200 == response.status_code
+    assert RESOURCE_CONTENT == response.data
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'resource_uploads_config')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+def test_resource_download_private_dataset(app, storage_path):
+    organization = factories.Organization()
+    dataset = factories.Dataset(owner_org=organization['id'], private=True)
+    resource = factories.Resource(package_id=dataset['id'], url='data.csv', url_type='upload')
+    LocalStorage(str(storage_path)).upload(BytesIO(RESOURCE_CONTENT), 'data.csv', 'resources/' + resource['id'])
+    assert 404 == app.get(_resource_download_url(resource)).status_code
+
+
+@pytest.mark.usefixtures('clean_db', 'with_plugins', 'resource_uploads_config')
+@pytest.mark.ckan_config('ckan.plugins', 'asset_storage')
+def test_resource_files_not_served_as_assets(app, uploaded_resource):
+    response = app.get('/uploads/resources/{}/data.csv'.format(uploaded_resource['id']))
+    assert 404 == response.status_code
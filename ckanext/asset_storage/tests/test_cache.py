@@ -0,0 +1,86 @@
+"""Tests for the in-memory asset cache
+"""
+import hashlib
+
+from ckanext.asset_storage import cache
+from ckanext.asset_storage.cache import AssetCache
+
+
+def test_cache_get_set():
+    c = AssetCache(max_size=1024)
+    asset = c.set('group/logo.png', b'content', 'image/png')
+    assert asset is c.get('group/logo.png')
+    assert b'content' == asset.content
+    assert 'image/png' == asset.mimetype
+    assert hashlib.md5(b'content').hexdigest() == asset.etag
+    assert 7 == c.size
+
+
+def test_cache_miss():
+    c = AssetCache(max_size=1024)
+    assert c.get('group/logo.png') is None
+
+
+def test_cache_item_too_large():
+    c = AssetCache(max_size=1024, max_item_size=4)
+    assert c.set('group/logo.png', b'content') is None
+    assert c.get('group/logo.png') is None
+    assert 0 == c.size
+
+
+def test_cache_evicts_least_recently_used():
+    c = AssetCache(max_size=10)
+    c.set('a', b'aaaa')
+    c.set('b', b'bbbb')
+    c.get('a')
+    c.set('c', b'cccc')
+    assert c.get('a') is not None
+    assert c.get('b') is None
+    assert c.get('c') is not None
+    assert 8 == c.size
+
+
+def test_cache_replace_updates_size():
+    c = AssetCache(max_size=100)
+    c.set('a', b'aaaa')
+    c.set('a', b'aa')
+    assert 2 == c.size
+    assert 1 == len(c)
+
+
+def test_cache_invalidate():
+    c = AssetCache(max_size=100)
+    c.set('a', b'aaaa')
+    c.invalidate('a')
+    c.invalidate('not-cached')
+    assert c.get('a') is None
+    assert 0 == c.size
+
+
+def test_cache_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache, 'monotonic', lambda: now[0])
+    c = AssetCache(max_size=100, ttl=10)
+    c.set('a', b'aaaa')
+    now[0] += 5
+    assert c.get('a') is not None
+    now[0] += 6
+    assert c.get('a') is None
+    assert 0 == c.size
+
+
+def test_cache_no_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache, 'monotonic', lambda: now[0])
+    c = AssetCache(max_size=100, ttl=None)
+    c.set('a', b'aaaa')
+    now[0] += 100000
+    assert c.get('a') is not None
+
+
+def test_cache_clear():
+    c = AssetCache(max_size=100)
+    c.set('a', b'aaaa')
+    c.clear()
+    assert 0 == len(c)
+    assert 0 == c.size
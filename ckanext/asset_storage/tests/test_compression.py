@@ -0,0 +1,85 @@
+"""Tests for the compression module
+"""
+import gzip
+
+import pytest
+from six import BytesIO
+
+from ckanext.asset_storage import compression
+
+
+@pytest.mark.parametrize('mimetype,expected', [
+    ('image/svg+xml', True),
+    ('text/plain', True),
+    ('application/json', True),
+    ('image/png', False),
+    ('image/jpeg', False),
+    (None, False),
+])
+def test_is_compressible(mimetype, expected):
+    assert expected == compression.is_compressible(mimetype)
+
+
+def test_variant_name():
+    assert 'group/logo.svg.gz' == compression.variant_name('group/logo.svg', 'gzip')
+    assert 'group/logo.svg.br' == compression.variant_name('group/logo.svg', 'br')
+
+
+def test_gzip_compress():
+    content = b'<svg xmlns="http://www.w3.org/2000/svg"></svg>' * 20
+    compressed = compression.compress(content, 'gzip')
+    assert len(compressed) < len(content)
+    assert gzip.GzipFile(fileobj=BytesIO(compressed)).read() == content
+
+
+def test_gzip_compress_is_deterministic():
+    content = b'<svg xmlns="http://www.w3.org/2000/svg"></svg>' * 20
+    assert compression.compress(content, 'gzip') == compression.compress(content, 'gzip')
+
+
+def test_compress_unsupported_encoding():
+    with pytest.raises(ValueError):
+        compression.compress(b'content', 'compress')
+
+
+@pytest.mark.parametrize('accept_encoding,expected', [
+    ('gzip, deflate', ['gzip']),
+    ('deflate', []),
+    ('gzip;q=0', []),
+    ('*', compression.available_encodings()),
+    ('*, gzip;q=0', [e for e in compression.available_encodings() if e != 'gzip']),
+    ('br;q=1.0, gzip;q=0.8', compression.available_encodings()),
+    ('GZIP', ['gzip']),
+    ('', []),
+    (None, []),
+])
+def test_accepted_encodings(accept_encoding, expected):
+    assert expected == compression.accepted_encodings(accept_encoding)
+
+
+def test_missing_variants(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(compression, 'monotonic', lambda: now[0])
+    missing = compression.MissingVariants(ttl=10)
+    assert 'group/logo.svg.br' not in missing
+    missing.add('group/logo.svg.br')
+    assert 'group/logo.svg.br' in missing
+    now[0] += 11
+    assert 'group/logo.svg.br' not in missing
+
+
+def test_missing_variants_discard():
+    missing = compression.MissingVariants()
+    missing.add('group/logo.svg.br')
+    missing.discard('group/logo.svg.br')
+    missing.discard('group/other.svg.br')
+    assert 'group/logo.svg.br' not in missing
+
+
+def test_missing_variants_is_bounded():
+    missing = compression.MissingVariants(max_items=2)
+    for uri in ('a.br', 'b.br', 'c.br'):
+        missing.add(uri)
+    assert 'a.br' not in missing
+    assert 'b.br' in missing
+    assert 'c.br' in missing
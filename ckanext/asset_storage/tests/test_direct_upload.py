@@ -0,0 +1,45 @@
+"""Tests for the direct_upload module
+"""
+from ckanext.asset_storage import direct_upload
+
+SECRET = 'not-so-secret'
+
+
+def test_create_and_verify_token():
+    token = direct_upload.create_token(SECRET, 'group', 'logo.png', now=1000)
+    assert 'logo.png' == direct_upload.verify_token(SECRET, 'group', token, now=1000)
+
+
+def test_name_with_colons():
+    token = direct_upload.create_token(SECRET, 'group', '2020-01-01 10:00:00-logo.png', now=1000)
+    assert '2020-01-01 10:00:00-logo.png' == direct_upload.verify_token(SECRET, 'group', token, now=1000)
+
+
+def test_expired_token():
+    token = direct_upload.create_token(SECRET, 'group', 'logo.png', expires_in=60, now=1000)
+    assert 'logo.png' == direct_upload.verify_token(SECRET, 'group', token, now=1060)
+    assert direct_upload.verify_token(SECRET, 'group', token, now=1061) is None
+
+
+def test_tampered_token():
+    token = direct_upload.create_token(SECRET, 'group', 'logo.png', now=1000)
+    expires_at, signature, _ = token.split(':', 2)
+    assert direct_upload.verify_token(SECRET, 'group', '{}:{}:other.png'.format(expires_at, signature),
+                                      now=1000) is None
+    assert direct_upload.verify_token(SECRET, 'group', '9999999999:{}:logo.png'.format(signature),
+                                      now=1000) is None
+
+
+def test_wrong_object_type():
+    token = direct_upload.create_token(SECRET, 'group', 'logo.png', now=1000)
+    assert direct_upload.verify_token(SECRET, 'admin', token, now=1000) is None
+
+
+def test_wrong_secret():
+    token = direct_upload.create_token(SECRET, 'group', 'logo.png', now=1000)
+    assert direct_upload.verify_token('other-secret', 'group', token, now=1000) is None
+
+
+def test_malformed_token():
+    assert direct_upload.verify_token(SECRET, 'group', 'garbage', now=1000) is None
+    assert direct_upload.verify_token(SECRET, 'group', None, now=1000) is None
@@ -0,0 +1,81 @@
+"""Tests for the helpers module
+"""
+import pytest
+from six import BytesIO
+
+from ckanext.asset_storage import cache, helpers, placeholders, uploader
+from ckanext.asset_storage.storage.local import LocalStorage
+
+METADATA = {'width': 64, 'height': 48, 'color': '#c81e1e', 'placeholder': 'data:image/jpeg;base64,'}
+
+
+@pytest.fixture()
+def storage(storage_path, ckan_config, monkeypatch):
+    monkeypatch.setattr(uploader, '_instances', {})
+    monkeypatch.setitem(ckan_config, uploader.CONF_BACKEND_TYPE, 'local')
+    monkeypatch.setitem(ckan_config, uploader.CONF_BACKEND_CONFIG, {'storage_path': str(storage_path)})
+    monkeypatch.setitem(ckan_config, uploader.CONF_PLACEHOLDERS, 'true')
+    return LocalStorage(str(storage_path))
+
+
+def _upload_metadata(storage, uri):
+    storage.upload(BytesIO(b'{"width": 64, "height": 48, "color": "#c81e1e", '
+                           b'"placeholder": "data:image/jpeg;base64,"}'),
+                   placeholders.metadata_name(uri))
+
+
+def test_image_placeholder(storage, storage_path):
+    _upload_metadata(storage, 'group/logo.png')
+    assert METADATA == helpers.image_placeholder('http://localhost:5000/uploads/group/logo.png')
+
+    # Metadata is cached
+    (storage_path / 'group' / 'logo.png.meta.json').unlink()
+    assert METADATA == helpers.image_placeholder('https://storage.example.com/bucket/group/logo.png')
+
+
+def test_image_placeholder_disabled(storage, ckan_config, monkeypatch):
+    _upload_metadata(storage, 'group/logo.png')
+    monkeypatch.setitem(ckan_config, uploader.CONF_PLACEHOLDERS, 'false')
+    assert helpers.image_placeholder('http://localhost:5000/uploads/group/logo.png') is None
+
+
+@pytest.mark.parametrize('image_url', [
+    None,
+    '',
+    'https://example.com/logo.png',
+    'http://localhost:5000/uploads/dataset/logo.png',
+])
+def test_image_placeholder_not_uploaded(storage, image_url):
+    assert helpers.image_placeholder(image_url) is None
+
+
+def test_image_placeholder_missing_metadata_is_cached_briefly(storage, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache, 'monotonic', lambda: now[0])
+    url = 'http://localhost:5000/uploads/group/logo.png'
+    assert helpers.image_placeholder(url) is None
+
+    _upload_metadata(storage, 'group/logo.png')
+    assert helpers.image_placeholder(url) is None
+    now[0] += helpers.PLACEHOLDER_MISS_TTL + 1
+    assert METADATA == helpers.image_placeholder(url)
+
+
+def test_image_placeholder_failure_is_cached_briefly(storage, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache, 'monotonic', lambda: now[0])
+    calls = []
+
+    def failing_load_metadata(storage, uri):
+        calls.append(uri)
+        raise IOError('Storage is unavailable')
+
+    monkeypatch.setattr(placeholders, 'load_metadata', failing_load_metadata)
+    url = 'http://localhost:5000/uploads/group/logo.png'
+    assert helpers.image_placeholder(url) is None
+    assert helpers.image_placeholder(url) is None
+    assert ['group/logo.png'] == calls
+
+    now[0] += helpers.PLACEHOLDER_MISS_TTL + 1
+    assert helpers.image_placeholder(url) is None
+    assert 2 == len(calls)
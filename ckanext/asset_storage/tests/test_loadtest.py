@@ -0,0 +1,107 @@
+"""Tests for the load testing module
+"""
+import threading
+
+import pytest
+from werkzeug.serving import make_server
+from werkzeug.wrappers import Response
+
+from ckanext.asset_storage import loadtest
+from ckanext.asset_storage.storage.local import LocalStorage
+
+
+@pytest.fixture()
+def server_url():
+    def app(environ, start_response):
+        path = environ['PATH_INFO']
+        if path == '/uploads/found':
+            response = Response(b'content')
+        elif path == '/uploads/redirect':
+            response = Response(status=302, headers={'Location': 'http://example.com/should-not-follow'})
+        else:
+            response = Response(status=404)
+        return response(environ, start_response)
+
+    server = make_server('127.0.0.1', 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield 'http://127.0.0.1:{}/'.format(server.server_address[1])
+    finally:
+        server.shutdown()
+
+
+def test_seed_assets(storage_path):
+    storage = LocalStorage(storage_path=storage_path)
+    uris = loadtest.seed_assets(storage, 3, size=16)
+    assert 3 == len(uris)
+    for uri in uris:
+        assert uri.startswith('loadtest/')
+        assert 16 == len(storage.download(uri).fileobj.read())
+
+
+def test_key_chooser_skew():
+    keys = ['key-{}'.format(i) for i in range(100)]
+    chooser = loadtest.KeyChooser(keys, hot_fraction=0.1, hot_traffic=0.9, seed=42)
+    chosen = [chooser.choose() for _ in range(2000)]
+    hot = sum(1 for key in chosen if key in keys[:10])
+    assert 0.85 < hot / 2000.0 < 0.95
+
+
+def test_key_chooser_reproducible():
+    keys = ['key-{}'.format(i) for i in range(100)]
+    first = loadtest.KeyChooser(keys, seed=1)
+    second = loadtest.KeyChooser(keys, seed=1)
+    assert [first.choose() for _ in range(50)] == [second.choose() for _ in range(50)]
+
+
+def test_key_chooser_single_key():
+    chooser = loadtest.KeyChooser(['only-key'], hot_traffic=0.0)
+    assert 'only-key' == chooser.choose()
+
+
+def test_key_chooser_no_keys():
+    with pytest.raises(ValueError):
+        loadtest.KeyChooser([])
+
+
+def test_run_request_count():
+    chooser = loadtest.KeyChooser(['a', 'b'], seed=1)
+    result = loadtest.run(lambda key: 200, chooser, concurrency=4, requests=100)
+    assert 100 == result.requests
+    assert 0 == result.errors
+    assert {200: 100} == result.statuses
+    assert result.percentile(50) is not None
+
+
+def test_run_counts_errors():
+    def fetch(key):
+        if key == 'bad':
+            raise IOError('Failed')
+        return 302
+
+    chooser = loadtest.KeyChooser(['good', 'bad'], hot_fraction=0.5, hot_traffic=0.5, seed=1)
+    result = loadtest.run(fetch, chooser, concurrency=2, requests=50)
+    assert 50 == result.requests
+    assert result.errors == 50 - result.statuses[302]
+    assert 'errors' in result.summary()
+
+
+def test_run_duration():
+    chooser = loadtest.KeyChooser(['a'])
+    result = loadtest.run(lambda key: 200, chooser, concurrency=2, requests=0, duration=0.05)
+    assert result.requests > 0
+    assert result.elapsed >= 0.05
+
+
+def test_http_fetcher(server_url):
+    fetch = loadtest.http_fetcher(server_url)
+    assert 200 == fetch('found')
+    assert 302 == fetch('redirect')
+
+
+def test_http_fetcher_error(server_url):
+    fetch = loadtest.http_fetcher(server_url)
+    with pytest.raises(IOError):
+        fetch('not-found')
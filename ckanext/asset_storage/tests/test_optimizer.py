@@ -0,0 +1,190 @@
+"""Tests for the optimizer module
+"""
+import os
+import struct
+import zlib
+
+import pytest
+from six import BytesIO
+
+from ckanext.asset_storage import optimizer
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def _image_bytes(image_format, **save_args):
+    image = Image.new('RGB', (64, 48), color=(200, 30, 30))
+    output = BytesIO()
+    image.save(output, image_format, **save_args)
+    return output.getvalue()
+
+
+def _slow_optimizer(content, mimetype):
+    import time
+    time.sleep(1)
+    return b''
+
+
+def _fast_optimizer(content, mimetype):
+    return b'optimized'
+
+
+def _failing_optimizer(content, mimetype):
+    raise ValueError('Cannot optimize this')
+
+
+def test_get_named_optimizer():
+    opt = optimizer.get_optimizer('pillow', workers=0)
+    assert isinstance(opt, optimizer.AssetOptimizer)
+
+
+def test_get_invalid_optimizer():
+    with pytest.raises(ValueError):
+        optimizer.get_optimizer('ckanext.asset_storage.optimizer.optimize_image')
+
+    with pytest.raises(ValueError):
+        optimizer.get_optimizer('ckanext.asset_storage.optimizer:made_up_optimizer')
+
+
+def _noise_image(mode='RGB', size=(64, 48)):
+    return Image.frombytes(mode, size, os.urandom(size[0] * size[1] * len(mode)))
+
+
+def _png_chunk(chunk_type, data):
+    crc = zlib.crc32(chunk_type + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', crc)
+
+
+def _rgb48_png_bytes(width=8, height=8):
+    """Build a 48 bit RGB PNG, which Pillow cannot write
+    """
+    rows = b''.join(b'\x00' + os.urandom(width * 6) for _ in range(height))
+    return (b'\x89PNG\r\n\x1a\n'
+            + _png_chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 16, 2, 0, 0, 0))
+            + _png_chunk(b'IDAT', zlib.compress(rows, 0))
+            + _png_chunk(b'IEND', b''))
+
+
+def test_optimize_png_strips_metadata():
+    content = _image_bytes('PNG', compress_level=0, icc_profile=b'fake-profile')
+    optimized = optimizer.optimize_image(content, 'image/png')
+    assert len(optimized) < len(content)
+
+    image = Image.open(BytesIO(optimized))
+    assert image.format == 'PNG'
+    assert image.size == (64, 48)
+    assert 'icc_profile' not in image.info
+
+
+@pytest.mark.parametrize('mode', ['RGB', 'RGBA', 'L'])
+def test_optimize_png_is_lossless(mode):
+    original = _noise_image(mode)
+    content = BytesIO()
+    original.save(content, 'PNG', compress_level=0)
+    optimized = Image.open(BytesIO(optimizer.optimize_image(content.getvalue(), 'image/png')))
+    assert original.mode == optimized.mode
+    assert original.tobytes() == optimized.tobytes()
+
+
+def test_optimize_png_skips_16_bit_images():
+    gray = BytesIO()
+    Image.frombytes('I;16', (8, 8), os.urandom(128)).save(gray, 'PNG', compress_level=0)
+    assert optimizer.optimize_image(gray.getvalue(), 'image/png') is None
+    assert optimizer.optimize_image(_rgb48_png_bytes(), 'image/png') is None
+
+
+def test_optimize_jpeg_is_lossless():
+    original = _noise_image()
+    exif = Image.Exif()
+    exif[0x010f] = 'Camera maker'
+    content = BytesIO()
+    original.save(content, 'JPEG', quality=90, exif=exif.tobytes(), icc_profile=b'fake-profile' * 100,
+                  comment=b'A comment')
+    content = content.getvalue()
+    optimized = optimizer.optimize_image(content, 'image/jpeg')
+    assert len(optimized) < len(content)
+
+    before, after = Image.open(BytesIO(content)), Image.open(BytesIO(optimized))
+    assert before.tobytes() == after.tobytes()
+    assert 'exif' not in after.info
+    assert 'icc_profile' not in after.info
+    assert 'comment' not in after.info
+
+
+def test_optimize_jpeg_keeps_orientation():
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    content = BytesIO()
+    _noise_image().save(content, 'JPEG', quality=90, exif=exif.tobytes(), comment=b'A comment')
+    content = content.getvalue()
+    optimized = optimizer.optimize_image(content, 'image/jpeg')
+
+    after = Image.open(BytesIO(optimized))
+    assert 6 == after.getexif()[0x0112]
+    assert Image.open(BytesIO(content)).tobytes() == after.tobytes()
+
+
+def test_optimize_invalid_jpeg():
+    assert optimizer._strip_jpeg_metadata(b'\xff\xd8\x00\x00garbage') is None
+
+
+def test_optimize_unsupported_format():
+    assert optimizer.optimize_image(_image_bytes('GIF'), 'image/gif') is None
+
+
+def test_process_returns_smaller_stream():
+    content = _image_bytes('PNG', compress_level=0)
+    opt = optimizer.AssetOptimizer(optimizer.optimize_image, workers=0)
+    result = opt.process(BytesIO(content), 'image/png')
+    assert len(result.read()) < len(content)
+
+
+def test_process_skips_unsupported_mimetype():
+    stream = BytesIO(b'<svg></svg>')
+    opt = optimizer.AssetOptimizer(optimizer.optimize_image, workers=0)
+    assert opt.process(stream, 'image/svg+xml') is stream
+
+
+def test_process_skips_large_files():
+    content = _image_bytes('PNG', compress_level=0)
+    stream = BytesIO(content)
+    opt = optimizer.AssetOptimizer(optimizer.optimize_image, workers=0, max_input_size=100)
+    assert opt.process(stream, 'image/png') is stream
+    assert stream.tell() == 0
+
+
+def test_process_keeps_original_on_failure():
+    stream = BytesIO(b'not really an image')
+    opt = optimizer.AssetOptimizer(_failing_optimizer, workers=0)
+    assert opt.process(stream, 'image/png') is stream
+    assert stream.tell() == 0
+
+
+def test_process_in_worker_pool():
+    content = _image_bytes('PNG', compress_level=0)
+    opt = optimizer.AssetOptimizer(optimizer.optimize_image, workers=1, timeout=30)
+    result = opt.process(BytesIO(content), 'image/png')
+    assert len(result.read()) < len(content)
+
+
+def test_process_keeps_original_on_timeout():
+    stream = BytesIO(b'some content')
+    opt = optimizer.AssetOptimizer(_slow_optimizer, workers=1, timeout=0.1)
+    assert opt.process(stream, 'image/png') is stream
+    assert stream.tell() == 0
+
+
+def test_timeout_kills_worker_pool():
+    opt = optimizer.AssetOptimizer(_fast_optimizer, workers=1, timeout=5)
+    assert b'optimized' == opt.process(BytesIO(b'some content'), 'image/png').read()
+    pool = opt._pool
+
+    opt._optimize = _slow_optimizer
+    opt._timeout = 0.1
+    opt.process(BytesIO(b'some content'), 'image/png')
+    assert opt._pool is None
+
+    opt._optimize = _fast_optimizer
+    opt._timeout = 5
+    assert b'optimized' == opt.process(BytesIO(b'some content'), 'image/png').read()
+    assert opt._pool is not pool
@@ -0,0 +1,131 @@
+"""Tests for the placeholders module
+"""
+import base64
+
+import pytest
+from six import BytesIO
+
+from ckanext.asset_storage import placeholders
+from ckanext.asset_storage.storage.local import LocalStorage
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def _image_bytes(image_format, size=(64, 48), mode='RGB', color=(200, 30, 30), **save_args):
+    image = Image.new(mode, size, color=color)
+    output = BytesIO()
+    image.save(output, image_format, **save_args)
+    return output.getvalue()
+
+
+def _parse_color(color):
+    return tuple(int(color[i:i + 2], 16) for i in (1, 3, 5))
+
+
+def _assert_color_close(expected, color):
+    assert all(abs(e - c) < 10 for e, c in zip(expected, _parse_color(color)))
+
+
+def _decode_data_uri(uri):
+    header, data = uri.split(',', 1)
+    return header, Image.open(BytesIO(base64.b64decode(data)))
+
+
+def test_compute_jpeg():
+    metadata = placeholders.compute(_image_bytes('JPEG', size=(400, 300)))
+    assert 400 == metadata['width']
+    assert 300 == metadata['height']
+
+    header, thumbnail = _decode_data_uri(metadata['placeholder'])
+    assert 'data:image/jpeg;base64' == header
+    assert (20, 15) == thumbnail.size
+
+    _assert_color_close((200, 30, 30), metadata['color'])
+
+
+def test_compute_dominant_color():
+    image = Image.new('RGB', (100, 100), color=(0, 0, 255))
+    image.paste((255, 255, 0), (0, 0, 100, 30))
+    output = BytesIO()
+    image.save(output, 'PNG')
+    _assert_color_close((0, 0, 255), placeholders.compute(output.getvalue())['color'])
+
+
+def test_compute_transparent_png():
+    image = Image.new('RGBA', (100, 100), color=(0, 0, 0, 0))
+    image.paste((0, 128, 0, 255), (25, 25, 75, 75))
+    output = BytesIO()
+    image.save(output, 'PNG')
+
+    metadata = placeholders.compute(output.getvalue())
+    _assert_color_close((0, 128, 0), metadata['color'])
+    header, thumbnail = _decode_data_uri(metadata['placeholder'])
+    assert 'data:image/png;base64' == header
+    assert (20, 20) == thumbnail.size
+
+
+def test_compute_fully_transparent():
+    metadata = placeholders.compute(_image_bytes('PNG', mode='RGBA', color=(0, 0, 0, 0)))
+    assert metadata['color'] is None
+
+
+def test_compute_exif_rotated():
+    exif = Image.Exif()
+    exif[0x0112] = 6
+    metadata = placeholders.compute(_image_bytes('JPEG', size=(400, 300), exif=exif.tobytes()))
+    assert 300 == metadata['width']
+    assert 400 == metadata['height']
+    _, thumbnail = _decode_data_uri(metadata['placeholder'])
+    assert (15, 20) == thumbnail.size
+
+
+@pytest.mark.parametrize('image_format,mode', [('PNG', 'RGB'), ('PNG', 'P'), ('WEBP', 'RGBA')])
+def test_compute_converts_downscaled_image(monkeypatch, image_format, mode):
+    """Images are downscaled before being converted, so no full size copy of the image is made
+    """
+    if image_format not in Image.SAVE:
+        Image.init()
+    if image_format not in Image.SAVE:
+        pytest.skip('Pillow was built without {} support'.format(image_format))
+
+    content = _image_bytes(image_format, size=(2000, 1500), mode=mode, color=(0, 0, 255) if mode != 'P' else 1)
+    converted = []
+    convert = Image.Image.convert
+
+    def recording_convert(image, *args, **kwargs):
+        converted.append(image.size)
+        return convert(image, *args, **kwargs)
+
+    monkeypatch.setattr(Image.Image, 'convert', recording_convert)
+    metadata = placeholders.compute(content)
+    assert 2000 == metadata['width']
+    assert converted
+    assert all(max(size) <= placeholders.PLACEHOLDER_SIZE for size in converted)
+
+
+def test_compute_invalid_image():
+    with pytest.raises(IOError):
+        placeholders.compute(b'not an image')
+
+
+def test_compute_too_many_pixels(monkeypatch):
+    monkeypatch.setattr(Image, 'MAX_IMAGE_PIXELS', 400 * 300 - 1)
+    with pytest.raises(ValueError):
+        placeholders.compute(_image_bytes('PNG', size=(400, 300)))
+
+
+def test_upload_and_load_metadata(tmpdir):
+    storage = LocalStorage(str(tmpdir))
+    metadata = placeholders.upload_metadata(storage, BytesIO(_image_bytes('PNG')), 'logo.png', 'group')
+    assert tmpdir.join('group', 'logo.png.meta.json').check()
+    assert metadata == placeholders.load_metadata(storage, 'group/logo.png')
+
+
+def test_upload_metadata_of_invalid_image(tmpdir):
+    storage = LocalStorage(str(tmpdir))
+    assert placeholders.upload_metadata(storage, BytesIO(b'not an image'), 'logo.png', 'group') is None
+    assert not tmpdir.join('group', 'logo.png.meta.json').check()
+
+
+def test_load_missing_metadata(tmpdir):
+    assert placeholders.load_metadata(LocalStorage(str(tmpdir)), 'group/logo.png') is None
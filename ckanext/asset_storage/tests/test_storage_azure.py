@@ -1,8 +1,19 @@
 """Tests for the Azure storage backend
 
-TODO: add dynamic / vcr based tests
+Some of these tests run against a local Azurite emulator (see
+`docker-compose.yml`), and are skipped unless the
+`AZURE_EMULATOR_CONNECTION_STRING` environment variable is set to its
+connection string
 """
-from ckanext.asset_storage.storage import get_storage
+import os
+import threading
+import uuid
+
+import pytest
+from six import BytesIO
+from six.moves.urllib.parse import parse_qs
+
+from ckanext.asset_storage.storage import PRIVATE_IMMUTABLE_CACHE_CONTROL, get_storage
 from ckanext.asset_storage.storage.azure_blobs import AzureBlobStorage
 
 FAKE_CONN_STRING = (
@@ -11,6 +22,10 @@ FAKE_CONN_STRING = (
     "BlobEndpoint=http://127.0.0.1:10000/devstoreaccount1;"
 )
 
+EMULATOR_CONN_STRING = os.environ.get('AZURE_EMULATOR_CONNECTION_STRING')
+
+requires_emulator = pytest.mark.skipif(not EMULATOR_CONN_STRING, reason='AZURE_EMULATOR_CONNECTION_STRING is not set')
+
 
 def test_store_can_instantiate():
     storage = AzureBlobStorage('my-container', FAKE_CONN_STRING)
@@ -20,3 +35,127 @@ def test_store_can_instantiate():
 def test_storage_fetched_from_factory():
     storage = get_storage('azure_blobs', {"container_name": "my-container", "connection_string": FAKE_CONN_STRING})
     assert isinstance(storage, AzureBlobStorage)
+
+
+def test_clients_share_transport():
+    first = AzureBlobStorage('my-container', FAKE_CONN_STRING, pool_size=5)
+    second = AzureBlobStorage('other-container', FAKE_CONN_STRING, pool_size=5)
+    transport = _get_session(first)
+    assert transport is _get_session(second)
+    assert transport is _get_session(first, first._blob_client('my-file.txt'))
+    adapter = transport.get_adapter('http://127.0.0.1:10000/')
+    assert 5 == adapter._pool_maxsize
+
+
+def test_transport_sized_by_options():
+    first = AzureBlobStorage('my-container', FAKE_CONN_STRING, pool_size=5)
+    second = AzureBlobStorage('my-container', FAKE_CONN_STRING, pool_size=20)
+    assert _get_session(first) is not _get_session(second)
+
+
+def test_signed_url():
+    storage = AzureBlobStorage('my-container', FAKE_CONN_STRING, path_prefix='assets')
+    blob = storage._blob_client('my file.txt', 'group')
+    url = storage._get_signed_url(blob, 60)
+    base_url, sas_token = url.split('?', 1)
+    assert 'http://127.0.0.1:10000/devstoreaccount1/my-container/assets/group/my%20file.txt' == base_url
+    query = parse_qs(sas_token)
+    assert ['r'] == query['sp']
+    assert 'sig' in query
+
+
+def _get_session(storage, client=None):
+    """Get the requests session used by a storage backend's client
+    """
+    if client is None:
+        client = storage._container_client
+    transport = client._pipeline._transport
+    # Child clients wrap their parent client's transport
+    while hasattr(transport, '_transport'):
+        transport = transport._transport
+    return transport.session
+
+
+@pytest.fixture()
+def container_name():
+    name = 'test-{}'.format(uuid.uuid4().hex[:12])
+    storage = AzureBlobStorage(name, EMULATOR_CONN_STRING)
+    storage._container_client.create_container()
+    try:
+        yield name
+    finally:
+        storage._container_client.delete_container()
+
+
+def _record_requests(storage, monkeypatch):
+    """Record HTTP requests made by the storage backend's clients in the current thread
+    """
+    requests = []
+    session = _get_session(storage)
+    send_request = session.request
+    thread = threading.current_thread()
+
+    def request(method, url, *args, **kwargs):
+        if threading.current_thread() is thread:
+            requests.append((method, url))
+        return send_request(method, url, *args, **kwargs)
+
+    monkeypatch.setattr(session, 'request', request)
+    return requests
+
+
+@requires_emulator
+def test_upload_is_a_single_request(container_name, monkeypatch):
+    content = b'This is the contents of the file'
+    storage = AzureBlobStorage(container_name, EMULATOR_CONN_STRING)
+    # The container's access policy is only fetched once per backend
+    assert PRIVATE_IMMUTABLE_CACHE_CONTROL == storage._cache_control
+    requests = _record_requests(storage, monkeypatch)
+    written = storage.upload(BytesIO(content), 'my-file.txt', 'group', mimetype='text/plain', content_encoding='gzip')
+    assert len(content) == written
+    assert ['PUT'] == [method for method, _ in requests]
+
+    properties = storage._blob_client('my-file.txt', 'group').get_blob_properties()
+    assert 'text/plain' == properties.content_settings.content_type
+    assert 'gzip' == properties.content_settings.content_encoding
+    assert PRIVATE_IMMUTABLE_CACHE_CONTROL == properties.content_settings.cache_control
+
+
+@requires_emulator
+def test_download_signed_url(container_name):
+    storage = AzureBlobStorage(container_name, EMULATOR_CONN_STRING)
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group', mimetype='text/plain')
+    target = storage.download('group/my-file.txt')
+    assert target.redirect_to.startswith(storage._blob_client('my-file.txt', 'group').url + '?')
+    assert b'content' == _get_session(storage).get(target.redirect_to).content
+
+
+@requires_emulator
+def test_exists_and_delete(container_name):
+    storage = AzureBlobStorage(container_name, EMULATOR_CONN_STRING)
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group')
+    assert storage.exists('group/my-file.txt')
+    assert storage.delete('group/my-file.txt')
+    assert not storage.exists('group/my-file.txt')
+    assert not storage.delete('group/my-file.txt')
+
+
+@requires_emulator
+def test_iter_uris(container_name):
+    storage = AzureBlobStorage(container_name, EMULATOR_CONN_STRING, path_prefix='assets')
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group')
+    storage.upload(BytesIO(b'content'), 'user-file.txt', 'user')
+    assert ['group/my-file.txt', 'user/user-file.txt'] == sorted(storage.iter_uris())
+    assert ['group/my-file.txt'] == list(storage.iter_uris('group'))
+
+
+@requires_emulator
+def test_update_cache_control_preserves_content_type(container_name):
+    storage = AzureBlobStorage(container_name, EMULATOR_CONN_STRING, cache_control=None)
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group', mimetype='text/plain')
+
+    storage = AzureBlobStorage(container_name, EMULATOR_CONN_STRING, cache_control='public, max-age=60')
+    assert storage.update_cache_control('group/my-file.txt')
+    properties = storage._blob_client('my-file.txt', 'group').get_blob_properties()
+    assert 'public, max-age=60' == properties.content_settings.cache_control
+    assert 'text/plain' == properties.content_settings.content_type
@@ -0,0 +1,93 @@
+"""Tests for the fallback storage backend
+"""
+import pytest
+from six import BytesIO
+
+from ckanext.asset_storage.storage import exc, get_storage
+from ckanext.asset_storage.storage.fallback import FallbackStorage
+
+
+def _fallback_storage(storage_path, **kwargs):
+    (storage_path / 'primary').mkdir()
+    (storage_path / 'legacy').mkdir()
+    backends = [{'type': 'local', 'options': {'storage_path': str(storage_path / 'primary')}},
+                {'type': 'local', 'options': {'storage_path': str(storage_path / 'legacy')}}]
+    return FallbackStorage(backends, **kwargs)
+
+
+def test_storage_fetched_from_factory(storage_path):
+    storage = get_storage('fallback', {'backends': [{'type': 'local', 'options': {'storage_path': str(storage_path)}}]})
+    assert isinstance(storage, FallbackStorage)
+
+
+def test_storage_requires_backends():
+    with pytest.raises(ValueError):
+        FallbackStorage([])
+
+
+def test_upload_goes_to_primary(storage_path):
+    content = b'This is the contents of the file'
+    storage = _fallback_storage(storage_path)
+    storage.upload(BytesIO(content), 'my-file.txt', 'assets')
+
+    assert (storage_path / 'primary' / 'assets' / 'my-file.txt').read_bytes() == content
+    assert not (storage_path / 'legacy' / 'assets' / 'my-file.txt').exists()
+
+
+def test_download_from_secondary_copies_to_primary(storage_path):
+    content = b'This is the contents of the file'
+    storage = _fallback_storage(storage_path)
+    legacy = get_storage('local', {'storage_path': str(storage_path / 'legacy')})
+    legacy.upload(BytesIO(content), 'my-file.txt', 'assets')
+
+    target = storage.download('assets/my-file.txt')
+    assert target.fileobj.read() == content
+    target.fileobj.close()
+
+    storage.flush(timeout=5)
+    assert (storage_path / 'primary' / 'assets' / 'my-file.txt').read_bytes() == content
+
+
+def test_download_from_secondary_no_copy(storage_path):
+    content = b'This is the contents of the file'
+    storage = _fallback_storage(storage_path, copy_on_read=False)
+    legacy = get_storage('local', {'storage_path': str(storage_path / 'legacy')})
+    legacy.upload(BytesIO(content), 'my-file.txt', 'assets')
+
+    target = storage.download('assets/my-file.txt')
+    assert target.fileobj.read() == content
+    target.fileobj.close()
+
+    storage.flush(timeout=5)
+    assert not (storage_path / 'primary' / 'assets' / 'my-file.txt').exists()
+
+
+def test_download_non_existing_file(storage_path):
+    storage = _fallback_storage(storage_path)
+    with pytest.raises(exc.ObjectNotFound):
+        storage.download('assets/other-file.txt')
+
+
+def test_delete_removes_from_all_backends(storage_path):
+    content = b'This is the contents of the file'
+    storage = _fallback_storage(storage_path)
+    legacy = get_storage('local', {'storage_path': str(storage_path / 'legacy')})
+    legacy.upload(BytesIO(content), 'my-file.txt', 'assets')
+    storage.upload(BytesIO(content), 'my-file.txt', 'assets')
+
+    assert storage.delete('assets/my-file.txt')
+    assert not (storage_path / 'primary' / 'assets' / 'my-file.txt').exists()
+    assert not (storage_path / 'legacy' / 'assets' / 'my-file.txt').exists()
+    assert not storage.delete('assets/my-file.txt')
+
+
+def test_iter_uris_lists_all_backends_once(storage_path):
+    storage = _fallback_storage(storage_path, copy_on_read=False)
+    legacy = get_storage('local', {'storage_path': str(storage_path / 'legacy')})
+    storage.upload(BytesIO(b'new'), 'new-file.txt', 'assets')
+    storage.upload(BytesIO(b'both'), 'both-files.txt', 'assets')
+    legacy.upload(BytesIO(b'both'), 'both-files.txt', 'assets')
+    legacy.upload(BytesIO(b'old'), 'old-file.txt', 'assets')
+
+    uris = list(storage.iter_uris())
+    assert sorted(uris) == ['assets/both-files.txt', 'assets/new-file.txt', 'assets/old-file.txt']
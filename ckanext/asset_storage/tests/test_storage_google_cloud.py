@@ -0,0 +1,212 @@
+"""Tests for the Google Cloud Storage backend
+
+These tests run against a local Google Cloud Storage emulator such as
+fake-gcs-server (see `docker-compose.yml`), and are skipped unless the
+`GCS_EMULATOR_URL` environment variable is set, e.g. to `http://localhost:4443`
+"""
+import os
+import threading
+import uuid
+
+import pytest
+from six import BytesIO
+
+from ckanext.asset_storage.storage import IMMUTABLE_CACHE_CONTROL, PRIVATE_IMMUTABLE_CACHE_CONTROL, exc, get_storage
+from ckanext.asset_storage.storage.google_cloud import GoogleCloudStorage
+
+EMULATOR_URL = os.environ.get('GCS_EMULATOR_URL')
+
+pytestmark = pytest.mark.skipif(not EMULATOR_URL, reason='GCS_EMULATOR_URL is not set')
+
+
+@pytest.fixture()
+def bucket_name():
+    name = 'test-{}'.format(uuid.uuid4().hex[:12])
+    storage = GoogleCloudStorage('test-project', name, api_endpoint=EMULATOR_URL)
+    storage._client.create_bucket(name)
+    return name
+
+
+def _storage(bucket_name, **kwargs):
+    return GoogleCloudStorage('test-project', bucket_name, api_endpoint=EMULATOR_URL, **kwargs)
+
+
+def _get_blob(storage, path):
+    return storage._bucket.get_blob(path)
+
+
+def test_storage_fetched_from_factory(bucket_name):
+    storage = get_storage('google_cloud', {'project_name': 'test-project',
+                                           'bucket_name': bucket_name,
+                                           'api_endpoint': EMULATOR_URL})
+    assert isinstance(storage, GoogleCloudStorage)
+
+
+def test_public_storage_uri(bucket_name):
+    storage = _storage(bucket_name, path_prefix='assets')
+    uri = storage.get_storage_uri('logo.png', 'group')
+    assert uri.endswith('/{}/assets/group/logo.png'.format(bucket_name))
+
+
+def test_private_storage_uri(bucket_name):
+    storage = _storage(bucket_name, public_read=False)
+    assert 'group/logo.png' == storage.get_storage_uri('logo.png', 'group')
+
+
+@pytest.mark.parametrize('uniform_access', [False, True])
+def test_upload(bucket_name, uniform_access):
+    content = b'This is the contents of the file'
+    storage = _storage(bucket_name, path_prefix='assets', uniform_bucket_level_access=uniform_access)
+    written = storage.upload(BytesIO(content), 'my-file.txt', 'group', mimetype='text/plain')
+    assert len(content) == written
+
+    blob = _get_blob(storage, 'assets/group/my-file.txt')
+    assert 'text/plain' == blob.content_type
+    assert IMMUTABLE_CACHE_CONTROL == blob.cache_control
+    assert content == blob.download_as_bytes()
+
+
+def test_upload_private_cache_control(bucket_name):
+    storage = _storage(bucket_name, public_read=False)
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group', mimetype='text/plain')
+    assert PRIVATE_IMMUTABLE_CACHE_CONTROL == _get_blob(storage, 'group/my-file.txt').cache_control
+
+
+def test_upload_content_encoding(bucket_name):
+    storage = _storage(bucket_name)
+    storage.upload(BytesIO(b'compressed'), 'my-file.txt.gz', 'group', mimetype='text/plain', content_encoding='gzip')
+    assert 'gzip' == _get_blob(storage, 'group/my-file.txt.gz').content_encoding
+
+
+def test_exists(bucket_name):
+    storage = _storage(bucket_name)
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group')
+    assert storage.exists('group/my-file.txt')
+    assert not storage.exists('group/other-file.txt')
+
+
+def test_download_non_existing_file(bucket_name):
+    storage = _storage(bucket_name, public_read=False)
+    with pytest.raises(exc.ObjectNotFound):
+        storage.download('group/other-file.txt')
+
+
+def test_delete(bucket_name):
+    storage = _storage(bucket_name)
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group')
+    assert storage.delete('group/my-file.txt')
+    assert not storage.exists('group/my-file.txt')
+
+
+def test_delete_non_existing_file(bucket_name):
+    storage = _storage(bucket_name)
+    assert not storage.delete('group/other-file.txt')
+
+
+def test_iter_uris(bucket_name):
+    storage = _storage(bucket_name, path_prefix='assets')
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group')
+    storage.upload(BytesIO(b'content'), 'other-file.txt', 'groups')
+    storage.upload(BytesIO(b'content'), 'user-file.txt', 'user')
+
+    assert ['group/my-file.txt', 'groups/other-file.txt', 'user/user-file.txt'] == sorted(storage.iter_uris())
+    assert ['group/my-file.txt'] == list(storage.iter_uris('group'))
+
+
+def test_update_cache_control(bucket_name):
+    storage = _storage(bucket_name, cache_control=None)
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group', mimetype='text/plain')
+    assert _get_blob(storage, 'group/my-file.txt').cache_control is None
+
+    storage = _storage(bucket_name, cache_control='public, max-age=60')
+    assert storage.update_cache_control('group/my-file.txt')
+    blob = _get_blob(storage, 'group/my-file.txt')
+    assert 'public, max-age=60' == blob.cache_control
+    assert 'text/plain' == blob.content_type
+
+
+def test_update_cache_control_non_existing_file(bucket_name):
+    storage = _storage(bucket_name)
+    assert not storage.update_cache_control('group/other-file.txt')
+
+
+def _record_requests(storage, monkeypatch):
+    """Record HTTP requests made by the storage backend's client in the current thread
+
+    Requests made in other threads (e.g. background bucket metadata fetching
+    in newer versions of the client library) are not recorded
+    """
+    requests = []
+    session = storage._client._http
+    send_request = session.request
+    thread = threading.current_thread()
+
+    def request(method, url, *args, **kwargs):
+        if threading.current_thread() is thread:
+            requests.append((method, url))
+        return send_request(method, url, *args, **kwargs)
+
+    monkeypatch.setattr(session, 'request', request)
+    return requests
+
+
+@pytest.mark.parametrize('public_read', [True, False])
+def test_upload_is_a_single_request(bucket_name, monkeypatch, public_read):
+    storage = _storage(bucket_name, public_read=public_read)
+    requests = _record_requests(storage, monkeypatch)
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group', mimetype='text/plain')
+    assert 1 == len(requests)
+    method, url = requests[0]
+    assert 'POST' == method
+    assert 'predefinedAcl={}'.format('publicRead' if public_read else 'private') in url
+
+
+def test_upload_uniform_access_sets_no_acl(bucket_name, monkeypatch):
+    storage = _storage(bucket_name, uniform_bucket_level_access=True)
+    requests = _record_requests(storage, monkeypatch)
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group', mimetype='text/plain')
+    assert 1 == len(requests)
+    assert 'predefinedAcl' not in requests[0][1]
+
+
+def test_delete_is_a_single_request(bucket_name, monkeypatch):
+    storage = _storage(bucket_name)
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group')
+    requests = _record_requests(storage, monkeypatch)
+    assert storage.delete('group/my-file.txt')
+    assert not storage.delete('group/my-file.txt')
+    assert ['DELETE', 'DELETE'] == [method for method, _ in requests]
+
+
+def test_storage_uri_makes_no_requests(bucket_name, monkeypatch):
+    storage = _storage(bucket_name)
+    requests = _record_requests(storage, monkeypatch)
+    storage.get_storage_uri('my-file.txt', 'group')
+    assert [] == requests
+
+
+def test_hmac_key_requires_secret(bucket_name):
+    with pytest.raises(ValueError):
+        _storage(bucket_name, hmac_access_id='GOOG1EXAMPLE')
+
+
+def test_download_signed_with_hmac_key(bucket_name, monkeypatch):
+    storage = _storage(bucket_name, public_read=False, path_prefix='assets', hmac_access_id='GOOG1EXAMPLE',
+                       hmac_secret='secret')
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group')
+    requests = _record_requests(storage, monkeypatch)
+    target = storage.download('group/my-file.txt')
+
+    assert target.redirect_to.startswith('{}/{}/assets/group/my-file.txt?'.format(EMULATOR_URL, bucket_name))
+    assert 'X-Goog-Algorithm=GOOG4-HMAC-SHA256' in target.redirect_to
+    assert 'X-Goog-Credential=GOOG1EXAMPLE%2F' in target.redirect_to
+    # Only the object lookup is sent to storage, the URL is signed locally
+    assert ['GET'] == [method for method, _ in requests]
+
+
+def test_upload_target_signed_with_hmac_key(bucket_name):
+    storage = _storage(bucket_name, public_read=False, hmac_access_id='GOOG1EXAMPLE', hmac_secret='secret')
+    target = storage.get_upload_target('my-file.png', 'group', mimetype='image/png', max_size=1024)
+    assert 'X-Goog-Algorithm=GOOG4-HMAC-SHA256' in target.url
+    assert 'content-type%3Bhost%3Bx-goog-acl%3Bx-goog-content-length-range' in target.url
+    assert 'image/png' == target.headers['Content-Type']
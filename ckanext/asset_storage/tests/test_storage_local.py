@@ -78,3 +78,125 @@ def test_store_delete_non_existing_file(storage_path):
     stored_uri = storage.get_storage_uri('other-file.txt', 'assets')
     removed = storage.delete(stored_uri)
     assert not removed
+
+
+def test_store_exists(storage_path):
+    storage = LocalStorage(storage_path=storage_path)
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'assets')
+    assert storage.exists('assets/my-file.txt')
+    assert not storage.exists('assets/other-file.txt')
+
+
+def test_store_download_compressed_variant(storage_path):
+    """Test downloading a precompressed file detects its content encoding
+    """
+    storage = LocalStorage(storage_path=storage_path)
+    storage.upload(BytesIO(b'compressed'), 'my-file.svg.gz', 'assets', content_encoding='gzip')
+
+    target = storage.download(storage.get_storage_uri('my-file.svg.gz', 'assets'))
+    assert target.mimetype == 'image/svg+xml'
+    assert target.content_encoding == 'gzip'
+
+
+def test_store_upload_hashed_layout(storage_path):
+    """Test uploading to local storage with the hashed layout
+    """
+    content = b'This is the contents of the file'
+    storage = LocalStorage(storage_path=storage_path, layout='hashed')
+    storage.upload(BytesIO(content), 'my-file.txt', 'assets')
+
+    # md5('my-file.txt') starts with '2730'
+    actual = (storage_path / 'assets' / '27' / '30' / 'my-file.txt').read_bytes()
+    assert actual == content
+    assert 'assets/my-file.txt' == storage.get_storage_uri('my-file.txt', 'assets')
+
+    target = storage.download('assets/my-file.txt')
+    assert target.fileobj.read() == content
+    target.fileobj.close()
+
+
+def test_store_invalid_layout(storage_path):
+    with pytest.raises(ValueError):
+        LocalStorage(storage_path=storage_path, layout='other')
+
+
+def test_store_upload_leaves_no_temp_files(storage_path):
+    storage = LocalStorage(storage_path=storage_path)
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'assets')
+    storage.upload(BytesIO(b'new content'), 'my-file.txt', 'assets')
+
+    assert [p.name for p in (storage_path / 'assets').iterdir()] == ['my-file.txt']
+    assert (storage_path / 'assets' / 'my-file.txt').read_bytes() == b'new content'
+
+
+def test_store_hashed_layout_reads_flat_files(storage_path):
+    """Test that files not yet migrated to the hashed layout can be downloaded and deleted
+    """
+    content = b'This is the contents of the file'
+    LocalStorage(storage_path=storage_path).upload(BytesIO(content), 'my-file.txt', 'assets')
+
+    storage = LocalStorage(storage_path=storage_path, layout='hashed')
+    target = storage.download('assets/my-file.txt')
+    assert target.fileobj.read() == content
+    target.fileobj.close()
+
+    assert storage.delete('assets/my-file.txt')
+    assert not (storage_path / 'assets' / 'my-file.txt').exists()
+
+
+def test_store_migrate_layout(storage_path):
+    """Test migrating files from the flat layout to the hashed layout and back
+    """
+    flat = LocalStorage(storage_path=storage_path)
+    flat.upload(BytesIO(b'file 1'), 'my-file.txt', 'assets')
+    flat.upload(BytesIO(b'file 2'), 'other-file.txt', 'group')
+
+    hashed = LocalStorage(storage_path=storage_path, layout='hashed')
+    assert len(list(hashed.migrate_layout(dry_run=True))) == 2
+    assert (storage_path / 'assets' / 'my-file.txt').exists()
+
+    moved = list(hashed.migrate_layout())
+    assert len(moved) == 2
+    assert (storage_path / 'assets' / '27' / '30' / 'my-file.txt').read_bytes() == b'file 1'
+    assert not (storage_path / 'assets' / 'my-file.txt').exists()
+    assert list(hashed.migrate_layout()) == []
+
+    assert len(list(flat.migrate_layout())) == 2
+    assert (storage_path / 'assets' / 'my-file.txt').read_bytes() == b'file 1'
+    assert (storage_path / 'group' / 'other-file.txt').read_bytes() == b'file 2'
+
+
+@pytest.mark.parametrize('layout', ['flat', 'hashed'])
+def test_store_iter_uris(storage_path, layout):
+    storage = LocalStorage(storage_path=storage_path, layout=layout)
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group')
+    storage.upload(BytesIO(b'content'), 'other-file.txt', 'user')
+    storage.upload(BytesIO(b'content'), 'no-prefix.txt')
+
+    assert ['group/my-file.txt', 'no-prefix.txt', 'user/other-file.txt'] == sorted(storage.iter_uris())
+    assert ['group/my-file.txt'] == list(storage.iter_uris('group'))
+
+
+def test_store_skips_ckan_dirs(storage_path):
+    """CKAN's own files kept in the same directory are not listed or moved, unless asked for explicitly
+    """
+    ckan_file = storage_path / 'resources' / 'abc' / 'def' / 'ghijkl'
+    ckan_file.parent.mkdir(parents=True)
+    ckan_file.write_bytes(b'CKAN resource')
+    storage = LocalStorage(storage_path=storage_path, layout='hashed')
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group')
+
+    assert ['group/my-file.txt'] == list(storage.iter_uris())
+    assert [] == list(storage.migrate_layout())
+    assert ['resources/abc/def/ghijkl'] == list(storage.iter_uris('resources'))
+
+    flat = LocalStorage(storage_path=storage_path)
+    assert 1 == len(list(flat.migrate_layout(['group', 'user'])))
+    assert ckan_file.read_bytes() == b'CKAN resource'
+    assert (storage_path / 'group' / 'my-file.txt').exists()
+
+
+def test_store_update_cache_control_not_supported(storage_path):
+    storage = LocalStorage(storage_path=storage_path)
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group')
+    assert not storage.update_cache_control('group/my-file.txt')
@@ -0,0 +1,110 @@
+"""Tests for the replicated storage backend
+"""
+import pytest
+from six import BytesIO
+
+from ckanext.asset_storage.storage import StorageBackend, exc, get_storage
+from ckanext.asset_storage.storage.replicated import ReplicatedStorage
+
+FAILING_BACKEND = {'type': 'ckanext.asset_storage.tests.test_storage_replicated:FailingStorage'}
+
+
+class FailingStorage(StorageBackend):
+    """A storage backend that always fails
+    """
+    def get_storage_uri(self, name, prefix=None):
+        return '{}/{}'.format(prefix, name)
+
+    def upload(self, stream, name, prefix=None, mimetype=None, content_encoding=None):
+        raise exc.StorageError('Storage is down')
+
+    def download(self, uri):
+        raise exc.StorageError('Storage is down')
+
+    def delete(self, uri):
+        raise exc.StorageError('Storage is down')
+
+
+def _local_backends(storage_path, count):
+    backends = []
+    for i in range(count):
+        path = storage_path / 'replica{}'.format(i)
+        path.mkdir()
+        backends.append({'type': 'local', 'options': {'storage_path': str(path)}})
+    return backends
+
+
+def test_storage_fetched_from_factory(storage_path):
+    storage = get_storage('replicated', {'backends': _local_backends(storage_path, 2)})
+    assert isinstance(storage, ReplicatedStorage)
+
+
+@pytest.mark.parametrize('quorum', [0, 3])
+def test_storage_invalid_quorum(storage_path, quorum):
+    with pytest.raises(ValueError):
+        ReplicatedStorage(_local_backends(storage_path, 2), quorum=quorum)
+
+
+def test_upload_to_all_replicas(storage_path):
+    content = b'This is the contents of the file'
+    storage = ReplicatedStorage(_local_backends(storage_path, 3), quorum=3)
+    written = storage.upload(BytesIO(content), 'my-file.txt', 'assets')
+    assert written == len(content)
+
+    for i in range(3):
+        assert (storage_path / 'replica{}'.format(i) / 'assets' / 'my-file.txt').read_bytes() == content
+
+
+def test_upload_survives_replica_failure(storage_path):
+    content = b'This is the contents of the file'
+    storage = ReplicatedStorage([FAILING_BACKEND] + _local_backends(storage_path, 2), quorum=2)
+    written = storage.upload(BytesIO(content), 'my-file.txt', 'assets')
+    assert written == len(content)
+
+
+def test_upload_fails_without_quorum():
+    content = b'This is the contents of the file'
+    storage = ReplicatedStorage([FAILING_BACKEND, FAILING_BACKEND], quorum=1)
+    with pytest.raises(exc.StorageError):
+        storage.upload(BytesIO(content), 'my-file.txt', 'assets')
+
+
+def test_download_skips_failing_replica(storage_path):
+    content = b'This is the contents of the file'
+    storage = ReplicatedStorage([FAILING_BACKEND] + _local_backends(storage_path, 1), quorum=1)
+    storage.upload(BytesIO(content), 'my-file.txt', 'assets')
+
+    for _ in range(3):
+        target = storage.download('assets/my-file.txt')
+        assert target.fileobj.read() == content
+        target.fileobj.close()
+
+    # Failing replica should now be ranked last
+    assert storage._ranked_backends() == [1, 0]
+
+
+def test_download_from_lagging_replica(storage_path):
+    content = b'This is the contents of the file'
+    backends = _local_backends(storage_path, 2)
+    storage = ReplicatedStorage(backends)
+    get_storage('local', backends[1]['options']).upload(BytesIO(content), 'my-file.txt', 'assets')
+
+    target = storage.download('assets/my-file.txt')
+    assert target.fileobj.read() == content
+    target.fileobj.close()
+
+
+def test_download_non_existing_file(storage_path):
+    storage = ReplicatedStorage(_local_backends(storage_path, 2))
+    with pytest.raises(exc.ObjectNotFound):
+        storage.download('assets/other-file.txt')
+
+
+def test_delete_from_all_replicas(storage_path):
+    content = b'This is the contents of the file'
+    storage = ReplicatedStorage(_local_backends(storage_path, 2), quorum=2)
+    storage.upload(BytesIO(content), 'my-file.txt', 'assets')
+
+    assert storage.delete('assets/my-file.txt')
+    for i in range(2):
+        assert not (storage_path / 'replica{}'.format(i) / 'assets' / 'my-file.txt').exists()
@@ -0,0 +1,155 @@
+"""Tests for the resilient storage backend
+"""
+import time
+
+import pytest
+from six import BytesIO
+
+from ckanext.asset_storage.storage import DownloadTarget, StorageBackend, exc, get_storage
+from ckanext.asset_storage.storage.resilient import CircuitBreaker, ResilientStorage
+
+
+class FlakyStorage(StorageBackend):
+    """A storage backend that fails or stalls according to a script
+
+    Each call pops the next action from `script`: a number means sleep for
+    this many seconds and succeed, 'fail' means raise an error. Once the
+    script is exhausted, all calls succeed.
+    """
+    instances = []
+
+    def __init__(self, script=()):
+        self.script = list(script)
+        self.calls = 0
+        FlakyStorage.instances.append(self)
+
+    def get_storage_uri(self, name, prefix=None):
+        return '{}/{}'.format(prefix, name)
+
+    def upload(self, stream, name, prefix=None, mimetype=None, content_encoding=None):
+        self._act()
+        return len(stream.read())
+
+    def download(self, uri):
+        if uri == 'not/found':
+            raise exc.ObjectNotFound('The requested file was not found')
+        self._act()
+        return DownloadTarget.redirect('https://example.com/{}'.format(uri))
+
+    def delete(self, uri):
+        self._act()
+        return True
+
+    def _act(self):
+        self.calls += 1
+        action = self.script.pop(0) if self.script else 0
+        if action == 'fail':
+            raise IOError('Storage is flaky')
+        time.sleep(action)
+
+
+def _resilient_storage(script=(), **kwargs):
+    kwargs.setdefault('backoff_base', 0.001)
+    storage = ResilientStorage({'type': 'ckanext.asset_storage.tests.test_storage_resilient:FlakyStorage',
+                                'options': {'script': script}}, **kwargs)
+    return storage, FlakyStorage.instances[-1]
+
+
+def test_storage_fetched_from_factory(storage_path):
+    storage = get_storage('resilient', {'backend': {'type': 'local', 'options': {'storage_path': str(storage_path)}}})
+    assert isinstance(storage, ResilientStorage)
+
+
+def test_download_retried_on_failure():
+    storage, backend = _resilient_storage(['fail', 'fail'], retries=2)
+    target = storage.download('assets/my-file.txt')
+    assert target.redirect_to == 'https://example.com/assets/my-file.txt'
+    assert backend.calls == 3
+
+
+def test_download_fails_after_retries():
+    storage, backend = _resilient_storage(['fail', 'fail', 'fail'], retries=2)
+    with pytest.raises(exc.StorageError):
+        storage.download('assets/my-file.txt')
+    assert backend.calls == 3
+
+
+def test_not_found_is_not_retried():
+    storage, backend = _resilient_storage(retries=2)
+    with pytest.raises(exc.ObjectNotFound):
+        storage.download('not/found')
+
+
+def test_download_times_out():
+    storage, backend = _resilient_storage([0.5], timeout=0.05, retries=0)
+    with pytest.raises(exc.StorageTimeout):
+        storage.download('assets/my-file.txt')
+
+
+def test_deadline_includes_retries():
+    storage, backend = _resilient_storage([0.15, 0.15, 0.15], timeout=0.1, retries=2)
+    start = time.time()
+    with pytest.raises(exc.StorageTimeout):
+        storage.download('assets/my-file.txt')
+    assert time.time() - start < 0.15
+    assert backend.calls == 1
+
+
+def test_no_retry_after_deadline():
+    storage, backend = _resilient_storage(['fail', 'fail'], timeout=0.1, retries=2, backoff_base=1, backoff_max=1)
+    storage._backoff = lambda attempt: 0.2
+    with pytest.raises(exc.StorageError):
+        storage.download('assets/my-file.txt')
+    assert backend.calls == 1
+
+
+def test_upload_retried_from_start_of_stream():
+    content = b'This is the contents of the file'
+    storage, backend = _resilient_storage(['fail'], retries=1)
+    assert storage.upload(BytesIO(content), 'my-file.txt', 'assets') == len(content)
+    assert backend.calls == 2
+
+
+def test_upload_not_retried_after_timeout():
+    storage, backend = _resilient_storage([0.5], upload_timeout=0.05, retries=2)
+    with pytest.raises(exc.StorageTimeout):
+        storage.upload(BytesIO(b'content'), 'my-file.txt', 'assets')
+    assert backend.calls == 1
+
+
+def test_circuit_opens_after_repeated_failures():
+    storage, backend = _resilient_storage(['fail'] * 3, retries=0, circuit_threshold=3)
+    for _ in range(3):
+        with pytest.raises(exc.StorageError):
+            storage.delete('assets/my-file.txt')
+
+    with pytest.raises(exc.StorageUnavailable):
+        storage.delete('assets/my-file.txt')
+    assert backend.calls == 3
+
+
+def test_hedged_download_returns_first_response():
+    storage, backend = _resilient_storage([0] * 5 + [2], hedge_percentile=95, hedge_min_samples=5, timeout=1)
+    for _ in range(5):
+        storage.download('assets/my-file.txt')
+
+    start = time.time()
+    target = storage.download('assets/my-file.txt')
+    assert time.time() - start < 1
+    assert target.redirect_to == 'https://example.com/assets/my-file.txt'
+    assert backend.calls == 7
+
+
+def test_circuit_breaker_allows_trial_after_reset_timeout():
+    circuit = CircuitBreaker(threshold=2, reset_timeout=0.05)
+    circuit.record_failure()
+    assert circuit.allow()
+    circuit.record_failure()
+    assert not circuit.allow()
+
+    time.sleep(0.06)
+    assert circuit.allow()
+    assert not circuit.allow()
+
+    circuit.record_success()
+    assert circuit.allow()
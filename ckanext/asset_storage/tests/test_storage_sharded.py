@@ -0,0 +1,246 @@
+"""Tests for the sharded storage backend
+"""
+import os
+
+import pytest
+from six import BytesIO
+from six.moves.urllib.request import pathname2url
+
+from ckanext.asset_storage.storage import DownloadTarget, exc, get_storage, sharded
+from ckanext.asset_storage.storage.local import LocalStorage
+from ckanext.asset_storage.storage.sharded import ShardedStorage
+
+
+class RedirectingStorage(LocalStorage):
+    """A local storage backend which redirects downloads to a file URL, like cloud storage redirects to a signed URL
+    """
+    def download(self, uri):
+        if not self.exists(uri):
+            raise exc.ObjectNotFound('The requested file was not found')
+        return DownloadTarget.redirect('file:' + pathname2url(os.path.join(self._path, uri)))
+
+
+class TellingStorage(LocalStorage):
+    """A local storage backend which tells the number of bytes written from the stream position, like cloud storage
+    """
+    def upload(self, stream, name, prefix=None, mimetype=None, content_encoding=None):
+        super(TellingStorage, self).upload(stream, name, prefix, mimetype=mimetype, content_encoding=content_encoding)
+        return stream.tell()
+
+
+class NonSeekableResponse(object):
+    """A response to a redirect URL which can only be read, like an HTTP response
+    """
+    def __init__(self, content, mimetype):
+        self._stream = BytesIO(content)
+        self._headers = {'Content-Type': mimetype}
+
+    def read(self, size=-1):
+        return self._stream.read(size)
+
+    def info(self):
+        return self._headers
+
+    def close(self):
+        pass
+
+
+def _backend_configs(storage_path, shards):
+    configs = []
+    for index in range(shards):
+        path = storage_path / 'shard-{}'.format(index)
+        if not path.exists():
+            path.mkdir()
+        configs.append({'type': 'local', 'options': {'storage_path': str(path)}})
+    return configs
+
+
+def _sharded_storage(storage_path, shards=3, **kwargs):
+    return ShardedStorage(_backend_configs(storage_path, shards), **kwargs)
+
+
+def _stored_files(storage_path):
+    return sorted(str(p.relative_to(storage_path)) for p in storage_path.rglob('*') if p.is_file())
+
+
+def _names(count):
+    return ['2020-01-01-{:06d}-my-file.txt'.format(i) for i in range(count)]
+
+
+def test_storage_fetched_from_factory(storage_path):
+    storage = get_storage('sharded', {'backends': [{'type': 'local', 'options': {'storage_path': str(storage_path)}}]})
+    assert isinstance(storage, ShardedStorage)
+
+
+def test_storage_requires_backends():
+    with pytest.raises(ValueError):
+        ShardedStorage([])
+
+
+def test_storage_validates_key_prefixes(storage_path):
+    with pytest.raises(ValueError):
+        _sharded_storage(storage_path, key_prefixes=257)
+
+
+def test_uploads_spread_across_backends(storage_path):
+    storage = _sharded_storage(storage_path)
+    for name in _names(60):
+        storage.upload(BytesIO(b'content'), name, 'group')
+
+    for index in range(3):
+        count = len(list((storage_path / 'shard-{}'.format(index) / 'group').iterdir()))
+        assert 10 < count < 30
+
+
+def test_shard_is_stable(storage_path):
+    storage = _sharded_storage(storage_path)
+    other = _sharded_storage(storage_path)
+    for name in _names(20):
+        assert storage.get_location('group/' + name) == other.get_location('group/' + name)
+
+
+def test_upload_download_delete(storage_path):
+    content = b'This is the contents of the file'
+    storage = _sharded_storage(storage_path, key_prefixes=16)
+    uri = storage.get_storage_uri('my-file.txt', 'group')
+    assert 'group/my-file.txt' == uri
+
+    storage.upload(BytesIO(content), 'my-file.txt', 'group')
+    index, key = storage.get_location(uri)
+    assert key.endswith('/group/my-file.txt')
+    assert (storage_path / 'shard-{}'.format(index) / key).read_bytes() == content
+
+    target = storage.download(uri)
+    assert target.fileobj.read() == content
+    target.fileobj.close()
+    assert storage.exists(uri)
+
+    assert storage.delete(uri)
+    assert not storage.exists(uri)
+    with pytest.raises(exc.ObjectNotFound):
+        storage.download(uri)
+
+
+def test_key_prefixes_spread_files(storage_path):
+    storage = _sharded_storage(storage_path, shards=1, key_prefixes=16)
+    for name in _names(200):
+        storage.upload(BytesIO(b'content'), name, 'group')
+    key_prefixes = [p.name for p in (storage_path / 'shard-0').iterdir()]
+    assert 16 == len(key_prefixes)
+    assert all(len(p) == 2 for p in key_prefixes)
+
+
+def test_iter_uris(storage_path):
+    storage = _sharded_storage(storage_path, key_prefixes=4)
+    names = _names(20)
+    for name in names:
+        storage.upload(BytesIO(b'content'), name, 'group')
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'user')
+
+    assert sorted('group/' + name for name in names) == sorted(storage.iter_uris('group'))
+    assert 21 == len(list(storage.iter_uris()))
+
+
+def test_download_from_other_shard(storage_path):
+    content = b'This is the contents of the file'
+    old_storage = _sharded_storage(storage_path, shards=2)
+    old_storage.upload(BytesIO(content), 'my-file.txt', 'group')
+
+    storage = _sharded_storage(storage_path, shards=4, key_prefixes=16, search_all_shards=True)
+    target = storage.download('group/my-file.txt')
+    assert target.fileobj.read() == content
+    target.fileobj.close()
+
+    storage = _sharded_storage(storage_path, shards=4, key_prefixes=16)
+    with pytest.raises(exc.ObjectNotFound):
+        storage.download('group/my-file.txt')
+
+
+@pytest.mark.parametrize('key_prefixes', [0, 7, 32, 256])
+def test_download_after_changing_key_prefixes(storage_path, key_prefixes):
+    names = _names(20)
+    old_storage = _sharded_storage(storage_path, key_prefixes=16)
+    for name in names:
+        old_storage.upload(BytesIO(name.encode('utf-8')), name, 'group')
+
+    storage = _sharded_storage(storage_path, key_prefixes=key_prefixes, search_all_shards=True)
+    for name in names:
+        assert storage.exists('group/' + name)
+        target = storage.download('group/' + name)
+        assert target.fileobj.read() == name.encode('utf-8')
+        target.fileobj.close()
+
+
+def test_adding_shards_only_moves_files_to_new_shards(storage_path):
+    names = _names(400)
+    old_storage = _sharded_storage(storage_path, shards=3, key_prefixes=16)
+    storage = _sharded_storage(storage_path, shards=4, key_prefixes=32)
+
+    moved = 0
+    for name in names:
+        (old_index, old_key), (index, key) = (s.get_location('group/' + name) for s in (old_storage, storage))
+        assert index in {old_index, 3}
+        assert key == old_key or key.startswith(tuple('{:02x}/'.format(p) for p in range(16, 32)))
+        moved += index != old_index
+    assert 50 < moved < 150
+
+
+def test_reshard(storage_path):
+    old_storage = _sharded_storage(storage_path, shards=2)
+    names = _names(30)
+    for name in names:
+        old_storage.upload(BytesIO(name.encode('utf-8')), name, 'group')
+
+    storage = _sharded_storage(storage_path, shards=3, key_prefixes=8)
+    before = _stored_files(storage_path)
+    moves = list(storage.reshard(dry_run=True))
+    assert moves
+    assert before == _stored_files(storage_path)
+
+    moved = list(storage.reshard())
+    assert moves == moved
+    assert 30 == len(_stored_files(storage_path))
+    assert not list(storage.iter_misplaced())
+    for name in names:
+        index, key = storage.get_location('group/' + name)
+        assert (storage_path / 'shard-{}'.format(index) / key).read_bytes() == name.encode('utf-8')
+
+    for name in names:
+        target = storage.download('group/' + name)
+        assert target.fileobj.read() == name.encode('utf-8')
+        target.fileobj.close()
+
+
+def test_reshard_copies_from_redirect_urls(storage_path):
+    content = b'This is the contents of the file'
+    configs = _backend_configs(storage_path, 2)
+    for config in configs:
+        config['type'] = 'ckanext.asset_storage.tests.test_storage_sharded:RedirectingStorage'
+    ShardedStorage(configs[:1]).upload(BytesIO(content), 'my-file.txt', 'group')
+
+    storage = ShardedStorage(configs, key_prefixes=4)
+    source = (0, 'group/my-file.txt')
+    stream, mimetype, _ = storage._fetch(storage._backends[0].download(source[1]))
+    with stream:
+        assert 0 == stream.tell()
+        assert content == stream.read()
+    assert 'text/plain' == mimetype
+
+    assert len(content) == storage.move(source, storage.get_location('group/my-file.txt'))
+    assert not list(storage.iter_misplaced())
+    index, key = storage.get_location('group/my-file.txt')
+    assert (storage_path / 'shard-{}'.format(index) / key).read_bytes() == content
+
+
+def test_move_non_seekable_stream_from_redirect_url(storage_path, monkeypatch):
+    content = b'This is the contents of the file'
+    configs = _backend_configs(storage_path, 2)
+    configs[0]['type'] = 'ckanext.asset_storage.tests.test_storage_sharded:RedirectingStorage'
+    configs[1]['type'] = 'ckanext.asset_storage.tests.test_storage_sharded:TellingStorage'
+    ShardedStorage(configs[:1]).upload(BytesIO(content), 'my-file.txt', 'group')
+    monkeypatch.setattr(sharded, 'urlopen', lambda url, timeout: NonSeekableResponse(content, 'text/plain'))
+
+    storage = ShardedStorage(configs)
+    assert len(content) == storage.move((0, 'group/my-file.txt'), (1, 'group/my-file.txt'))
+    assert (storage_path / 'shard-1' / 'group' / 'my-file.txt').read_bytes() == content
+    assert not (storage_path / 'shard-0' / 'group' / 'my-file.txt').exists()
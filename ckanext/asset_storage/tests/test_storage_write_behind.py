@@ -0,0 +1,256 @@
+"""Tests for the write-behind storage backend
+"""
+import os
+import threading
+import time
+
+import pytest
+from six import BytesIO
+
+from ckanext.asset_storage.storage import exc, get_storage
+from ckanext.asset_storage.storage.local import LocalStorage
+from ckanext.asset_storage.storage.write_behind import WriteBehindStorage
+
+
+class GatedStorage(LocalStorage):
+    """A local storage backend which fails uploads a number of times, and holds uploads until a gate is opened
+    """
+    instances = []
+
+    def __init__(self, storage_path, failures=0):
+        super(GatedStorage, self).__init__(storage_path)
+        self.failures = failures
+        self.uploads = 0
+        self.gate = threading.Event()
+        self.gate.set()
+        self.waiting = threading.Event()
+        GatedStorage.instances.append(self)
+
+    def upload(self, stream, name, prefix=None, mimetype=None, content_encoding=None):
+        self.waiting.set()
+        self.gate.wait()
+        self.uploads += 1
+        if self.failures > 0:
+            self.failures -= 1
+            raise IOError('Storage is unavailable')
+        return super(GatedStorage, self).upload(stream, name, prefix, mimetype, content_encoding)
+
+
+class PublicStorage(LocalStorage):
+    """A local storage backend which generates absolute URLs, like publicly readable cloud storage
+    """
+    def get_storage_uri(self, name, prefix=None):
+        return 'https://storage.example.com/' + super(PublicStorage, self).get_storage_uri(name, prefix)
+
+
+@pytest.fixture()
+def spool(storage_path):
+    storages = []
+
+    def factory(failures=0, **kwargs):
+        kwargs.setdefault('backoff_base', 0.001)
+        kwargs.setdefault('backoff_max', 0.01)
+        backend = {'type': 'ckanext.asset_storage.tests.test_storage_write_behind:GatedStorage',
+                   'options': {'storage_path': str(storage_path / 'backend'), 'failures': failures}}
+        storage = WriteBehindStorage(backend, str(storage_path / 'spool'), **kwargs)
+        storages.append(storage)
+        return storage, GatedStorage.instances[-1]
+
+    (storage_path / 'backend').mkdir()
+    yield factory
+    for storage in storages:
+        storage.close()
+
+
+def _spooled_files(storage_path):
+    return [name for name in os.listdir(str(storage_path / 'spool')) if not name.startswith('.')]
+
+
+def test_storage_fetched_from_factory(storage_path):
+    storage = get_storage('write_behind', {'backend': {'type': 'local', 'options': {'storage_path': str(storage_path)}},
+                                           'spool_path': str(storage_path / 'spool')})
+    assert isinstance(storage, WriteBehindStorage)
+    storage.close()
+
+
+def test_storage_requires_relative_uris(storage_path):
+    backend = {'type': 'ckanext.asset_storage.tests.test_storage_write_behind:PublicStorage',
+               'options': {'storage_path': str(storage_path)}}
+    with pytest.raises(ValueError):
+        WriteBehindStorage(backend, str(storage_path / 'spool'))
+
+
+def test_upload_is_pushed_and_evicted(storage_path, spool):
+    content = b'This is the contents of the file'
+    storage, backend = spool()
+    assert len(content) == storage.upload(BytesIO(content), 'my-file.txt', 'group', mimetype='text/plain')
+
+    assert storage.flush(timeout=5)
+    assert (storage_path / 'backend' / 'group' / 'my-file.txt').read_bytes() == content
+    assert [] == _spooled_files(storage_path)
+
+
+def test_upload_does_not_wait_for_backend(storage_path, spool):
+    content = b'This is the contents of the file'
+    storage, backend = spool()
+    backend.gate.clear()
+    storage.upload(BytesIO(content), 'my-file.txt', 'group')
+
+    assert not storage.flush(timeout=0.05)
+    assert not (storage_path / 'backend' / 'group' / 'my-file.txt').exists()
+    assert storage.exists('group/my-file.txt')
+    backend.gate.set()
+    assert storage.flush(timeout=5)
+
+
+def test_download_from_spool_until_pushed(storage_path, spool):
+    content = b'This is the contents of the file'
+    storage, backend = spool()
+    backend.gate.clear()
+    storage.upload(BytesIO(content), 'my-file.json', 'group', mimetype='application/json', content_encoding='gzip')
+
+    target = storage.download('group/my-file.json')
+    assert target.fileobj.read() == content
+    assert 'application/json' == target.mimetype
+    assert 'gzip' == target.content_encoding
+    target.fileobj.close()
+
+    backend.gate.set()
+    assert storage.flush(timeout=5)
+    target = storage.download('group/my-file.json')
+    assert target.fileobj.read() == content
+    target.fileobj.close()
+
+
+def test_failed_pushes_are_retried(storage_path, spool):
+    content = b'This is the contents of the file'
+    storage, backend = spool(failures=3)
+    storage.upload(BytesIO(content), 'my-file.txt', 'group')
+
+    assert storage.flush(timeout=5)
+    assert 4 == backend.uploads
+    assert (storage_path / 'backend' / 'group' / 'my-file.txt').read_bytes() == content
+
+
+def test_delete_spooled_file(storage_path, spool):
+    storage, backend = spool()
+    backend.gate.clear()
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group')
+
+    assert storage.delete('group/my-file.txt')
+    assert not storage.exists('group/my-file.txt')
+    with pytest.raises(exc.ObjectNotFound):
+        storage.download('group/my-file.txt')
+
+    backend.gate.set()
+    assert storage.flush(timeout=5)
+    assert not (storage_path / 'backend' / 'group' / 'my-file.txt').exists()
+    assert [] == _spooled_files(storage_path)
+
+
+def test_delete_pushed_file(storage_path, spool):
+    storage, backend = spool()
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group')
+    assert storage.flush(timeout=5)
+
+    assert storage.delete('group/my-file.txt')
+    assert not storage.exists('group/my-file.txt')
+    assert [] == list(storage.iter_uris('group'))
+    assert storage.flush(timeout=5)
+    assert not (storage_path / 'backend' / 'group' / 'my-file.txt').exists()
+    assert [] == _spooled_files(storage_path)
+
+
+def test_delete_does_not_wait_for_pushes(storage_path, spool):
+    storage, backend = spool(workers=1)
+    backend.gate.clear()
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group')
+    assert backend.waiting.wait(timeout=5)
+
+    # Neither the file being pushed, nor any other file, waits for the push to complete
+    for uri in ('group/my-file.txt', 'group/other-file.txt'):
+        thread = threading.Thread(target=storage.delete, args=(uri,))
+        thread.start()
+        thread.join(timeout=1)
+        assert not thread.is_alive()
+
+    backend.gate.set()
+    assert storage.flush(timeout=5)
+    assert not (storage_path / 'backend' / 'group' / 'my-file.txt').exists()
+    assert [] == _spooled_files(storage_path)
+
+
+def test_replaced_while_pushing(storage_path, spool):
+    storage, backend = spool(workers=1)
+    backend.gate.clear()
+    storage.upload(BytesIO(b'old content'), 'my-file.txt', 'group')
+    time.sleep(0.05)
+    storage.upload(BytesIO(b'new content'), 'my-file.txt', 'group')
+
+    backend.gate.set()
+    assert storage.flush(timeout=5)
+    assert (storage_path / 'backend' / 'group' / 'my-file.txt').read_bytes() == b'new content'
+    assert [] == _spooled_files(storage_path)
+
+
+def test_iter_uris_includes_spooled_files(storage_path, spool):
+    storage, backend = spool()
+    storage.upload(BytesIO(b'content'), 'pushed.txt', 'group')
+    assert storage.flush(timeout=5)
+    backend.gate.clear()
+    storage.upload(BytesIO(b'content'), 'spooled.txt', 'group')
+    storage.upload(BytesIO(b'content'), 'other.txt', 'user')
+
+    assert ['group/pushed.txt', 'group/spooled.txt'] == sorted(storage.iter_uris('group'))
+    backend.gate.set()
+
+
+def test_recovery_on_start_up(storage_path, spool):
+    content = b'This is the contents of the file'
+    # A process without workers crashes before pushing its file
+    storage, backend = spool(workers=0)
+    storage.upload(BytesIO(content), 'my-file.txt', 'group')
+    assert not (storage_path / 'backend' / 'group' / 'my-file.txt').exists()
+
+    # Left over from a crash while writing a file
+    temp_file = storage_path / 'spool' / '.tmp-crashed'
+    temp_file.write_bytes(b'partial')
+    os.utime(str(temp_file), (time.time() - 7200, time.time() - 7200))
+
+    storage, backend = spool()
+    assert storage.flush(timeout=5)
+    assert (storage_path / 'backend' / 'group' / 'my-file.txt').read_bytes() == content
+    assert not temp_file.exists()
+    assert [] == _spooled_files(storage_path)
+
+
+def test_rescan_pushes_files_of_other_processes(storage_path, spool):
+    content = b'This is the contents of the file'
+    storage, backend = spool(rescan_interval=0.05)
+    assert storage.flush(timeout=5)
+    # Another process dies without pushing its file
+    other, _ = spool(workers=0)
+    other.upload(BytesIO(content), 'my-file.txt', 'group')
+
+    deadline = time.time() + 5
+    while _spooled_files(storage_path) and time.time() < deadline:
+        time.sleep(0.01)
+    assert (storage_path / 'backend' / 'group' / 'my-file.txt').read_bytes() == content
+
+
+def test_workers_started_on_first_use(storage_path, spool, monkeypatch):
+    storage, backend = spool()
+    assert [] == storage._threads
+
+    storage.upload(BytesIO(b'content'), 'my-file.txt', 'group')
+    threads = list(storage._threads)
+    assert 2 == len(threads)
+    assert storage.flush(timeout=5)
+
+    # Threads of the parent process do not exist in a forked process
+    monkeypatch.setattr(os, 'getpid', lambda: -1)
+    storage.upload(BytesIO(b'content'), 'other-file.txt', 'group')
+    assert 2 == len(storage._threads)
+    assert not set(threads) & set(storage._threads)
+    assert storage.flush(timeout=5)
+    assert (storage_path / 'backend' / 'group' / 'other-file.txt').exists()
@@ -0,0 +1,62 @@
+"""Tests for the tracing module
+"""
+import pytest
+
+from ckanext.asset_storage import tracing
+
+
+@pytest.fixture(autouse=True)
+def reset_timings():
+    yield
+    tracing.stop_timings()
+
+
+def test_span_timings_collected():
+    tracing.start_timings()
+    with tracing.span('outer'):
+        with tracing.span('inner', {'some.attribute': 'value'}):
+            pass
+    timings = tracing.stop_timings()
+    assert ['inner', 'outer'] == [name for name, _ in timings]
+    assert all(duration >= 0 for _, duration in timings)
+
+
+def test_span_timings_not_collected_by_default():
+    with tracing.span('outer'):
+        pass
+    assert [] == tracing.stop_timings()
+
+
+def test_span_timing_recorded_on_error():
+    tracing.start_timings()
+    with pytest.raises(ValueError):
+        with tracing.span('failing'):
+            raise ValueError('Oops')
+    assert ['failing'] == [name for name, _ in tracing.stop_timings()]
+
+
+def test_stop_timings_resets_collection():
+    tracing.start_timings()
+    with tracing.span('first'):
+        pass
+    tracing.stop_timings()
+    with tracing.span('second'):
+        pass
+    assert [] == tracing.stop_timings()
+
+
+def test_configure_without_opentelemetry(monkeypatch):
+    monkeypatch.setattr(tracing, 'otel_trace', None)
+    tracing.configure(enabled=True)
+    with tracing.span('some_span'):
+        pass
+    tracing.configure(enabled=False)
+
+
+def test_format_server_timing():
+    header = tracing.format_server_timing([('get_storage', 0.0012), ('download', 0.25)])
+    assert 'get_storage;dur=1.2, download;dur=250.0' == header
+
+
+def test_format_server_timing_empty():
+    assert '' == tracing.format_server_timing([])
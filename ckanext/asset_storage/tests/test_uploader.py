@@ -1,12 +1,15 @@
 """Tests for the uploader module
 """
+import gzip
 from cgi import FieldStorage
 
 import pytest
+from ckan.plugins import toolkit
 from six import BytesIO
 from werkzeug.datastructures import FileStorage
 
-from ckanext.asset_storage import uploader
+from ckanext.asset_storage import compression, direct_upload, placeholders, uploader
+from ckanext.asset_storage.storage.local import LocalStorage
 
 
 @pytest.mark.parametrize('value,expected', [
@@ -111,3 +114,237 @@ def test_uploader_property():
                                       headers={"content-disposition": 'form-data; name="file"; filename="foo.png"'})}
     up.update_data_dict(data_dict, 'url', 'file', 'clear')
     assert up.filename.endswith('-foo.png')
+
+
+@pytest.mark.ckan_config(uploader.CONF_PRECOMPRESS, 'true')
+def test_uploader_upload_creates_compressed_variants(storage_path):
+    """Test that compressed variants of compressible files are uploaded
+    """
+    content = b'<svg xmlns="http://www.w3.org/2000/svg"><rect width="10" height="10"/></svg>' * 20
+    backend = LocalStorage(str(storage_path))
+    up = uploader.AssetUploader(backend, 'group')
+    data_dict = {'url': 'logo.svg',
+                 'clear': '',
+                 'file': FileStorage(name='file', filename='logo.svg', stream=BytesIO(content))}
+    up.update_data_dict(data_dict, 'url', 'file', 'clear')
+    up.upload()
+
+    uri = backend.get_storage_uri(up.filename, 'group')
+    target = backend.download(compression.variant_name(uri, 'gzip'))
+    assert target.content_encoding == 'gzip'
+    assert gzip.GzipFile(fileobj=target.fileobj).read() == content
+
+
+def _png_bytes():
+    Image = pytest.importorskip('PIL.Image')
+    output = BytesIO()
+    Image.new('RGB', (64, 48), color=(200, 30, 30)).save(output, 'PNG')
+    return output.getvalue()
+
+
+@pytest.mark.ckan_config(uploader.CONF_PLACEHOLDERS, 'true')
+def test_uploader_upload_creates_placeholder(storage_path):
+    backend = LocalStorage(str(storage_path))
+    up = uploader.AssetUploader(backend, 'group')
+    data_dict = {'url': 'logo.png',
+                 'clear': '',
+                 'file': FileStorage(name='file', filename='logo.png', stream=BytesIO(_png_bytes()),
+                                     content_type='image/png')}
+    up.update_data_dict(data_dict, 'url', 'file', 'clear')
+    up.upload()
+
+    metadata = placeholders.load_metadata(backend, 'group/' + up.filename)
+    assert 64 == metadata['width']
+    assert 48 == metadata['height']
+
+
+@pytest.mark.ckan_config(uploader.CONF_PLACEHOLDERS, 'true')
+def test_uploader_upload_placeholder_of_unseekable_stream(storage_path):
+    class UnseekableStream(object):
+        def read(self, size=-1):
+            return b''
+
+    backend = LocalStorage(str(storage_path))
+    up = uploader.AssetUploader(backend, 'group')
+    up._filename = 'logo.png'
+    up._upload_placeholder(UnseekableStream())
+    assert not (storage_path / 'group' / 'logo.png.meta.json').exists()
+
+
+@pytest.mark.ckan_config(uploader.CONF_PLACEHOLDERS, 'true')
+@pytest.mark.ckan_config(uploader.CONF_PRECOMPRESS, 'true')
+@pytest.mark.parametrize('old_name,related_names', [
+    ('old-logo.png', ['old-logo.png.meta.json']),
+    ('old-logo.svg', [compression.variant_name('old-logo.svg', e) for e in compression.available_encodings()]),
+])
+def test_uploader_replace_deletes_old_file(storage_path, old_name, related_names):
+    """Test that replacing an asset deletes the old file, along with its placeholder metadata or compressed variants
+    """
+    backend = LocalStorage(str(storage_path))
+    for name in [old_name] + related_names:
+        backend.upload(BytesIO(b'old content'), name, 'group')
+    up = uploader.AssetUploader(backend, 'group', 'group/' + old_name)
+    data_dict = {'url': 'new-logo.txt',
+                 'clear': '',
+                 'file': FileStorage(name='file', filename='new-logo.txt', stream=BytesIO(b'new content'))}
+    up.update_data_dict(data_dict, 'url', 'file', 'clear')
+    up.upload()
+
+    assert ['group/' + up.filename] == list(backend.iter_uris('group'))
+
+
+@pytest.mark.ckan_config(uploader.CONF_PLACEHOLDERS, 'true')
+def test_uploader_clear_deletes_old_file(storage_path):
+    backend = LocalStorage(str(storage_path))
+    for name in ('old-logo.png', 'old-logo.png.meta.json'):
+        backend.upload(BytesIO(b'old content'), name, 'group')
+    up = uploader.AssetUploader(backend, 'group', 'group/old-logo.png')
+    data_dict = {'url': 'group/old-logo.png', 'clear': 'true'}
+    up.update_data_dict(data_dict, 'url', 'file', 'clear')
+    up.upload()
+
+    assert '' == data_dict['url']
+    assert [] == list(backend.iter_uris('group'))
+
+
+def test_uploader_clear_deletes_old_file_given_its_url(storage_path):
+    backend = LocalStorage(str(storage_path))
+    backend.upload(BytesIO(b'old'), 'old-logo.png', 'group')
+    old_url = toolkit.url_for('asset_storage.uploaded_file', file_uri='group/old-logo.png', _external=True)
+    up = uploader.AssetUploader(backend, 'group', old_filename=old_url)
+    up.update_data_dict({'image_url': old_url, 'clear_upload': '1'}, 'image_url', 'image_upload', 'clear_upload')
+    up.upload()
+    assert not backend.exists('group/old-logo.png')
+
+
+@pytest.mark.ckan_config(uploader.CONF_DIRECT_UPLOADS, 'true')
+@pytest.mark.ckan_config('SECRET_KEY', 'not-so-secret')
+def test_uploader_direct_upload_token(storage_path):
+    """Test that a directly uploaded file is referenced by its upload token, once it is in storage
+    """
+    backend = LocalStorage(str(storage_path))
+    token = direct_upload.create_token('not-so-secret', 'group', '2020-01-01-000000-logo.png')
+    up = uploader.AssetUploader(backend, 'group', 'group/old-logo.png')
+    data_dict = {'url': '', 'clear': '', 'file_token': token}
+    up.update_data_dict(data_dict, 'url', 'file', 'clear')
+    assert '2020-01-01-000000-logo.png' == up.filename
+    assert data_dict['url'].endswith('/uploads/group/2020-01-01-000000-logo.png')
+    assert 'file_token' not in data_dict
+
+    with pytest.raises(toolkit.ValidationError):
+        up.upload()
+
+    backend.upload(BytesIO(b'new logo'), 'old-logo.png', 'group')
+    backend.upload(BytesIO(b'new logo'), '2020-01-01-000000-logo.png', 'group')
+    up.upload()
+    assert not (storage_path / 'group' / 'old-logo.png').exists()
+
+
+@pytest.mark.ckan_config(uploader.CONF_DIRECT_UPLOADS, 'true')
+@pytest.mark.ckan_config('SECRET_KEY', 'not-so-secret')
+@pytest.mark.parametrize('object_type,token', [
+    ('group', 'garbage'),
+    ('group', direct_upload.create_token('other-secret', 'group', 'logo.png')),
+    ('group', direct_upload.create_token('not-so-secret', 'user', 'logo.png')),
+    ('group', direct_upload.create_token('not-so-secret', 'group', 'logo.png', expires_in=-1)),
+])
+def test_uploader_invalid_direct_upload_token(storage_path, object_type, token):
+    up = uploader.AssetUploader(LocalStorage(str(storage_path)), object_type)
+    with pytest.raises(toolkit.ValidationError):
+        up.update_data_dict({'url': '', 'clear': '', 'file_token': token}, 'url', 'file', 'clear')
+
+
+def test_uploader_ignores_direct_upload_token_when_disabled(storage_path):
+    token = direct_upload.create_token('not-so-secret', 'group', 'logo.png')
+    up = uploader.AssetUploader(LocalStorage(str(storage_path)), 'group')
+    data_dict = {'url': '', 'clear': '', 'file_token': token}
+    up.update_data_dict(data_dict, 'url', 'file', 'clear')
+    assert up.filename == ''
+    assert '' == data_dict['url']
+
+
+def test_resource_uploader_updates_resource_dict(storage_path):
+    resource = {'url': '',
+                'upload': FileStorage(name='upload', filename='my data.csv', stream=BytesIO(b'a,b\n1,2\n'))}
+    up = uploader.ResourceUploader(LocalStorage(str(storage_path)), resource)
+    assert 'upload' not in resource
+    assert 'my-data.csv' == resource['url']
+    assert 'upload' == resource['url_type']
+    assert 'text/csv' == up.mimetype
+    assert 8 == up.filesize
+
+
+def test_resource_uploader_upload(storage_path):
+    backend = LocalStorage(str(storage_path))
+    resource = {'url': '', 'upload': FileStorage(name='upload', filename='data.csv', stream=BytesIO(b'a,b\n1,2\n'))}
+    up = uploader.ResourceUploader(backend, resource)
+    up.upload('resource-id')
+
+    assert 'resources/resource-id/data.csv' == up.get_path('resource-id')
+    assert b'a,b\n1,2\n' == backend.download('resources/resource-id/data.csv').fileobj.read()
+    assert up.get_url('resource-id') is None
+
+
+def test_resource_uploader_get_path_from_url(storage_path):
+    """The path of a previously uploaded file is taken from the resource URL, without listing files
+    """
+    class NoListingStorage(LocalStorage):
+        def iter_uris(self, prefix=None):
+            raise AssertionError('Storage should not be listed')
+
+    resource = {'id': 'resource-id',
+                'url': 'http://localhost:5000/dataset/dataset-id/resource/resource-id/download/data.csv',
+                'url_type': 'upload'}
+    up = uploader.ResourceUploader(NoListingStorage(str(storage_path)), resource)
+    assert 'resources/resource-id/data.csv' == up.get_path('resource-id')
+
+    up = uploader.ResourceUploader(NoListingStorage(str(storage_path)), {'id': 'resource-id', 'url': 'data.csv'})
+    with pytest.raises(uploader.exc.ObjectNotFound):
+        up.get_path('resource-id')
+
+
+def test_resource_uploader_refuses_public_storage(storage_path):
+    class PublicStorage(LocalStorage):
+        def get_storage_uri(self, name, prefix=None):
+            return 'https://storage.example.com/{}/{}'.format(prefix, name)
+
+    backend = PublicStorage(str(storage_path))
+    resource = {'url': '', 'upload': FileStorage(name='upload', filename='data.csv', stream=BytesIO(b'a,b\n1,2\n'))}
+    up = uploader.ResourceUploader(backend, resource)
+    with pytest.raises(toolkit.ValidationError):
+        up.upload('resource-id')
+    assert not backend.exists('resources/resource-id/data.csv')
+
+
+def test_resource_uploader_upload_too_large(storage_path):
+    backend = LocalStorage(str(storage_path))
+    resource = {'url': '', 'upload': FileStorage(name='upload', filename='data.csv', stream=BytesIO(b'a' * 2048))}
+    up = uploader.ResourceUploader(backend, resource)
+    up.filesize = None  # Size is not known in advance
+    with pytest.raises(uploader.toolkit.ValidationError):
+        up.upload('resource-id', max_size=0.001)
+    assert not backend.exists('resources/resource-id/data.csv')
+
+
+def test_resource_uploader_replaces_previous_file(storage_path):
+    backend = LocalStorage(str(storage_path))
+    backend.upload(BytesIO(b'old'), 'old.csv', 'resources/resource-id')
+    resource = {'id': 'resource-id',
+                'url': 'old.csv',
+                'upload': FileStorage(name='upload', filename='new.csv', stream=BytesIO(b'new'))}
+    up = uploader.ResourceUploader(backend, resource)
+    up.upload('resource-id')
+
+    assert ['resources/resource-id/new.csv'] == list(backend.iter_uris('resources/resource-id'))
+    assert 'resources/resource-id/new.csv' == up.get_path('resource-id')
+
+
+def test_resource_uploader_clear(storage_path):
+    backend = LocalStorage(str(storage_path))
+    backend.upload(BytesIO(b'old'), 'old.csv', 'resources/resource-id')
+    resource = {'id': 'resource-id', 'url': 'https://example.com/data.csv', 'clear_upload': 'true'}
+    up = uploader.ResourceUploader(backend, resource)
+    up.upload('resource-id')
+
+    assert '' == resource['url_type']
+    assert [] == list(backend.iter_uris('resources/resource-id'))
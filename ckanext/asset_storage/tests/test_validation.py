@@ -0,0 +1,113 @@
+"""Tests for the validation module
+"""
+import struct
+import zlib
+
+import pytest
+from six import BytesIO
+
+from ckanext.asset_storage import validation
+from ckanext.asset_storage.validation import ImageValidator, InvalidImage
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def _image_bytes(image_format, size=(64, 48), **save_args):
+    image = Image.new('RGB', size, color=(200, 30, 30))
+    output = BytesIO()
+    image.save(output, image_format, **save_args)
+    return output.getvalue()
+
+
+def _animated_gif_bytes(frames):
+    images = [Image.new('RGB', (16, 16), color=(i % 256, (i * 7) % 256, 0)) for i in range(frames)]
+    output = BytesIO()
+    images[0].save(output, 'GIF', save_all=True, append_images=images[1:], duration=100)
+    return output.getvalue()
+
+
+def _png_chunk(chunk_type, data):
+    crc = zlib.crc32(chunk_type + data) & 0xffffffff
+    return struct.pack('>I', len(data)) + chunk_type + data + struct.pack('>I', crc)
+
+
+def _png_header_only(width, height):
+    """A PNG file with a valid header declaring a (huge) size, but no actual pixel data
+    """
+    ihdr = struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)
+    return b'\x89PNG\r\n\x1a\n' + _png_chunk(b'IHDR', ihdr) + _png_chunk(b'IDAT', b'') + _png_chunk(b'IEND', b'')
+
+
+def test_read_image_info():
+    info = validation.read_image_info(BytesIO(_image_bytes('PNG')))
+    assert 'PNG' == info.format
+    assert 'image/png' == info.mimetype
+    assert (64, 48) == (info.width, info.height)
+    assert 1 == info.frames
+
+
+def test_read_image_info_of_invalid_image():
+    with pytest.raises(InvalidImage):
+        validation.read_image_info(BytesIO(b'not an image'))
+
+
+def test_count_gif_frames():
+    assert 7 == validation.count_gif_frames(BytesIO(_animated_gif_bytes(7)))
+    assert 1 == validation.count_gif_frames(BytesIO(_image_bytes('GIF')))
+
+
+def test_count_gif_frames_stops_after_max():
+    assert 4 == validation.count_gif_frames(BytesIO(_animated_gif_bytes(50)), max_frames=3)
+
+
+def test_validate_valid_image():
+    stream = BytesIO(_image_bytes('JPEG'))
+    info = ImageValidator(max_pixels=10000, max_dimension=100).validate(stream, 'image/jpeg')
+    assert 'JPEG' == info.format
+    assert 0 == stream.tell()
+
+
+def test_validate_mimetype_alias():
+    assert ImageValidator().validate(BytesIO(_image_bytes('JPEG')), 'image/jpg') is not None
+
+
+def test_validate_skips_other_types():
+    validator = ImageValidator()
+    assert validator.validate(BytesIO(b'<svg></svg>'), 'image/svg+xml') is None
+    assert validator.validate(BytesIO(b'some text'), 'text/plain') is None
+    assert validator.validate(BytesIO(b'some text'), None) is None
+
+
+def test_validate_format_mismatch():
+    with pytest.raises(InvalidImage) as e:
+        ImageValidator().validate(BytesIO(_image_bytes('JPEG')), 'image/png')
+    assert 'JPEG' in str(e.value)
+
+
+def test_validate_not_an_image():
+    with pytest.raises(InvalidImage):
+        ImageValidator().validate(BytesIO(b'<html></html>'), 'image/png')
+
+
+def test_validate_max_dimension():
+    with pytest.raises(InvalidImage):
+        ImageValidator(max_dimension=50).validate(BytesIO(_image_bytes('PNG')), 'image/png')
+
+
+def test_validate_max_pixels():
+    with pytest.raises(InvalidImage):
+        ImageValidator(max_pixels=1000).validate(BytesIO(_image_bytes('PNG')), 'image/png')
+
+
+def test_validate_decompression_bomb():
+    content = _png_header_only(30000, 30000)
+    assert len(content) < 100
+    with pytest.raises(InvalidImage):
+        ImageValidator(max_pixels=25000000).validate(BytesIO(content), 'image/png')
+
+
+def test_validate_max_frames():
+    validator = ImageValidator(max_frames=10)
+    assert 5 == validator.validate(BytesIO(_animated_gif_bytes(5)), 'image/gif').frames
+    with pytest.raises(InvalidImage):
+        validator.validate(BytesIO(_animated_gif_bytes(20)), 'image/gif')
@@ -0,0 +1,85 @@
+"""Lightweight request tracing
+
+Spans mark the phases of handling asset requests (e.g. getting the storage
+backend, checking if a file exists or signing a URL). If tracing is enabled
+and the `opentelemetry-api` Python package is installed, spans are exported
+as OpenTelemetry spans, using whatever exporter the OpenTelemetry SDK is set
+up with. Independently, span durations can be collected for the current
+request, so they can be reported to clients in a `Server-Timing` header.
+
+Timings are collected per thread; spans started in worker threads (e.g. by
+composite storage backends) are not included in the current request timings.
+"""
+import logging
+import threading
+from contextlib import contextmanager
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from ckanext.asset_storage.storage.stats import monotonic
+
+try:
+    from opentelemetry import trace as otel_trace
+except ImportError:
+    otel_trace = None
+
+_log = logging.getLogger(__name__)
+
+_tracer = None
+
+_state = threading.local()
+
+
+def configure(enabled=False):
+    # type: (bool) -> None
+    """Configure exporting spans to OpenTelemetry
+    """
+    global _tracer
+    if not enabled:
+        _tracer = None
+    elif otel_trace is None:
+        _log.warning('Tracing is enabled, but the opentelemetry-api package is not installed')
+        _tracer = None
+    else:
+        _tracer = otel_trace.get_tracer(__name__)
+
+
+@contextmanager
+def span(name, attributes=None):
+    # type: (str, Optional[Dict[str, Any]]) -> Iterator[None]
+    """Trace a phase of handling a request
+    """
+    start = monotonic()
+    try:
+        if _tracer is None:
+            yield
+        else:
+            with _tracer.start_as_current_span('asset_storage.{}'.format(name), attributes=attributes):
+                yield
+    finally:
+        timings = getattr(_state, 'timings', None)
+        if timings is not None:
+            timings.append((name, monotonic() - start))
+
+
+def start_timings():
+    # type: () -> None
+    """Start collecting span durations in the current thread
+    """
+    _state.timings = []
+
+
+def stop_timings():
+    # type: () -> List[Tuple[str, float]]
+    """Stop collecting span durations in the current thread, and get the
+    durations collected so far as a list of `(name, seconds)` tuples
+    """
+    timings = getattr(_state, 'timings', None) or []
+    _state.timings = None
+    return timings
+
+
+def format_server_timing(timings):
+    # type: (List[Tuple[str, float]]) -> str
+    """Format span durations as a `Server-Timing` header value
+    """
+    return ', '.join('{};dur={:.1f}'.format(name, seconds * 1000) for name, seconds in timings)
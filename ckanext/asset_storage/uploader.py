@@ -4,27 +4,71 @@ import datetime
 import logging
 import mimetypes
 import os
-from typing import Optional, Union
+import posixpath
+import tempfile
+import threading
+from contextlib import contextmanager
+from typing import Any, BinaryIO, Dict, Iterator, List, Optional, Union
 
-from ckan.lib.munge import munge_filename_legacy
+from ckan.lib.munge import munge_filename, munge_filename_legacy
 from ckan.lib.uploader import _get_underlying_file  # noqa
 from ckan.lib.uploader import ALLOWED_UPLOAD_TYPES, MB
 from ckan.plugins import toolkit
+from six import BytesIO
 from six.moves.urllib_parse import quote, unquote
 
-from ckanext.asset_storage.storage import StorageBackend, get_storage
+from ckanext.asset_storage import compression, direct_upload, placeholders, tracing
+from ckanext.asset_storage.admission import AdmissionController, AdmissionRejected
+from ckanext.asset_storage.cache import AssetCache
+from ckanext.asset_storage.optimizer import AssetOptimizer, get_optimizer
+from ckanext.asset_storage.storage import StorageBackend, exc, get_storage
+from ckanext.asset_storage.validation import ImageValidator, InvalidImage
 
 CONF_BACKEND_TYPE = 'ckanext.asset_storage.backend_type'
 CONF_BACKEND_CONFIG = 'ckanext.asset_storage.backend_options'
+CONF_PRECOMPRESS = 'ckanext.asset_storage.precompress'
+CONF_OPTIMIZER = 'ckanext.asset_storage.optimizer'
+CONF_OPTIMIZER_WORKERS = 'ckanext.asset_storage.optimizer_workers'
+CONF_OPTIMIZER_TIMEOUT = 'ckanext.asset_storage.optimizer_timeout'
+CONF_OPTIMIZER_MAX_SIZE = 'ckanext.asset_storage.optimizer_max_size'
+CONF_DIRECT_UPLOADS = 'ckanext.asset_storage.direct_uploads'
+CONF_SERVER_TIMING = 'ckanext.asset_storage.server_timing'
+CONF_CACHE_MAX_SIZE = 'ckanext.asset_storage.cache_max_size'
+CONF_CACHE_MAX_ITEM_SIZE = 'ckanext.asset_storage.cache_max_item_size'
+CONF_CACHE_TTL = 'ckanext.asset_storage.cache_ttl'
+CONF_PLACEHOLDERS = 'ckanext.asset_storage.placeholders'
+CONF_VALIDATE_IMAGES = 'ckanext.asset_storage.validate_images'
+CONF_IMAGE_MAX_PIXELS = 'ckanext.asset_storage.image_max_pixels'
+CONF_IMAGE_MAX_DIMENSION = 'ckanext.asset_storage.image_max_dimension'
+CONF_IMAGE_MAX_FRAMES = 'ckanext.asset_storage.image_max_frames'
+CONF_RESOURCE_UPLOADS = 'ckanext.asset_storage.resource_uploads'
+CONF_MAX_CONCURRENT_UPLOADS = 'ckanext.asset_storage.max_concurrent_uploads'
+CONF_MAX_QUEUED_UPLOADS = 'ckanext.asset_storage.max_queued_uploads'
+CONF_UPLOAD_QUEUE_TIMEOUT = 'ckanext.asset_storage.upload_queue_timeout'
+CONF_HOST_MAX_CONCURRENT_UPLOADS = 'ckanext.asset_storage.host_max_concurrent_uploads'
+CONF_HOST_UPLOAD_LOCK_DIR = 'ckanext.asset_storage.host_upload_lock_dir'
+
+RESOURCES_PREFIX = 'resources'
 
 # This is used for typing uploaded file form field wrapper
 UploadedFileWrapper = Union[ALLOWED_UPLOAD_TYPES]
 
 _log = logging.getLogger(__name__)
 
+_instances = {}
+_instances_lock = threading.Lock()
+
+_deferred_deletes = threading.local()
+
 
 def get_configured_storage():
     # type: () -> StorageBackend
+    """Get the configured storage backend
+
+    Storage backends are instantiated once per process and configuration, as
+    some backends hold state (e.g. client connections or background workers)
+    that should be reused across requests
+    """
     backend_type = toolkit.config.get(CONF_BACKEND_TYPE)
     config = toolkit.config.get(CONF_BACKEND_CONFIG, {})
     if not backend_type:
@@ -33,7 +77,119 @@ def get_configured_storage():
     if backend_type == 'local' and not config:
         config = {'storage_path': toolkit.config.get('ckan.storage_path')}
 
-    return get_storage(backend_type=backend_type, backend_config=config)
+    return _get_instance(('storage', backend_type, repr(config)),
+                         lambda: get_storage(backend_type=backend_type, backend_config=config))
+
+
+def get_configured_optimizer():
+    # type: () -> Optional[AssetOptimizer]
+    """Get the configured upload optimizer, if any
+
+    Like storage backends, optimizers are instantiated once per process and
+    configuration, as they hold a pool of worker processes
+    """
+    optimizer_type = toolkit.config.get(CONF_OPTIMIZER)
+    if not optimizer_type:
+        return None
+
+    workers = toolkit.asint(toolkit.config.get(CONF_OPTIMIZER_WORKERS, 2))
+    timeout = float(toolkit.config.get(CONF_OPTIMIZER_TIMEOUT, 5))
+    max_size = toolkit.asint(toolkit.config.get(CONF_OPTIMIZER_MAX_SIZE, 10)) * MB
+    return _get_instance(('optimizer', optimizer_type, workers, timeout, max_size),
+                         lambda: get_optimizer(optimizer_type, workers, timeout, max_size))
+
+
+def get_configured_cache():
+    # type: () -> Optional[AssetCache]
+    """Get the in-memory asset cache, if enabled
+    """
+    max_size = toolkit.asint(toolkit.config.get(CONF_CACHE_MAX_SIZE, 0)) * MB
+    if not max_size:
+        return None
+
+    max_item_size = toolkit.asint(toolkit.config.get(CONF_CACHE_MAX_ITEM_SIZE, 256)) * 1024
+    ttl = float(toolkit.config.get(CONF_CACHE_TTL, 300)) or None
+    return _get_instance(('cache', max_size, max_item_size, ttl),
+                         lambda: AssetCache(max_size, max_item_size, ttl))
+
+
+def get_configured_image_validator():
+    # type: () -> Optional[ImageValidator]
+    """Get the uploaded image validator, if image validation is enabled
+    """
+    if not toolkit.asbool(toolkit.config.get(CONF_VALIDATE_IMAGES, False)):
+        return None
+
+    max_pixels = toolkit.asint(toolkit.config.get(CONF_IMAGE_MAX_PIXELS, 25000000)) or None
+    max_dimension = toolkit.asint(toolkit.config.get(CONF_IMAGE_MAX_DIMENSION, 10000)) or None
+    max_frames = toolkit.asint(toolkit.config.get(CONF_IMAGE_MAX_FRAMES, 1000)) or None
+    return ImageValidator(max_pixels, max_dimension, max_frames)
+
+
+def get_configured_admission():
+    # type: () -> AdmissionController
+    """Get the upload admission controller
+
+    Without any configured limits, all uploads are admitted immediately
+    """
+    max_concurrent = toolkit.asint(toolkit.config.get(CONF_MAX_CONCURRENT_UPLOADS, 0)) or None
+    max_queued = toolkit.asint(toolkit.config.get(CONF_MAX_QUEUED_UPLOADS, 10))
+    timeout = float(toolkit.config.get(CONF_UPLOAD_QUEUE_TIMEOUT, 5))
+    host_max_concurrent = toolkit.asint(toolkit.config.get(CONF_HOST_MAX_CONCURRENT_UPLOADS, 0)) or None
+    lock_dir = toolkit.config.get(CONF_HOST_UPLOAD_LOCK_DIR) or os.path.join(tempfile.gettempdir(),
+                                                                             'ckanext-asset-storage-uploads')
+    key = ('admission', max_concurrent, max_queued, timeout, host_max_concurrent, lock_dir)
+    return _get_instance(key, lambda: AdmissionController(max_concurrent, max_queued, timeout,
+                                                          host_max_concurrent, lock_dir))
+
+
+def get_missing_variants():
+    # type: () -> compression.MissingVariants
+    """Get the per-process record of precompressed variants known not to exist
+    """
+    return _get_instance(('missing_variants',), compression.MissingVariants)
+
+
+def invalidate_cached(uri):
+    # type: (str) -> None
+    """Remove an asset and its precompressed variants from the in-memory cache,
+    and forget about its variants being missing
+    """
+    missing_variants = get_missing_variants()
+    for encoding in compression.available_encodings():
+        missing_variants.discard(compression.variant_name(uri, encoding))
+
+    cache = get_configured_cache()
+    if cache is None:
+        return
+    cache.invalidate(uri)
+    for encoding in compression.available_encodings():
+        cache.invalidate(compression.variant_name(uri, encoding))
+
+
+@contextmanager
+def defer_old_file_deletes():
+    # type: () -> Iterator[List[str]]
+    """Keep old files replaced by uploads in the current thread, instead of
+    deleting them
+
+    Yields a list which collects the URIs of the kept files, so they can be
+    deleted once the new files are committed to the database.
+    """
+    _deferred_deletes.uris = []
+    try:
+        yield _deferred_deletes.uris
+    finally:
+        _deferred_deletes.uris = None
+
+
+def _get_instance(key, factory):
+    """Get a per-process instance of an object identified by `key`, creating it using `factory` if needed
+    """
+    with _instances_lock:
+        if key not in _instances:
+            _instances[key] = factory()
+        return _instances[key]
 
 
 class AssetUploader(object):
@@ -58,6 +214,7 @@ class AssetUploader(object):
         self._clear = None
         self._file_field_name = None
         self._uploaded_file = None
+        self._direct_upload = False
         self._old_filename = None
 
         if old_filename:
@@ -78,10 +235,15 @@ class AssetUploader(object):
 
         `clear_field` is the name of a boolean field which requests the upload
         to be deleted.
+
+        If direct uploads are enabled, instead of an uploaded file the
+        `<file_field>_token` field may contain a token provided to the client
+        when requesting to upload an asset directly to storage.
         """
         self._filename = data_dict.get(url_field, '')
         self._clear = data_dict.pop(clear_field, None)
         uploaded_file = data_dict.pop(file_field, None)
+        upload_token = data_dict.pop(file_field + direct_upload.TOKEN_FIELD_SUFFIX, None)
         filename = None
 
         if _is_uploaded_file_field(uploaded_file):
@@ -90,6 +252,12 @@ class AssetUploader(object):
             filename = self._get_storage_uri(self._filename, self._object_type)
             _log.debug("Got a new uploaded asset, file name will be %s", self._filename)
 
+        elif upload_token and is_direct_upload_enabled():
+            self._filename = self._verify_upload_token(upload_token)
+            self._direct_upload = True
+            filename = self._get_storage_uri(self._filename, self._object_type)
+            _log.debug("Got a directly uploaded asset, file name is %s", self._filename)
+
         elif self._old_filename and not self._old_filename.startswith('http'):
             if not self._clear:
                 # Keep the old filename in data_dict
@@ -108,48 +276,178 @@ class AssetUploader(object):
         max_size is the maximum file size to accept in megabytes
         (note that not all backends will support this limitation).
         """
-        if self._uploaded_file is not None:
-            _log.debug("Initiating file upload for %s, storage is %s", self._filename, self._storage)
-            size = get_uploaded_size(self._uploaded_file)
-            _log.debug("Detected file size: %s", size)
-            if size and max_size and size > max_size * MB:
-                raise toolkit.ValidationError({'upload': ['File upload too large']})
-
-            mimetype = get_uploaded_mimetype(self._uploaded_file)
-            _log.debug("Detected file MIME type: %s", mimetype)
-            stored = self._storage.upload(_get_underlying_file(self._uploaded_file),
+        with tracing.span('upload', {'asset_storage.object_type': self._object_type}):
+            if self._uploaded_file is not None:
+                self._upload_file(max_size)
+                self._clear = True
+            elif self._direct_upload:
+                with tracing.span('verify_direct_upload'):
+                    self._verify_direct_upload()
+                self._clear = True
+
+            if self._clear \
+                    and self._old_filename \
+                    and not is_absolute_http_url(self._old_filename):
+                deferred = getattr(_deferred_deletes, 'uris', None)
+                if deferred is not None:
+                    _log.debug("Deferring delete of old asset file: %s", self._old_filename)
+                    deferred.append(self._old_filename)
+                    return
+                with tracing.span('delete_old_file'):
+                    self._delete_old_file()
+
+    def _upload_file(self, max_size):
+        # type: (int) -> None
+        """Upload the new file to storage
+        """
+        _log.debug("Initiating file upload for %s, storage is %s", self._filename, self._storage)
+        size = get_uploaded_size(self._uploaded_file)
+        _log.debug("Detected file size: %s", size)
+        if size and max_size and size > max_size * MB:
+            raise toolkit.ValidationError({'upload': ['File upload too large']})
+
+        validator = get_configured_image_validator()
+        if validator:
+            with tracing.span('validate_image'):
+                self._validate_image(validator)
+
+        try:
+            with get_configured_admission().admit():
+                self._store_file()
+        except AdmissionRejected as e:
+            _log.warning("Rejected upload of %s: %s", self._filename, e)
+            raise toolkit.ValidationError({'upload': ['Too many uploads are in progress, please try again later']})
+
+    def _validate_image(self, validator):
+        # type: (ImageValidator) -> None
+        """Validate an uploaded image, before anything is sent to storage
+        """
+        mimetype = get_uploaded_mimetype(self._uploaded_file)
+        try:
+            info = validator.validate(_get_underlying_file(self._uploaded_file), mimetype)
+        except InvalidImage as e:
+            _log.info("Rejected invalid uploaded image %s: %s", self._filename, e)
+            raise toolkit.ValidationError({'upload': [str(e)]})
+        if info is not None:
+            _log.debug("Validated uploaded %s image, %dx%d pixels, %d frames",
+                       info.format, info.width, info.height, info.frames)
+
+    def _store_file(self):
+        # type: () -> None
+        """Optimize and store the new file, and any precompressed variants
+        """
+        mimetype = get_uploaded_mimetype(self._uploaded_file)
+        _log.debug("Detected file MIME type: %s", mimetype)
+        stream = _get_underlying_file(self._uploaded_file)
+        optimizer = get_configured_optimizer()
+        if optimizer:
+            with tracing.span('optimize'):
+                stream = optimizer.process(stream, mimetype)
+
+        with tracing.span('storage_upload', {'asset_storage.name': self._filename}):
+            stored = self._storage.upload(stream,
                                           self._filename,
                                           self._object_type,
                                           mimetype=mimetype)
-            _log.debug("Finished uploading file %s, %d bytes written to storage", self._filename, stored)
-            self._clear = True
+        _log.debug("Finished uploading file %s, %d bytes written to storage", self._filename, stored)
+        if is_precompress_enabled() and compression.is_compressible(mimetype):
+            with tracing.span('upload_compressed_variants'):
+                self._upload_compressed_variants(stream, mimetype)
+        invalidate_cached('{}/{}'.format(self._object_type, self._filename))
+        if is_placeholders_enabled() and mimetype in placeholders.MIMETYPES:
+            with tracing.span('upload_placeholder'):
+                self._upload_placeholder(stream)
+
+    def _verify_upload_token(self, token):
+        # type: (str) -> str
+        """Verify a direct upload token, returning the name of the uploaded file
+        """
+        name = direct_upload.verify_token(get_secret(), self._object_type, token)
+        if name is None:
+            raise toolkit.ValidationError({'upload': ['Invalid or expired upload token']})
+        return name
+
+    def _verify_direct_upload(self):
+        # type: () -> None
+        """Verify that a directly uploaded file exists in storage
+        """
+        uri = self._storage.get_storage_uri(self._filename, self._object_type)
+        if is_absolute_http_url(uri):
+            # Publicly readable storage backends provide absolute URLs, but expect relative URIs
+            uri = '{}/{}'.format(self._object_type, self._filename)
+        if not self._storage.exists(uri):
+            raise toolkit.ValidationError({'upload': ['Uploaded file was not found in storage']})
+        _log.debug("Verified directly uploaded file %s exists in storage", self._filename)
+
+    def _delete_old_file(self):
+        # type: () -> None
+        """Delete the old file from storage
+        """
+        _log.debug("Clearing old asset file: %s", self._old_filename)
+        self._storage.delete(self._old_filename)
+        invalidate_cached(self._old_filename)
+        if is_precompress_enabled() and compression.is_compressible(mimetypes.guess_type(self._old_filename)[0]):
+            for encoding in compression.available_encodings():
+                self._storage.delete(compression.variant_name(self._old_filename, encoding))
+        if is_placeholders_enabled() and mimetypes.guess_type(self._old_filename)[0] in placeholders.MIMETYPES:
+            self._storage.delete(placeholders.metadata_name(self._old_filename))
+
+    def _upload_compressed_variants(self, stream, mimetype):
+        # type: (BinaryIO, str) -> None
+        """Upload precompressed variants of the uploaded file
+
+        Variants are only uploaded if they are smaller than the original file
+        """
+        try:
+            stream.seek(0)
+        except (AttributeError, IOError):
+            _log.debug("Uploaded file stream is not seekable, not creating compressed variants")
+            return
+
+        content = stream.read()
+        if len(content) < compression.MIN_SIZE:
+            return
+
+        for encoding in compression.available_encodings():
+            compressed = compression.compress(content, encoding)
+            if len(compressed) >= len(content):
+                continue
+            self._storage.upload(BytesIO(compressed),
+                                 compression.variant_name(self._filename, encoding),
+                                 self._object_type,
+                                 mimetype=mimetype,
+                                 content_encoding=encoding)
+            _log.debug("Uploaded %s compressed variant of %s, %d bytes (%d uncompressed)",
+                       encoding, self._filename, len(compressed), len(content))
+
+    def _upload_placeholder(self, stream):
+        # type: (BinaryIO) -> None
+        """Compute and upload the placeholder metadata of an uploaded image
+        """
+        try:
+            stream.tell()
+        except (AttributeError, IOError):
+            _log.debug("Uploaded file stream is not seekable, not creating a placeholder")
+            return
 
-        if self._clear \
-                and self._old_filename \
-                and not is_absolute_http_url(self._old_filename):
-            _log.debug("Clearing old asset file: %s", self._old_filename)
-            self._storage.delete(self._old_filename)
+        metadata = placeholders.upload_metadata(self._storage, stream, self._filename, self._object_type)
+        if metadata is not None:
+            _log.debug("Uploaded placeholder metadata of %s (%dx%d, %s)",
+                       self._filename, metadata['width'], metadata['height'], metadata['color'])
 
     def _get_storage_uri(self, filename, prefix):
         # type: (str, Optional[str]) -> str
         """Get the URI of a to-be-uploaded file from the storage backend and
         encode it in a way suitable for saving in the DB
         """
-        storage_url = self._storage.get_storage_uri(filename, prefix)
-        if is_absolute_http_url(storage_url):
-            return storage_url
-        return toolkit.url_for('asset_storage.uploaded_file',
-                               file_uri=quote(storage_url, safe='/'),
-                               _external=True)
+        return get_download_url(self._storage, filename, prefix)
 
     @staticmethod
     def _create_uploaded_filename(uploaded_file_field):
         # type: (UploadedFileWrapper) -> str
         """Create a filename for storage for the new uploaded file
         """
-        now = str(datetime.datetime.utcnow())
-        filename = '{}-{}'.format(now, uploaded_file_field.filename)
-        return munge_filename_legacy(filename)
+        return create_storage_filename(uploaded_file_field.filename)
 
     @staticmethod
     def _parse_old_uri(url):
@@ -168,7 +466,171 @@ class AssetUploader(object):
             raise RuntimeError("We really didn't get the expected URL pattern here")
 
         if url.startswith(pattern_parts[0]) and url.endswith(pattern_parts[1]):
-            return decode_uri(url[len(pattern_parts[0])][:-len(pattern_parts[1])])
+            return decode_uri(url[len(pattern_parts[0]):len(url) - len(pattern_parts[1])])
+
+
+class ResourceUploader(object):
+    """Store uploaded resource files in the configured storage backend
+
+    This follows the interface of CKAN's own `ResourceUpload`. Files are
+    streamed to storage, so large files are never held in memory; They are
+    stored as `resources/<resource id>/<file name>`.
+
+    Resource files may belong to private datasets, so they are never uploaded
+    to storage which serves files publicly.
+    """
+    def __init__(self, storage, resource):
+        # type: (StorageBackend, Dict[str, Any]) -> ResourceUploader
+        """Create a new resource uploader
+
+        This is called by CKAN before a resource is created or updated, and
+        updates the resource dict if a file was uploaded or cleared.
+        """
+        self._storage = storage
+        self._uploaded_file = None
+        self._is_update = bool(resource.get('id'))
+        self.filename = None
+        self.mimetype = None
+        self.filesize = None
+        self.clear = resource.pop('clear_upload', None)
+        self._stored_filename = None
+        if resource.get('url_type') == 'upload' and resource.get('url'):
+            self._stored_filename = posixpath.basename(resource['url'])
+
+        uploaded_file = resource.pop('upload', None)
+        if _is_uploaded_file_field(uploaded_file):
+            self._uploaded_file = uploaded_file
+            self.filename = munge_filename(uploaded_file.filename)
+            self.mimetype = get_uploaded_mimetype(uploaded_file)
+            size = get_uploaded_size(uploaded_file)
+            self.filesize = int(size) if size is not None else None
+            resource['url'] = self.filename
+            resource['url_type'] = 'upload'
+            resource['last_modified'] = datetime.datetime.utcnow()
+            _log.debug("Got a new uploaded resource file %s", self.filename)
+        elif self.clear:
+            resource['url_type'] = ''
+
+    def get_path(self, id, filename=None):
+        # type: (str, Optional[str]) -> str
+        """Get the storage URI of a resource file
+
+        Unlike with CKAN's own uploader, this is not a local file path. The
+        file name defaults to the name of the uploaded file, or else to the
+        file name in the resource's URL. This does not access storage.
+        """
+        filename = filename or self.filename or self._stored_filename
+        if not filename:
+            raise exc.ObjectNotFound('No file was uploaded for resource {}'.format(id))
+        return get_resource_uri(id, filename)
+
+    def get_url(self, id, filename=None):
+        # type: (str, Optional[str]) -> Optional[str]
+        """Get the public URL of a resource file
+
+        Resource files are never stored in storage which serves files
+        publicly, so this always returns None; They are served through CKAN.
+        """
+        return None
+
+    def upload(self, id, max_size=10):
+        # type: (str, int) -> None
+        """Upload the file to storage, and delete any previously uploaded files of the resource
+
+        `max_size` is the maximum file size to accept in megabytes
+        """
+        if self.filename:
+            with tracing.span('resource_upload', {'asset_storage.resource_id': id}):
+                self._upload_file(id, max_size)
+            if self._is_update:
+                self._delete_files(id, keep=self.filename)
+        elif self.clear and self._is_update:
+            self._delete_files(id)
+
+    def _upload_file(self, id, max_size):
+        # type: (str, int) -> None
+        max_bytes = max_size * MB if max_size else None
+        if self.filesize and max_bytes and self.filesize > max_bytes:
+            raise toolkit.ValidationError({'upload': ['File upload too large']})
+
+        if is_absolute_http_url(self._storage.get_storage_uri(self.filename, get_resource_prefix(id))):
+            _log.error("Refusing to upload resource %s: storage backend %s serves files publicly, and resource "
+                       "uploads require storage which does not", id, self._storage)
+            raise toolkit.ValidationError({'upload': ['Resource uploads are not available, please contact the '
+                                                      'site administrator']})
+
+        stream = _get_underlying_file(self._uploaded_file)
+        if self.filesize is None and max_bytes:
+            stream = SizeLimitedStream(stream, max_bytes)
+
+        try:
+            with get_configured_admission().admit():
+                stored = self._storage.upload(stream, self.filename, get_resource_prefix(id), mimetype=self.mimetype)
+        except AdmissionRejected as e:
+            _log.warning("Rejected upload of resource %s: %s", id, e)
+            raise toolkit.ValidationError({'upload': ['Too many uploads are in progress, please try again later']})
+        except exc.InvalidInput as e:
+            raise toolkit.ValidationError({'upload': [str(e)]})
+        _log.debug("Finished uploading resource file %s, %d bytes written to storage", self.filename, stored)
+
+    def _delete_files(self, id, keep=None):
+        # type: (str, Optional[str]) -> None
+        """Delete uploaded files of a resource, except for `keep`
+        """
+        keep_uri = get_resource_uri(id, keep) if keep else None
+        for uri in self._list_files(id):
+            if uri != keep_uri:
+                _log.debug("Deleting previously uploaded resource file %s", uri)
+                self._storage.delete(uri)
+
+    def _list_files(self, id):
+        # type: (str) -> List[str]
+        try:
+            return list(self._storage.iter_uris(get_resource_prefix(id)))
+        except NotImplementedError:
+            _log.debug("Storage backend %s cannot list files, not looking up resource files", self._storage)
+            return []
+
+
+class SizeLimitedStream(object):
+    """Wrap a stream of unknown size, raising `InvalidInput` if more than `max_size` bytes are read from it
+    """
+    def __init__(self, stream, max_size):
+        # type: (BinaryIO, int) -> SizeLimitedStream
+        self._stream = stream
+        self._max_size = max_size
+        self._read = 0
+
+    def read(self, size=-1):
+        # type: (int) -> bytes
+        data = self._stream.read(size)
+        self._read += len(data)
+        if self._read > self._max_size:
+            raise exc.InvalidInput('File upload too large')
+        return data
+
+    def tell(self):
+        # type: () -> int
+        return self._read
+
+
+def get_resource_prefix(resource_id):
+    # type: (str) -> str
+    return '{}/{}'.format(RESOURCES_PREFIX, resource_id)
+
+
+def get_resource_uri(resource_id, filename):
+    # type: (str, str) -> str
+    """Get the storage URI of an uploaded resource file
+    """
+    return '{}/{}'.format(get_resource_prefix(resource_id), filename)
+
+
+def is_resource_uploads_enabled():
+    # type: () -> bool
+    """Tell if resource files should be uploaded to the configured storage backend
+    """
+    return toolkit.asbool(toolkit.config.get(CONF_RESOURCE_UPLOADS, False))
 
 
 def _is_uploaded_file_field(field):
@@ -190,6 +652,65 @@ def _is_uploaded_file_field(field):
     return hasattr(field, 'filename') and field.filename
 
 
+def create_storage_filename(filename):
+    # type: (str) -> str
+    """Create a unique filename for storage, given the name of an uploaded file
+    """
+    now = str(datetime.datetime.utcnow())
+    filename = '{}-{}'.format(now, filename)
+    return munge_filename_legacy(filename)
+
+
+def get_download_url(storage, filename, prefix):
+    # type: (StorageBackend, str, Optional[str]) -> str
+    """Get the absolute download URL of a file in storage
+    """
+    storage_url = storage.get_storage_uri(filename, prefix)
+    if is_absolute_http_url(storage_url):
+        return storage_url
+    return toolkit.url_for('asset_storage.uploaded_file',
+                           file_uri=quote(storage_url, safe='/'),
+                           _external=True)
+
+
+def is_direct_upload_enabled():
+    # type: () -> bool
+    """Tell if uploading assets directly to storage is enabled
+    """
+    return toolkit.asbool(toolkit.config.get(CONF_DIRECT_UPLOADS, False))
+
+
+def get_secret():
+    # type: () -> str
+    """Get the secret key used for signing direct upload tokens
+    """
+    secret = toolkit.config.get('SECRET_KEY') or toolkit.config.get('beaker.session.secret')
+    if not secret:
+        raise RuntimeError('A secret key must be configured for direct uploads')
+    return secret
+
+
+def is_server_timing_enabled():
+    # type: () -> bool
+    """Tell if `Server-Timing` headers should be added to asset download responses
+    """
+    return toolkit.asbool(toolkit.config.get(CONF_SERVER_TIMING, False))
+
+
+def is_placeholders_enabled():
+    # type: () -> bool
+    """Tell if placeholder metadata should be computed for uploaded images
+    """
+    return toolkit.asbool(toolkit.config.get(CONF_PLACEHOLDERS, False))
+
+
+def is_precompress_enabled():
+    # type: () -> bool
+    """Tell if precompressed variants of compressible assets are enabled
+    """
+    return toolkit.asbool(toolkit.config.get(CONF_PRECOMPRESS, False))
+
+
 def decode_uri(uri):
     # type: (str) -> str
     """Decode a URI before passing it to storage
@@ -214,7 +735,7 @@ def get_uploaded_mimetype(uploaded):
     mimetype = None
     # Uploaded content-type header set by client
     try:
-        mimetype = uploaded.headers['Content-Length']
+        mimetype = uploaded.headers['Content-Type']
     except (AttributeError, KeyError):
         pass
 
@@ -0,0 +1,194 @@
+"""Validation of uploaded images
+
+Images are validated by reading only their headers, without decoding pixel
+data, so that oversized images and decompression bombs (small files which
+decode to huge images) can be rejected cheaply, before being stored.
+"""
+import logging
+import os
+import struct
+import warnings
+from typing import BinaryIO, Optional
+
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+# MIME types considered equivalent when comparing the claimed and actual types
+MIMETYPE_ALIASES = {'image/jpg': 'image/jpeg',
+                    'image/pjpeg': 'image/jpeg',
+                    'image/mpo': 'image/jpeg',  # Multi-picture JPEG files, as produced by some cameras
+                    'image/x-png': 'image/png',
+                    'image/x-ms-bmp': 'image/bmp',
+                    'image/vnd.microsoft.icon': 'image/x-icon'}
+
+# Vector images are not validated
+UNVALIDATED_MIMETYPES = {'image/svg+xml'}
+
+_log = logging.getLogger(__name__)
+
+
+class InvalidImage(ValueError):
+    """An uploaded image is invalid, or exceeds the configured limits
+    """
+    pass
+
+
+class ImageInfo(object):
+    """Image properties read from the image header
+    """
+    def __init__(self, image_format, mimetype, width, height, frames):
+        # type: (str, Optional[str], int, int, int) -> ImageInfo
+        self.format = image_format
+        self.mimetype = mimetype
+        self.width = width
+        self.height = height
+        self.frames = frames
+
+    @property
+    def pixels(self):
+        # type: () -> int
+        return self.width * self.height
+
+
+class ImageValidator(object):
+    """Validate uploaded images against configured limits
+    """
+    def __init__(self, max_pixels=None, max_dimension=None, max_frames=None):
+        # type: (Optional[int], Optional[int], Optional[int]) -> ImageValidator
+        """Create a new image validator
+
+        Args:
+            max_pixels: Max number of pixels (width x height) in an image, or `None` for no limit
+            max_dimension: Max width or height of an image in pixels, or `None` for no limit
+            max_frames: Max number of frames in an animated image, or `None` for no limit
+        """
+        self._max_pixels = max_pixels
+        self._max_dimension = max_dimension
+        self._max_frames = max_frames
+
+    def validate(self, stream, mimetype):
+        # type: (BinaryIO, Optional[str]) -> Optional[ImageInfo]
+        """Validate an uploaded image
+
+        Only files claimed to be raster images (by their MIME type) are
+        validated. The stream is rewound to its original position.
+
+        Returns the image properties, or None if the file was not validated.
+        Raises `InvalidImage` if the file is not a valid image of the claimed
+        type, or exceeds the configured limits.
+        """
+        if not mimetype or not mimetype.startswith('image/') or mimetype in UNVALIDATED_MIMETYPES:
+            return None
+
+        try:
+            start_pos = stream.tell()
+        except (AttributeError, IOError):
+            _log.debug("Uploaded file stream is not seekable, not validating")
+            return None
+
+        try:
+            info = read_image_info(stream, self._max_frames)
+        finally:
+            stream.seek(start_pos)
+
+        if MIMETYPE_ALIASES.get(info.mimetype, info.mimetype) != MIMETYPE_ALIASES.get(mimetype, mimetype):
+            raise InvalidImage('File is a {} image, but was uploaded as {}'.format(info.format, mimetype))
+        self._check_limits(info)
+        return info
+
+    def _check_limits(self, info):
+        # type: (ImageInfo) -> None
+        if self._max_dimension and max(info.width, info.height) > self._max_dimension:
+            raise InvalidImage('Image dimensions {}x{} exceed the maximum of {} pixels'.format(
+                info.width, info.height, self._max_dimension))
+        if self._max_pixels and info.pixels > self._max_pixels:
+            raise InvalidImage('Image size of {} pixels exceeds the maximum of {} pixels'.format(
+                info.pixels, self._max_pixels))
+        if self._max_frames and info.frames > self._max_frames:
+            raise InvalidImage('Animated image has more than the maximum of {} frames'.format(self._max_frames))
+
+
+def read_image_info(stream, max_frames=None):
+    # type: (BinaryIO, Optional[int]) -> ImageInfo
+    """Read the format, dimensions and frame count of an image from its header
+
+    Pixel data is not decoded. If `max_frames` is set, counting frames stops
+    once this number is exceeded.
+    """
+    if Image is None:
+        raise RuntimeError('The Pillow package is required for validating images')
+
+    start_pos = stream.tell()
+    with warnings.catch_warnings():
+        # Image size limits are enforced by the caller; Pillow's own limit applies when decoding
+        warnings.simplefilter('ignore', Image.DecompressionBombWarning)
+        try:
+            image = Image.open(stream)
+        except Image.DecompressionBombError:
+            raise InvalidImage('Image is too large')
+        except Exception:
+            raise InvalidImage('File is not a valid image')
+
+    width, height = image.size
+    if image.format == 'GIF':
+        # Pillow counts GIF frames by seeking to each, which decodes them
+        stream.seek(start_pos)
+        frames = count_gif_frames(stream, max_frames)
+    else:
+        frames = getattr(image, 'n_frames', 1)
+    return ImageInfo(image.format, Image.MIME.get(image.format), width, height, frames)
+
+
+def count_gif_frames(stream, max_frames=None):
+    # type: (BinaryIO, Optional[int]) -> int
+    """Count the frames in a GIF image, by skipping over the data blocks of each frame
+
+    Stops counting once `max_frames` is exceeded, if set.
+    """
+    header = stream.read(13)
+    if len(header) < 13 or header[:3] != b'GIF':
+        raise InvalidImage('File is not a valid GIF image')
+    _skip_color_table(stream, _byte(header, 10))
+
+    frames = 0
+    while max_frames is None or frames <= max_frames:
+        block_type = stream.read(1)
+        if block_type == b',':
+            # Image descriptor, followed by an optional color table, LZW code size and image data
+            descriptor = stream.read(9)
+            if len(descriptor) < 9:
+                break
+            _skip_color_table(stream, _byte(descriptor, 8))
+            stream.read(1)
+            _skip_sub_blocks(stream)
+            frames += 1
+        elif block_type == b'!':
+            # Extension, with a label followed by data sub-blocks
+            stream.read(1)
+            _skip_sub_blocks(stream)
+        else:
+            # Trailer, or truncated file
+            break
+    return frames
+
+
+def _byte(data, index):
+    # type: (bytes, int) -> int
+    return struct.unpack('B', data[index:index + 1])[0]
+
+
+def _skip_color_table(stream, flags):
+    # type: (BinaryIO, int) -> None
+    if flags & 0x80:
+        stream.seek(3 * 2 ** ((flags & 0x07) + 1), os.SEEK_CUR)
+
+
+def _skip_sub_blocks(stream):
+    # type: (BinaryIO) -> None
+    while True:
+        size = stream.read(1)
+        if not size or size == b'\x00':
+            return
+        stream.seek(_byte(size, 0), os.SEEK_CUR)